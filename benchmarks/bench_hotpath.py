@@ -0,0 +1,464 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+
+Benchmark suite for the poll / serialize / send hot path. Each benchmark
+runs in its own child process, so that the peak RSS reported is its own,
+and reports throughput (datapoints per second), per-iteration latency
+percentiles and peak RSS:
+
+- ``serialize`` - serializing a poll's worth of datapoints to the plaintext
+  protocol, as each destination does on send.
+- ``send_data`` - ``CachingGraphiteClient.send_data()`` to a local TCP sink.
+- ``flush_cache_1k`` / ``flush_cache_10k`` - replaying a disk cache built
+  from 1,000 / 10,000 failed sends to a local TCP sink.
+- ``onewire_poll`` - ``OneWireCollector.poll()`` over a fake sysfs tree.
+- ``onewire_poll_sysfs`` - the same, using the ``sysfs`` sensor reader
+  instead of w1thermsensor.
+- ``do_poll`` - ``MetricsHandler.do_poll()`` end to end, over the same tree.
+
+The last three need the collectors' dependencies installed, and are skipped
+if they aren't.
+
+Results can be saved as a baseline, and later runs compared against it;
+the comparison exits non-zero if any benchmark's throughput dropped, or its
+p95 latency grew, by more than the tolerance. Baselines are only comparable
+on the same hardware, so keep one per device type.
+
+Run from the top of the source tree:
+``python benchmarks/bench_hotpath.py [--save baseline.json]
+[--compare baseline.json]``
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import argparse
+import logging
+import multiprocessing
+from copy import deepcopy
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# don't try to load the 1-Wire kernel modules when importing w1thermsensor
+os.environ['W1THERMSENSOR_NO_KERNEL_MODULE'] = '1'
+
+from pi2graphite.graphiteclient import (  # noqa
+    CachingGraphiteClient, GraphiteDestination, LineSerializer
+)
+from pi2graphite.config import Config  # noqa
+
+# filling the cache for the flush benchmarks logs a warning per send
+logging.basicConfig(level=logging.ERROR)
+
+#: list of (name, function) for each benchmark, in the order to run them
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Decorator to register a benchmark function. The function takes the
+    parsed command-line arguments, and returns a 2-tuple of (datapoints per
+    iteration, list of per-iteration latencies in seconds), or raises
+    :py:exc:`~.Skip`.
+    """
+    def wrap(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return wrap
+
+
+class Skip(Exception):
+    """
+    Raised by a benchmark that can't run here.
+    """
+    pass
+
+
+def make_data(num_metrics, ts=1483228800):
+    """
+    Return a data list of ``num_metrics`` datapoints, as the poll loop would
+    pass to ``CachingGraphiteClient.send_data()``.
+    """
+    return [
+        ('sensors.sensor%d.temp_c' % i, 20.0 + (i % 100) / 8.0, ts)
+        for i in range(num_metrics)
+    ]
+
+
+def timed(func, iterations, setup=None):
+    """
+    Call ``func`` ``iterations`` times, after one untimed warm-up call, and
+    return the list of call durations. If given, ``setup`` is called
+    (untimed) before each call.
+    """
+    res = []
+    for i in range(iterations + 1):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        if i > 0:
+            res.append(time.time() - start)
+    return res
+
+
+class Sink(object):
+    """
+    Local TCP server that reads and discards everything sent to it.
+    """
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(8)
+        self.port = self._sock.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._sock.accept()
+            t = threading.Thread(target=self._read, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    @staticmethod
+    def _read(conn):
+        while len(conn.recv(262144)) > 0:
+            pass
+        conn.close()
+
+
+def make_sysfs(sensors):
+    """
+    Create a fake ``/sys/bus/w1/devices`` tree of DS18B20 sensors, and
+    return its path.
+    """
+    base = tempfile.mkdtemp(prefix='pi2graphite-bench-w1-')
+    for i in range(sensors):
+        d = os.path.join(base, '28-%012x' % (i + 1))
+        os.mkdir(d)
+        with open(os.path.join(d, 'w1_slave'), 'w') as fh:
+            fh.write('72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+                     '72 01 4b 46 7f ff 0e 10 57 t=%d\n' % (23125 + i))
+    return base
+
+
+def make_config(tmpdir, port, onewire=None, **graphite):
+    """
+    Write a config file for benchmarking, and return it loaded.
+    """
+    conf = deepcopy(Config._example)
+    conf['graphite'].update({'host': '127.0.0.1', 'port': port})
+    conf['graphite'].update(graphite)
+    conf['onewire'].update(onewire or {})
+    conf['cache']['directory'] = os.path.join(tmpdir, 'cache')
+    conf['send_wifi_metrics'] = False
+    path = os.path.join(tmpdir, 'config.json')
+    with open(path, 'w') as fh:
+        json.dump(conf, fh)
+    return Config(path)
+
+
+@benchmark('serialize')
+def bench_serialize(args):
+    data = make_data(args.metrics)
+    serializer = LineSerializer(prefix='pi2graphite.myhost')
+    return args.metrics, timed(
+        lambda: serializer.serialize(data), args.iterations
+    )
+
+
+@benchmark('send_data')
+def bench_send_data(args):
+    sink = Sink()
+    tmpdir = tempfile.mkdtemp(prefix='pi2graphite-bench-')
+    try:
+        client = CachingGraphiteClient(
+            '127.0.0.1', port=sink.port, metric_prefix='pi2graphite.myhost',
+            cache_dir=tmpdir, replay_jitter=0
+        )
+        data = make_data(args.metrics)
+        res = timed(lambda: client.send_data(data), args.iterations)
+        client.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return args.metrics, res
+
+
+def bench_flush_cache(args, sends):
+    """
+    Replay a disk cache holding ``sends`` failed sends of ``--cache-points``
+    datapoints each.
+    """
+    sink = Sink()
+    tmpdir = tempfile.mkdtemp(prefix='pi2graphite-bench-')
+    try:
+        dest = GraphiteDestination(
+            '127.0.0.1', port=sink.port, cache_dir=tmpdir, replay_jitter=0,
+            replay_chunk_delay=0
+        )
+        data = make_data(args.cache_points)
+
+        def fill():
+            for _ in range(sends):
+                dest._cache_data(data)
+
+        res = timed(dest._flush_cache, args.flush_iterations, setup=fill)
+        dest.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return sends * args.cache_points, res
+
+
+@benchmark('flush_cache_1k')
+def bench_flush_cache_1k(args):
+    return bench_flush_cache(args, 1000)
+
+
+@benchmark('flush_cache_10k')
+def bench_flush_cache_10k(args):
+    return bench_flush_cache(args, 10000)
+
+
+def patch_w1(base):
+    """
+    Point w1thermsensor at a fake sysfs tree.
+    """
+    try:
+        from w1thermsensor import W1ThermSensor
+    except ImportError:
+        raise Skip('w1thermsensor is not installed')
+    W1ThermSensor.BASE_DIRECTORY = base
+
+
+def bench_onewire(args, reader):
+    base = make_sysfs(args.sensors)
+    try:
+        patch_w1(base)
+        from pi2graphite.onewire_collector import OneWireCollector
+        tmpdir = tempfile.mkdtemp(prefix='pi2graphite-bench-')
+        try:
+            collector = OneWireCollector(
+                make_config(tmpdir, 2003, onewire={'reader': reader})
+            )
+            res = timed(collector.poll, args.iterations)
+            collector.close()
+        finally:
+            shutil.rmtree(tmpdir)
+    finally:
+        shutil.rmtree(base)
+    return args.sensors * 2, res
+
+
+@benchmark('onewire_poll')
+def bench_onewire_poll(args):
+    return bench_onewire(args, 'w1thermsensor')
+
+
+@benchmark('onewire_poll_sysfs')
+def bench_onewire_poll_sysfs(args):
+    return bench_onewire(args, 'sysfs')
+
+
+@benchmark('do_poll')
+def bench_do_poll(args):
+    base = make_sysfs(args.sensors)
+    try:
+        patch_w1(base)
+        try:
+            from pi2graphite.handler import MetricsHandler
+        except ImportError as ex:
+            raise Skip('cannot import MetricsHandler: %s' % ex)
+        tmpdir = tempfile.mkdtemp(prefix='pi2graphite-bench-')
+        try:
+            handler = MetricsHandler(make_config(tmpdir, Sink().port))
+            res = timed(handler.do_poll, args.iterations)
+            handler._graphite.close()
+        finally:
+            shutil.rmtree(tmpdir)
+    finally:
+        shutil.rmtree(base)
+    return args.sensors * 2, res
+
+
+def percentile(samples, pct):
+    """
+    Return the ``pct`` percentile of a sorted list of samples, by the
+    nearest-rank method.
+    """
+    idx = int(round(pct / 100.0 * len(samples) + 0.5)) - 1
+    return samples[max(0, min(len(samples) - 1, idx))]
+
+
+def peak_rss_kb():
+    """
+    Return the peak RSS of this process in KiB, or 0 if unknown.
+    """
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, KiB elsewhere
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+
+def run_one(name, func, args, queue):
+    """
+    Run a single benchmark (in a child process) and put its results, or the
+    reason it was skipped, on ``queue``.
+    """
+    try:
+        points, latencies = func(args)
+    except Skip as ex:
+        queue.put({'name': name, 'skipped': str(ex)})
+        return
+    latencies.sort()
+    total = sum(latencies)
+    queue.put({
+        'name': name,
+        'iterations': len(latencies),
+        'points_per_sec': points * len(latencies) / total if total else 0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'peak_rss_kb': peak_rss_kb()
+    })
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline; print and return the list of
+    regressions.
+    """
+    base = dict((r['name'], r) for r in baseline)
+    regressions = []
+    for r in results:
+        b = base.get(r['name'])
+        if b is None or 'skipped' in r or 'skipped' in b:
+            continue
+        if r['points_per_sec'] < b['points_per_sec'] * (1 - tolerance):
+            regressions.append('%s: throughput %.0f/s vs baseline %.0f/s' % (
+                r['name'], r['points_per_sec'], b['points_per_sec']))
+        if r['p95_ms'] > b['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 latency %.3f ms vs baseline %.3f ms'
+                               % (r['name'], r['p95_ms'], b['p95_ms']))
+    for line in regressions:
+        print('REGRESSION ' + line)
+    return regressions
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description='Benchmark the poll / serialize '
+                                '/ send hot path')
+    p.add_argument('-b', '--benchmark', dest='benchmarks', action='append',
+                   choices=[b[0] for b in BENCHMARKS], default=None,
+                   help='benchmark to run; may be given more than once '
+                        '(default all)')
+    p.add_argument('-n', '--iterations', dest='iterations', type=int,
+                   default=200, help='iterations per benchmark (default 200)')
+    p.add_argument('-m', '--metrics', dest='metrics', type=int, default=1000,
+                   help='datapoints per send (default 1000)')
+    p.add_argument('--cache-points', dest='cache_points', type=int,
+                   default=10,
+                   help='datapoints per cached failed send (default 10)')
+    p.add_argument('--flush-iterations', dest='flush_iterations', type=int,
+                   default=5,
+                   help='iterations of the flush_cache benchmarks (default 5)')
+    p.add_argument('-s', '--sensors', dest='sensors', type=int, default=10,
+                   help='fake 1-Wire sensors (default 10)')
+    p.add_argument('--save', dest='save', type=str, default=None,
+                   help='save results as a baseline to this JSON file')
+    p.add_argument('--compare', dest='compare', type=str, default=None,
+                   help='compare results to the baseline in this JSON file, '
+                        'exiting 1 on regressions')
+    p.add_argument('-t', '--tolerance', dest='tolerance', type=float,
+                   default=0.2, help='fraction by which throughput may drop '
+                   'or p95 latency grow before it is a regression '
+                   '(default 0.2)')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = []
+    print('%-18s %13s %9s %9s %9s %9s %10s' % (
+        'benchmark', 'points/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+        'rss KiB'))
+    for name, func in BENCHMARKS:
+        if args.benchmarks is not None and name not in args.benchmarks:
+            continue
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(
+            target=run_one, args=(name, func, args, queue)
+        )
+        proc.start()
+        r = queue.get()
+        proc.join()
+        results.append(r)
+        if 'skipped' in r:
+            print('%-18s skipped: %s' % (name, r['skipped']))
+            continue
+        print('%-18s %13.0f %9.3f %9.3f %9.3f %9.3f %10d' % (
+            name, r['points_per_sec'], r['p50_ms'], r['p95_ms'],
+            r['p99_ms'], r['max_ms'], r['peak_rss_kb']))
+    if args.save is not None:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % args.save)
+    if args.compare is not None:
+        with open(args.compare, 'r') as fh:
+            baseline = json.load(fh)
+        if compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
+        print('No regressions against %s' % args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+
+Micro-benchmark of serializing datapoints to the Graphite plaintext protocol;
+the old per-send string formatting versus
+:py:class:`pi2graphite.graphiteclient.LineSerializer`.
+
+Run from the top of the source tree: ``python benchmarks/bench_serializer.py``
+"""
+
+import sys
+import os
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pi2graphite.graphiteclient import LineSerializer  # noqa
+
+
+def make_data(num_metrics, ts=1483228800):
+    """
+    Return a data list of ``num_metrics`` datapoints, as the poll loop would
+    pass to ``CachingGraphiteClient.send_data()``.
+    """
+    return [
+        ('sensors.sensor%d.temp_c' % i, 20.0 + (i % 100) / 8.0, ts)
+        for i in range(num_metrics)
+    ]
+
+
+def format_strings(prefix, data_list):
+    """
+    The previous implementation; build the full path and line for every
+    datapoint with string formatting on each send, join them, then encode
+    the result for the socket.
+    """
+    parts = [
+        "%s.%s %s %d" % (prefix, t[0], t[1], t[2]) for t in data_list
+    ]
+    return ("\n".join(parts) + "\n").encode('utf-8')
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark plaintext protocol '
+                                'serialization')
+    p.add_argument('-m', '--metrics', dest='metrics', type=int,
+                   default=10000, help='datapoints per send (default 10000)')
+    p.add_argument('-n', '--number', dest='number', type=int, default=50,
+                   help='sends per timing run (default 50)')
+    p.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                   help='timing runs; the best is reported (default 5)')
+    args = p.parse_args()
+    prefix = 'pi2graphite.myhost'
+    data = make_data(args.metrics)
+    serializer = LineSerializer(prefix=prefix)
+    assert bytes(serializer.serialize(data)) == format_strings(prefix, data)
+    results = []
+    for name, func in [
+        ('format_strings', lambda: format_strings(prefix, data)),
+        ('LineSerializer', lambda: serializer.serialize(data))
+    ]:
+        best = min(timeit.repeat(func, number=args.number,
+                                 repeat=args.repeat)) / args.number
+        results.append(best)
+        print('%-16s %9.3f ms/send  %8.1f ns/datapoint' % (
+            name, best * 1000, best * 1e9 / args.metrics))
+    print('speedup: %.2fx' % (results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -61,9 +61,52 @@ class Config(object):
         'graphite': {
             'host': '127.0.0.1',
             'port': 2003,
-            'metricPrefix': 'pi2graphite.%HOSTNAME%'
+            'metricPrefix': 'pi2graphite.%HOSTNAME%',
+            'protocol': 'plaintext',
+            'pickleBatchSize': 500,
+            'failureThreshold': 3,
+            'retryBackoff': 5,
+            'retryBackoffMax': 300,
+            'fanout': 'replicate',
+            'udpPatterns': [],
+            'udpPort': 2003,
+            'udpMaxDatagram': 1472,
+            'queueMaxPoints': 10000,
+            'queueRetryDelay': 1,
+            'maxLinesPerWrite': 1000,
+            'maxBytesPerWrite': 65536,
+            'connectTimeout': 10,
+            'sendTimeout': 30,
+            'tcpNoDelay': False,
+            'sendBufferBytes': 0,
+            'dnsCacheTtl': 300
+        },
+        'cache': {
+            'directory': '/var/lib/pi2graphite',
+            'segmentBytes': 1048576,
+            'maxBytes': 104857600,
+            'maxAge': 0,
+            'downsampleAt': 0.75,
+            'downsampleFactor': 2,
+            'downsampleMethod': 'avg',
+            'compress': True,
+            'replayChunkLines': 1000,
+            'replayChunkBytes': 65536,
+            'replayChunkDelay': 0.1,
+            'replayPointsPerSec': 0,
+            'replayBytesPerSec': 0,
+            'replayJitter': 10
+        },
+        'onewire': {
+            'bulkRead': True,
+            'hotplugInterval': 5,
+            'readThreads': 1,
+            'reader': 'w1thermsensor',
+            'rescanInterval': 300,
+            'sensorTimeout': 10
         },
         'send_wifi_metrics': True,
+        'send_self_metrics': True,
         'sensor_names': {
             '10-0008010ff558': 'tempA',
             '10-0008010ff563': 'tempB'
@@ -78,12 +121,139 @@ class Config(object):
     graphite - Graphite server configuration:
 
       - 'host' - (string) Graphite hostname
-      - 'port' - (int) Graphite plaintext port number to use
+      - 'port' - (int) Graphite port number to use. Defaults to 2003 for the
+        plaintext protocol and 2004 for the pickle protocol.
       - 'metricPrefix' - (string) Prefix to use for all metrics. "%HOSTNAME%"
         will be replaced with the system's current hostname.
+      - 'protocol' - (string) Carbon protocol to send with; "plaintext"
+        (default) or "pickle".
+      - 'pickleBatchSize' - (int) When using the pickle protocol, maximum
+        number of datapoints per length-prefixed pickle frame. Default 500.
+      - 'failureThreshold' - (int) after this many consecutive failed sends,
+        stop trying to send and cache data immediately. Default 3.
+      - 'retryBackoff' - (float) seconds to wait before trying to send again
+        after 'failureThreshold' failures. Doubles after each failed retry.
+        Default 5.
+      - 'retryBackoffMax' - (float) maximum seconds to wait before trying to
+        send again. Default 300.
+      - 'destinations' - (list) optional list of multiple Graphite
+        destinations to send to, instead of 'host' and 'port'. Each is a dict
+        with a 'host' key, and optional 'port' (defaults to 'port' above) and
+        'instance' keys. Each destination has its own connection, backoff and
+        cache (in a subdirectory of the cache 'directory'). Data cached
+        directly in the cache 'directory', e.g. before more destinations were
+        added, is moved into these at startup.
+      - 'fanout' - (string) how to send data to multiple 'destinations';
+        "replicate" (default) to send all data to every destination, or
+        "shard" to send each metric to one destination, chosen the same way
+        as carbon-relay's "consistent-hashing" relay method. When sharding,
+        destinations on the same host must have distinct 'instance' values,
+        matching the DESTINATIONS of your carbon-relays.
+      - 'udpPatterns' - (list) shell-style wildcard patterns (e.g.
+        "wifi.*"); metrics whose names (without 'metricPrefix') match any of
+        them are sent fire-and-forget over UDP instead of TCP. They are never
+        cached, so use this only for data where occasional loss is acceptable.
+        Carbon must have ENABLE_UDP_LISTENER set. Default empty (all TCP).
+      - 'udpPort' - (int) carbon UDP listener port. Default 2003.
+      - 'udpMaxDatagram' - (int) maximum size of each UDP datagram in bytes.
+        Default 1472 (fits a 1500 byte MTU).
+      - 'queueMaxPoints' - (int) collected data is put on an in-memory queue
+        and sent by a background thread, so polling never waits on the
+        network. If sending fails, data stays queued and is retried; it is
+        only written to the disk cache once more than this many datapoints
+        are queued. 0 to disable the queue, and send (or cache) data
+        immediately after each poll. Default 10000.
+      - 'queueRetryDelay' - (float) seconds to wait before retrying a failed
+        send of queued data. Default 1.
+      - 'maxLinesPerWrite' - (int) send data in socket writes of at most this
+        many datapoints. 0 for unlimited. Default 1000.
+      - 'maxBytesPerWrite' - (int) with the plaintext protocol, send data in
+        socket writes of at most this many bytes. 0 for unlimited. Default
+        65536.
+      - 'connectTimeout' - (float) timeout in seconds for connecting to
+        Graphite. Default 10.
+      - 'sendTimeout' - (float) timeout in seconds for each socket write to
+        Graphite. Default 30.
+      - 'tcpNoDelay' - (boolean) set TCP_NODELAY on the socket, disabling
+        Nagle's algorithm. Default false.
+      - 'sendBufferBytes' - (int) socket send buffer size (SO_SNDBUF) in
+        bytes; 0 (default) to use the OS default.
+      - 'dnsCacheTtl' - (int) seconds to cache DNS lookups of the Graphite
+        host(s) for. If a lookup fails, the last successful result is used.
+        Default 300.
+
+    cache - On-disk cache of data that could not be sent to Graphite:
+
+      - 'directory' - (string) directory to store the cache in. Default
+        /var/lib/pi2graphite
+      - 'segmentBytes' - (int) the cache is an append-only log split into
+        segment files; a new segment is started once the current one reaches
+        this size in bytes. Default 1048576 (1MiB).
+      - 'maxBytes' - (int) maximum total size of the cache in bytes; once it is
+        exceeded, the oldest segments are evicted. Should be several times
+        'segmentBytes'. 0 for unlimited. Default 104857600 (100MiB).
+      - 'maxAge' - (int) evict cache segments last written to more than this
+        many seconds ago. 0 (default) for unlimited.
+      - 'downsampleAt' - (float) once the cache grows past this fraction of
+        'maxBytes', thin out the oldest segments (once each) to make room
+        before evicting anything. Default 0.75.
+      - 'downsampleFactor' - (int) factor to thin out old segments by; 1 to
+        disable downsampling. Default 2.
+      - 'downsampleMethod' - (string) "avg" (default) to replace each run of
+        'downsampleFactor' points of a metric with their average, or "nth" to
+        keep every 'downsampleFactor'-th point.
+      - 'compress' - (boolean) write the cache in a compact, zlib-compressed
+        format rather than as plaintext. Default true.
+      - 'replayChunkLines' - (int) when sending cached data, read and send it
+        in chunks of at most this many lines. Default 1000.
+      - 'replayChunkBytes' - (int) when sending cached data, read and send it
+        in chunks of at most this many bytes. Default 65536.
+      - 'replayChunkDelay' - (float) cached data is sent by a background
+        thread, which pauses this many seconds between chunks. Default 0.1.
+      - 'replayPointsPerSec' - (float) limit the rate at which cached
+        datapoints are sent to this many per second; 0 (default) for no limit.
+        Live data is never rate-limited.
+      - 'replayBytesPerSec' - (float) limit the rate at which cached data is
+        sent to this many bytes per second; 0 (default) for no limit.
+      - 'replayJitter' - (float) wait a random time up to this many seconds
+        before starting to send cached data, so that many hosts recovering
+        from the same outage don't all send at once. Default 10.
+
+    onewire - 1-Wire temperature sensor polling:
+
+      - 'bulkRead' - (boolean) on each poll, start a temperature conversion on
+        every sensor at once via the bus master's ``therm_bulk_read`` file
+        (Linux 5.10+), so that each poll takes about one conversion period
+        (750ms) per bus rather than one per sensor. Buses that don't support
+        it fall back to converting on each sensor read. Default True.
+      - 'hotplugInterval' - (int) watch /sys/bus/w1/devices/ in a background
+        thread for sensors being added or removed, and update the list of
+        sensors to poll accordingly. inotify is used where the filesystem
+        supports it (sysfs doesn't); otherwise the directory is checked every
+        this many seconds. 0 to disable. Default 5.
+      - 'reader' - (str) how to read sensors; "w1thermsensor" (default) to
+        use the w1thermsensor package, or "sysfs" to read each sensor's
+        w1_slave file directly, keeping it open between polls. The two
+        report identical values.
+      - 'rescanInterval' - (int) how often, in seconds, to rescan the bus for
+        added or removed sensors. The bus is also rescanned on the poll after
+        any sensor fails to read. 0 to rescan on every poll. Default 300.
+      - 'readThreads' - (int) number of sensors to read concurrently. Each
+        DS18B20 conversion takes up to 750ms, so with many sensors reading
+        them in parallel greatly shortens each poll. 1 (default) to read
+        them one at a time.
+      - 'sensorTimeout' - (float) when reading concurrently, give up on a
+        sensor that hasn't returned a reading within this many seconds of
+        its read starting. Also the longest time to wait for a bulk
+        conversion to complete. Default 10.
 
     send_wifi_metrics - (boolean) Whether or not to send WiFi metrics.
 
+    send_self_metrics - (boolean) Whether or not to send metrics about
+      pi2graphite itself (``pi2graphite.poll.*``, ``pi2graphite.loop.*``,
+      ``pi2graphite.process.*``, ``pi2graphite.graphite.*`` and
+      ``pi2graphite.cache.*``). Default True.
+
     sensor_names - dict of sensor address (directory under /sys/bus/w1/devices/)
       to meaningful name to use instead of address, in metric names.
 
@@ -122,8 +292,59 @@ class Config(object):
         if ('logging_level' in self._config and
                 self._config['logging_level'] not in levels):
             raise InvalidConfigError('logging_level must be one of %s' % levels)
+        protocols = ['plaintext', 'pickle']
+        if self._config.get('graphite', {}).get(
+                'protocol', 'plaintext') not in protocols:
+            raise InvalidConfigError(
+                'graphite protocol must be one of %s' % protocols)
+        self._validate_destinations()
+        threads = self._config.get('onewire', {}).get('readThreads', 1)
+        if not isinstance(threads, int) or threads < 1:
+            raise InvalidConfigError(
+                'onewire readThreads must be an integer of at least 1')
+        readers = ['w1thermsensor', 'sysfs']
+        if self._config.get('onewire', {}).get(
+                'reader', 'w1thermsensor') not in readers:
+            raise InvalidConfigError(
+                'onewire reader must be one of %s' % readers)
+        methods = ['avg', 'nth']
+        if self._config.get('cache', {}).get(
+                'downsampleMethod', 'avg') not in methods:
+            raise InvalidConfigError(
+                'cache downsampleMethod must be one of %s' % methods)
         logger.debug('Configuration validated.')
 
+    def _validate_destinations(self):
+        """
+        Validate the graphite destinations and fanout configuration.
+
+        :raises: InvalidConfigError
+        """
+        conf = self._config.get('graphite', {})
+        fanouts = ['replicate', 'shard']
+        if conf.get('fanout', 'replicate') not in fanouts:
+            raise InvalidConfigError(
+                'graphite fanout must be one of %s' % fanouts)
+        if not isinstance(conf.get('udpPatterns', []), list):
+            raise InvalidConfigError('graphite udpPatterns must be a list')
+        if 'destinations' not in conf:
+            return
+        dests = conf['destinations']
+        if not isinstance(dests, list) or len(dests) < 1:
+            raise InvalidConfigError(
+                'graphite destinations must be a non-empty list')
+        nodes = []
+        for d in dests:
+            if not isinstance(d, dict) or 'host' not in d:
+                raise InvalidConfigError(
+                    'each graphite destination must have a "host"')
+            nodes.append((d['host'], d.get('instance', None)))
+        if (conf.get('fanout', 'replicate') == 'shard' and
+                len(set(nodes)) != len(nodes)):
+            raise InvalidConfigError(
+                'graphite destinations must have unique (host, instance) '
+                'pairs when sharding')
+
     def get(self, key):
         """
         Get the value of the specified configuration key. Return None if the
@@ -175,12 +396,193 @@ class Config(object):
     @property
     def graphite_port(self):
         """
-        Return the Graphite plaintext port
+        Return the Graphite port; defaults to 2003 for the plaintext protocol
+        or 2004 for the pickle protocol.
 
         :return: Graphite port
         :rtype: int
         """
-        return self._config['graphite'].get('port', 2003)
+        default = 2004 if self.graphite_protocol == 'pickle' else 2003
+        return self._config['graphite'].get('port', default)
+
+    @property
+    def graphite_destinations(self):
+        """
+        Return the list of Graphite destinations to send to; dicts with
+        "host", "port" and "instance" keys. If no destinations are configured,
+        this is the single configured host and port.
+
+        :return: list of Graphite destination dicts
+        :rtype: list
+        """
+        if 'destinations' not in self._config['graphite']:
+            return [{
+                'host': self.graphite_host,
+                'port': self.graphite_port,
+                'instance': None
+            }]
+        return [
+            {
+                'host': d['host'],
+                'port': d.get('port', self.graphite_port),
+                'instance': d.get('instance', None)
+            }
+            for d in self._config['graphite']['destinations']
+        ]
+
+    @property
+    def graphite_fanout(self):
+        """
+        Return how to send data to multiple destinations, "replicate" or
+        "shard".
+
+        :return: graphite fanout method
+        :rtype: str
+        """
+        return self._config['graphite'].get('fanout', 'replicate')
+
+    @property
+    def graphite_udp_patterns(self):
+        """
+        Return the list of patterns of metric names to send over UDP.
+
+        :return: list of shell-style wildcard patterns
+        :rtype: list
+        """
+        return self._config['graphite'].get('udpPatterns', [])
+
+    @property
+    def graphite_udp_port(self):
+        """
+        Return the carbon UDP listener port.
+
+        :return: UDP port
+        :rtype: int
+        """
+        return self._config['graphite'].get('udpPort', 2003)
+
+    @property
+    def graphite_udp_max_datagram(self):
+        """
+        Return the maximum UDP datagram size in bytes.
+
+        :return: maximum UDP datagram size
+        :rtype: int
+        """
+        return self._config['graphite'].get('udpMaxDatagram', 1472)
+
+    @property
+    def graphite_queue_max_points(self):
+        """
+        Return the high-water mark of the in-memory send queue, in datapoints;
+        0 if the queue is disabled.
+
+        :return: send queue high-water mark
+        :rtype: int
+        """
+        return self._config['graphite'].get('queueMaxPoints', 10000)
+
+    @property
+    def graphite_queue_retry_delay(self):
+        """
+        Return the number of seconds to wait before retrying a failed send of
+        queued data.
+
+        :return: send queue retry delay
+        :rtype: float
+        """
+        return self._config['graphite'].get('queueRetryDelay', 1)
+
+    @property
+    def graphite_max_lines_per_write(self):
+        """
+        Return the maximum number of datapoints to send in each socket write.
+
+        :return: maximum datapoints per write
+        :rtype: int
+        """
+        return self._config['graphite'].get('maxLinesPerWrite', 1000)
+
+    @property
+    def graphite_max_bytes_per_write(self):
+        """
+        Return the maximum number of bytes to send in each socket write with the
+        plaintext protocol.
+
+        :return: maximum bytes per write
+        :rtype: int
+        """
+        return self._config['graphite'].get('maxBytesPerWrite', 65536)
+
+    @property
+    def graphite_connect_timeout(self):
+        """
+        Return the socket connect timeout in seconds.
+
+        :return: connect timeout
+        :rtype: float
+        """
+        return self._config['graphite'].get('connectTimeout', 10)
+
+    @property
+    def graphite_send_timeout(self):
+        """
+        Return the socket send timeout in seconds.
+
+        :return: send timeout
+        :rtype: float
+        """
+        return self._config['graphite'].get('sendTimeout', 30)
+
+    @property
+    def graphite_tcp_nodelay(self):
+        """
+        Return whether or not to set TCP_NODELAY on the Graphite socket.
+
+        :return: whether to set TCP_NODELAY
+        :rtype: bool
+        """
+        return self._config['graphite'].get('tcpNoDelay', False)
+
+    @property
+    def graphite_send_buffer_bytes(self):
+        """
+        Return the socket send buffer size in bytes; 0 for the OS default.
+
+        :return: socket send buffer size
+        :rtype: int
+        """
+        return self._config['graphite'].get('sendBufferBytes', 0)
+
+    @property
+    def graphite_dns_cache_ttl(self):
+        """
+        Return the number of seconds to cache Graphite host DNS lookups for.
+
+        :return: DNS cache TTL in seconds
+        :rtype: int
+        """
+        return self._config['graphite'].get('dnsCacheTtl', 300)
+
+    @property
+    def graphite_protocol(self):
+        """
+        Return the carbon protocol to send with, "plaintext" or "pickle".
+
+        :return: Graphite protocol name
+        :rtype: str
+        """
+        return self._config['graphite'].get('protocol', 'plaintext')
+
+    @property
+    def graphite_pickle_batch_size(self):
+        """
+        Return the maximum number of datapoints per pickle protocol frame.
+
+        :return: pickle batch size
+        :rtype: int
+        """
+        return self._config['graphite'].get('pickleBatchSize', 500)
 
     @property
     def metric_prefix(self):
@@ -195,6 +597,246 @@ class Config(object):
         hostname = node().replace('.', '_')
         return pfx.replace('%HOSTNAME%', hostname)
 
+    @property
+    def graphite_failure_threshold(self):
+        """
+        Return the number of consecutive failed sends after which to stop
+        trying to send and cache data immediately.
+
+        :return: consecutive failure threshold
+        :rtype: int
+        """
+        return self._config['graphite'].get('failureThreshold', 3)
+
+    @property
+    def graphite_retry_backoff(self):
+        """
+        Return the initial number of seconds to wait before retrying sends.
+
+        :return: initial retry backoff in seconds
+        :rtype: float
+        """
+        return self._config['graphite'].get('retryBackoff', 5)
+
+    @property
+    def graphite_retry_backoff_max(self):
+        """
+        Return the maximum number of seconds to wait before retrying sends.
+
+        :return: maximum retry backoff in seconds
+        :rtype: float
+        """
+        return self._config['graphite'].get('retryBackoffMax', 300)
+
+    @property
+    def cache_dir(self):
+        """
+        Return the directory to store the on-disk cache in.
+
+        :return: cache directory path
+        :rtype: str
+        """
+        return self._config.get('cache', {}).get(
+            'directory', '/var/lib/pi2graphite')
+
+    @property
+    def cache_segment_bytes(self):
+        """
+        Return the size in bytes at which to start a new cache segment.
+
+        :return: cache segment size in bytes
+        :rtype: int
+        """
+        return self._config.get('cache', {}).get('segmentBytes', 1048576)
+
+    @property
+    def cache_max_bytes(self):
+        """
+        Return the maximum total size of the cache in bytes, or 0 for no limit.
+
+        :return: maximum cache size in bytes
+        :rtype: int
+        """
+        return self._config.get('cache', {}).get('maxBytes', 104857600)
+
+    @property
+    def cache_max_age(self):
+        """
+        Return the maximum age of cache segments in seconds, or 0 for no limit.
+
+        :return: maximum cache segment age in seconds
+        :rtype: int
+        """
+        return self._config.get('cache', {}).get('maxAge', 0)
+
+    @property
+    def cache_downsample_at(self):
+        """
+        Return the fraction of the maximum cache size above which to start
+        thinning out old cached data.
+
+        :return: downsampling threshold as a fraction of maximum cache size
+        :rtype: float
+        """
+        return self._config.get('cache', {}).get('downsampleAt', 0.75)
+
+    @property
+    def cache_downsample_factor(self):
+        """
+        Return the factor to thin out old cached data by.
+
+        :return: downsampling factor
+        :rtype: int
+        """
+        return self._config.get('cache', {}).get('downsampleFactor', 2)
+
+    @property
+    def cache_downsample_method(self):
+        """
+        Return the method to thin out old cached data with, "avg" or "nth".
+
+        :return: downsampling method
+        :rtype: str
+        """
+        return self._config.get('cache', {}).get('downsampleMethod', 'avg')
+
+    @property
+    def cache_compress(self):
+        """
+        Return whether to write the cache in the compressed format.
+
+        :return: whether to compress the cache
+        :rtype: bool
+        """
+        return self._config.get('cache', {}).get('compress', True)
+
+    @property
+    def cache_replay_chunk_lines(self):
+        """
+        Return the maximum number of lines per cache replay chunk.
+
+        :return: maximum lines per replay chunk
+        :rtype: int
+        """
+        return self._config.get('cache', {}).get('replayChunkLines', 1000)
+
+    @property
+    def cache_replay_chunk_bytes(self):
+        """
+        Return the maximum number of bytes per cache replay chunk.
+
+        :return: maximum bytes per replay chunk
+        :rtype: int
+        """
+        return self._config.get('cache', {}).get('replayChunkBytes', 65536)
+
+    @property
+    def cache_replay_chunk_delay(self):
+        """
+        Return the number of seconds to pause between cache replay chunks.
+
+        :return: seconds to pause between replay chunks
+        :rtype: float
+        """
+        return self._config.get('cache', {}).get('replayChunkDelay', 0.1)
+
+    @property
+    def cache_replay_points_per_sec(self):
+        """
+        Return the maximum rate at which to send cached datapoints, or 0 for
+        no limit.
+
+        :return: maximum cached datapoints per second
+        :rtype: float
+        """
+        return self._config.get('cache', {}).get('replayPointsPerSec', 0)
+
+    @property
+    def cache_replay_bytes_per_sec(self):
+        """
+        Return the maximum rate at which to send cached data in bytes per
+        second, or 0 for no limit.
+
+        :return: maximum cached bytes per second
+        :rtype: float
+        """
+        return self._config.get('cache', {}).get('replayBytesPerSec', 0)
+
+    @property
+    def cache_replay_jitter(self):
+        """
+        Return the maximum random delay in seconds before sending cached data.
+
+        :return: maximum replay start delay in seconds
+        :rtype: float
+        """
+        return self._config.get('cache', {}).get('replayJitter', 10)
+
+    @property
+    def onewire_bulk_read(self):
+        """
+        Return whether or not to trigger a bulk temperature conversion on
+        each 1-Wire bus before reading sensors.
+
+        :return: whether or not to use bulk conversion
+        :rtype: bool
+        """
+        return self._config.get('onewire', {}).get('bulkRead', True)
+
+    @property
+    def onewire_hotplug_interval(self):
+        """
+        Return the number of seconds between checks for 1-Wire sensors being
+        added or removed, when they can't be watched with inotify; 0 to not
+        watch for them at all.
+
+        :return: hotplug check interval in seconds
+        :rtype: int
+        """
+        return self._config.get('onewire', {}).get('hotplugInterval', 5)
+
+    @property
+    def onewire_read_threads(self):
+        """
+        Return the number of 1-Wire sensors to read concurrently.
+
+        :return: number of sensor read threads
+        :rtype: int
+        """
+        return self._config.get('onewire', {}).get('readThreads', 1)
+
+    @property
+    def onewire_reader(self):
+        """
+        Return how to read 1-Wire sensors; "w1thermsensor" or "sysfs".
+
+        :return: 1-Wire sensor reader
+        :rtype: str
+        """
+        return self._config.get('onewire', {}).get('reader', 'w1thermsensor')
+
+    @property
+    def onewire_rescan_interval(self):
+        """
+        Return the number of seconds between rescans of the 1-Wire bus for
+        added or removed sensors.
+
+        :return: bus rescan interval in seconds
+        :rtype: int
+        """
+        return self._config.get('onewire', {}).get('rescanInterval', 300)
+
+    @property
+    def onewire_sensor_timeout(self):
+        """
+        Return the number of seconds to wait for each 1-Wire sensor reading
+        when reading concurrently.
+
+        :return: per-sensor read timeout in seconds
+        :rtype: float
+        """
+        return self._config.get('onewire', {}).get('sensorTimeout', 10)
+
     @property
     def send_wifi_metrics(self):
         """
@@ -205,6 +847,16 @@ class Config(object):
         """
         return self._config.get('send_wifi_metrics', True)
 
+    @property
+    def send_self_metrics(self):
+        """
+        Return whether or not to send metrics about pi2graphite itself.
+
+        :return: whether or not to send self-metrics
+        :rtype: bool
+        """
+        return self._config.get('send_self_metrics', True)
+
     @property
     def polling_interval(self):
         """
@@ -0,0 +1,336 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#: struct inotify_event header; wd, mask, cookie, len (of name)
+EVENT_HEADER = struct.Struct('iIII')
+
+#: filesystems that accept inotify watches but never generate events for
+#: entries the kernel itself creates or removes, such as devices appearing
+#: under /sys/bus/w1/devices
+NO_EVENTS_FS = ('sysfs', 'proc', 'devpts', 'debugfs', 'configfs')
+
+
+def _libc():
+    """
+    Return the C library, if it provides the inotify functions.
+
+    :return: the C library, or None if inotify is not available
+    :rtype: ``ctypes.CDLL``
+    """
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+    ]
+    return libc
+
+
+def fs_type(path, mounts='/proc/mounts'):
+    """
+    Return the type of the filesystem that ``path`` is on, according to
+    ``/proc/mounts``.
+
+    :param path: path to find the filesystem type of
+    :type path: str
+    :param mounts: path to the mount table
+    :type mounts: str
+    :return: filesystem type, or None if it can't be determined
+    :rtype: str
+    """
+    path = os.path.realpath(path)
+    best = None
+    try:
+        with open(mounts, 'r') as fh:
+            for line in fh:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                # spaces etc. in mount points are octal-escaped
+                mnt = parts[1].replace('\\040', ' ')
+                if path != mnt and not path.startswith(
+                        mnt.rstrip('/') + '/'):
+                    continue
+                if best is None or len(mnt) >= len(best[0]):
+                    best = (mnt, parts[2])
+    except (IOError, OSError):
+        return None
+    if best is None:
+        return None
+    return best[1]
+
+
+class DirectoryWatcher(object):
+    """
+    Watch a directory for entries being added or removed, and call
+    ``callback(added, removed)`` with the sets of entry names that changed,
+    from a background thread.
+
+    Uses inotify (through ctypes, so Linux only) to relist the directory as
+    soon as something in it changes. Where inotify isn't available, or the
+    directory is on a filesystem that doesn't generate inotify events for
+    changes made by the kernel (i.e. sysfs), it falls back to relisting the
+    directory every ``interval`` seconds.
+    """
+
+    def __init__(self, path, callback, interval=5):
+        """
+        :param path: directory to watch
+        :type path: str
+        :param callback: callable taking two sets of entry names, those
+          added and those removed since the last call
+        :type callback: callable
+        :param interval: seconds between listings of the directory when
+          falling back to polling
+        :type interval: float
+        """
+        self._path = path
+        self._callback = callback
+        self._interval = interval
+        self._entries = self._list()
+        self._fd = None
+        # written to by stop(), to wake the thread up from select(); only
+        # opened by start(), so that nothing leaks if it's never called
+        self._wake_r = None
+        self._wake_w = None
+        self._stop = threading.Event()
+        self._thread = None
+        #: ``inotify`` or ``poll``, once started
+        self.mode = None
+
+    def start(self):
+        """
+        Start watching the directory in a background thread.
+        """
+        self._wake_r, self._wake_w = os.pipe()
+        try:
+            self._fd = self._inotify_watch()
+            self.mode = 'poll' if self._fd is None else 'inotify'
+            logger.debug('Watching %s for changes (mode=%s)', self._path,
+                         self.mode)
+            self._thread = threading.Thread(
+                target=self._run, name='pi2graphite-dirwatch'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        except Exception:
+            self._thread = None
+            self._close()
+            self._close_wake()
+            raise
+
+    def stop(self):
+        """
+        Stop watching the directory, and wait for the background thread to
+        exit.
+        """
+        self._stop.set()
+        if self._wake_w is not None:
+            os.write(self._wake_w, b'x')
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+        self._close_wake()
+
+    def _inotify_watch(self):
+        """
+        Start an inotify watch on the directory.
+
+        :return: inotify file descriptor, or None if the directory can't be
+          watched with inotify
+        :rtype: int
+        """
+        fstype = fs_type(self._path)
+        if fstype in NO_EVENTS_FS:
+            logger.info('%s is on %s, which does not support inotify; '
+                        'checking it for changes every %s seconds',
+                        self._path, fstype, self._interval)
+            return None
+        libc = _libc()
+        if libc is None:
+            logger.info('inotify is not available; checking %s for changes '
+                        'every %s seconds', self._path, self._interval)
+            return None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning('inotify_init1 failed (%s); checking %s for '
+                           'changes every %s seconds',
+                           os.strerror(ctypes.get_errno()), self._path,
+                           self._interval)
+            return None
+        path = self._path
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        mask = (
+            IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+        )
+        if libc.inotify_add_watch(fd, path, mask) < 0:
+            logger.warning('Unable to watch %s with inotify (%s); checking '
+                           'it for changes every %s seconds', self._path,
+                           os.strerror(ctypes.get_errno()), self._interval)
+            os.close(fd)
+            return None
+        return fd
+
+    def _close(self):
+        """
+        Close the inotify file descriptor, if open.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _close_wake(self):
+        """
+        Close the pipe used to wake up the background thread, if open.
+        """
+        if self._wake_w is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+
+    def _run(self):
+        """
+        Background thread; relist the directory whenever inotify says it has
+        changed, or every ``interval`` seconds when polling.
+        """
+        while not self._stop.is_set():
+            if self._fd is None:
+                self._stop.wait(self._interval)
+            elif not self._read_events():
+                continue
+            if not self._stop.is_set():
+                self._check()
+        logger.debug('Stopped watching %s', self._path)
+
+    def _read_events(self):
+        """
+        Wait for inotify events, or to be woken up by :py:meth:`~.stop`, and
+        consume any events. If the watch is removed (i.e. the directory was
+        deleted), close it and fall back to polling.
+
+        :return: whether any events were read
+        :rtype: bool
+        """
+        r, _, _ = select.select([self._fd, self._wake_r], [], [])
+        if self._fd not in r:
+            return False
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            _, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.debug('inotify event queue overflowed for %s',
+                             self._path)
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                logger.warning('%s was removed or moved; checking it for '
+                               'changes every %s seconds', self._path,
+                               self._interval)
+                self._close()
+                self.mode = 'poll'
+                break
+        # we relist the directory rather than apply each event, so that
+        # nothing is missed if the event queue overflows
+        return True
+
+    def _list(self):
+        """
+        Return the entries in the directory.
+
+        :return: entry names, or an empty set if the directory can't be read
+        :rtype: set
+        """
+        try:
+            return set(os.listdir(self._path))
+        except OSError:
+            return set()
+
+    def _check(self):
+        """
+        Relist the directory, and call the callback if anything changed.
+        """
+        entries = self._list()
+        added = entries - self._entries
+        removed = self._entries - entries
+        if not added and not removed:
+            return
+        self._entries = entries
+        logger.debug('Entries in %s changed; added=%s removed=%s',
+                     self._path, sorted(added), sorted(removed))
+        try:
+            self._callback(added, removed)
+        except Exception:
+            logger.error('Error handling changes to %s', self._path,
+                         exc_info=True)
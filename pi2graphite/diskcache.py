@@ -0,0 +1,938 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+
+import logging
+import os
+import re
+import time
+import struct
+import zlib
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentEncoder(object):
+    """
+    Encoder for the compressed cache segment format. Each metric name is
+    written to the segment only once, the first time it is seen, and
+    assigned the next integer id; each datapoint is then written as
+    ``<id> <value> <timestamp delta from the previous datapoint>``. The
+    result is compressed with a single zlib stream per segment, sync-flushed
+    at the end of each frame so that every complete frame can be decoded,
+    and written as length-prefixed frames.
+    """
+
+    def __init__(self):
+        self._zlib = zlib.compressobj()
+        self._names = {}
+        self._last_ts = 0
+
+    def encode(self, data):
+        """
+        Encode plaintext protocol data as a frame.
+
+        :param data: newline-separated plaintext protocol data
+        :type data: bytes
+        :return: length-prefixed compressed frame
+        :rtype: bytes
+        """
+        out = []
+        for line in data.splitlines():
+            parts = line.split()
+            if len(parts) == 0:
+                continue
+            try:
+                if len(parts) != 3:
+                    raise ValueError()
+                ts = int(parts[2])
+            except ValueError:
+                # not a datapoint we understand; store it verbatim
+                out.append(b'!' + line)
+                continue
+            if parts[0] not in self._names:
+                self._names[parts[0]] = len(self._names)
+                out.append(b'=' + parts[0])
+            out.append(b'%d %s %d' % (
+                self._names[parts[0]], parts[1], ts - self._last_ts
+            ))
+            self._last_ts = ts
+        if len(out) == 0:
+            return b''
+        payload = self._zlib.compress(b'\n'.join(out) + b'\n') + \
+            self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        return struct.pack('!I', len(payload)) + payload
+
+
+class SegmentDecoder(object):
+    """
+    Decoder for frames written by :py:class:`~.SegmentEncoder`. Frames must
+    be decoded in order, starting from the beginning of the segment.
+    """
+
+    def __init__(self):
+        self._zlib = zlib.decompressobj()
+        self._names = []
+        self._last_ts = 0
+
+    def decode(self, payload):
+        """
+        Decode one frame's payload (without its length prefix) back to
+        plaintext protocol data.
+
+        :param payload: compressed frame payload
+        :type payload: bytes
+        :return: newline-terminated plaintext protocol data
+        :rtype: bytes
+        """
+        out = []
+        for line in self._zlib.decompress(payload).splitlines():
+            if line[:1] == b'=':
+                self._names.append(line[1:])
+            elif line[:1] == b'!':
+                out.append(line[1:] + b'\n')
+            elif len(line) > 0:
+                idx, value, delta = line.split()
+                self._last_ts += int(delta)
+                out.append(b'%s %s %d\n' % (
+                    self._names[int(idx)], value, self._last_ts
+                ))
+        return b''.join(out)
+
+
+class ChunkReader(object):
+    """
+    Iterator over the chunks of a cache segment, returned by
+    :py:meth:`~.DiskCache.read_chunks`. The segment is protected from
+    downsampling and eviction until the iterator is exhausted or closed.
+    """
+
+    def __init__(self, cache, seg, progress, chunks):
+        """
+        :param cache: the cache the segment is in
+        :type cache: :py:class:`~.DiskCache`
+        :param seg: segment number
+        :type seg: int
+        :param progress: the segment's progress when reading started; see
+          :py:meth:`~.DiskCache.progress`
+        :type progress: tuple
+        :param chunks: generator of chunks
+        :type chunks: ``generator``
+        """
+        self._cache = cache
+        self._seg = seg
+        self._chunks = chunks
+        #: 2-tuple of (committed offset, lines sent after it) when reading
+        #: started
+        self.progress = progress
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except Exception:
+            self.close()
+            raise
+
+    next = __next__
+
+    def close(self):
+        """
+        Stop reading, and release the segment.
+        """
+        self._chunks.close()
+        self._cache._reading.discard(self._seg)
+
+
+class DiskCache(object):
+    """
+    Segmented, append-only on-disk log of plaintext-protocol Graphite data
+    that could not be sent. Data is appended to the newest segment file
+    until it reaches ``segment_bytes``, at which point a new segment is
+    started. Each segment has a checkpoint file recording the offset up to
+    which its data has been successfully sent, so that replay resumes
+    exactly where it stopped. Fully-sent segments are removed.
+
+    Replay is done in batches, each identified by the segment number and
+    offset it starts at. If a batch is only partly sent, the checkpoint also
+    records a progress marker; the number of lines after the batch's offset
+    that were sent. Those lines are skipped when the segment is next read, so
+    that only the unsent tail of the batch is replayed.
+
+    By default segments are written in a compressed format (see
+    :py:class:`~.SegmentEncoder`) that is several times smaller than the
+    plaintext protocol, to reduce writes to flash storage. Segments in either
+    format are read back as plaintext protocol data.
+
+    The cache can be bounded in total size and in age. Once its size passes
+    ``downsample_at`` (a fraction of ``max_bytes``), the oldest segments are
+    thinned out one at a time by ``downsample_factor``, either keeping every
+    Nth point of each metric or replacing each run of N points with their
+    average. If the cache is still larger than ``max_bytes``, the oldest
+    segments are evicted entirely; segments last written to more than
+    ``max_age`` seconds ago are always evicted.
+
+    The directory is only scanned once, at startup; from then on segments
+    are tracked in an in-memory index, which orders them chronologically by
+    their earliest datapoint for replay.
+    """
+
+    #: regex matching segment file names
+    _segment_re = re.compile(r'^(\d+)\.seg$')
+
+    #: regex matching legacy one-file-per-failure cache file names
+    _legacy_re = re.compile(r'^(\d+)\.json$')
+
+    #: header identifying a compressed segment
+    _magic = b'pi2graphite-z1\n'
+
+    #: maximum number of datapoints to encode in one compressed frame
+    _frame_lines = 1000
+
+    #: exceptions raised when reading a damaged segment
+    _decode_errors = (zlib.error, ValueError, IndexError)
+
+    def __init__(self, directory='/var/lib/pi2graphite',
+                 segment_bytes=1048576, max_bytes=0, max_age=0,
+                 downsample_at=0.75, downsample_factor=2,
+                 downsample_method='avg', compress=True):
+        """
+        Initialize DiskCache, creating the cache directory if needed and
+        importing any legacy cache files found in it.
+
+        :param directory: directory to store cache segments in
+        :type directory: str
+        :param segment_bytes: size in bytes at which to start a new segment
+        :type segment_bytes: int
+        :param max_bytes: maximum total size of the cache in bytes; 0 for
+          unlimited
+        :type max_bytes: int
+        :param max_age: evict segments last written to more than this many
+          seconds ago; 0 for unlimited
+        :type max_age: int
+        :param downsample_at: fraction of ``max_bytes`` above which to start
+          thinning out the oldest segments
+        :type downsample_at: float
+        :param downsample_factor: factor to thin out segments by; 1 to
+          disable downsampling
+        :type downsample_factor: int
+        :param downsample_method: "avg" to replace each run of
+          ``downsample_factor`` points of a metric with their average, or
+          "nth" to keep every ``downsample_factor``-th point
+        :type downsample_method: str
+        :param compress: whether to write new segments in the compressed
+          format rather than as plaintext
+        :type compress: bool
+        """
+        self._dir = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._downsample_at = downsample_at
+        self._downsample_factor = downsample_factor
+        self._downsample_method = downsample_method
+        self._compress = compress
+        self._encoder = None
+        # segments currently being streamed by read_chunks(), which must not
+        # be rewritten or evicted out from under the reader
+        self._reading = set()
+        # damaged segments; segment number to the offset of the end of the
+        # last data before the damage, at which the segment is treated as
+        # ending
+        self._damaged = {}
+        #: number of unsent datapoints evicted or thinned out of the cache
+        self.evicted_points = 0
+        self._active = None
+        self._active_fh = None
+        # highest segment number used by this process, so that numbers are
+        # never re-used even once all segments have been sent and removed
+        self._last_seg = 0
+        if not os.path.exists(self._dir):
+            logger.info('Creating cache directory at: %s', self._dir)
+            os.makedirs(self._dir)
+        # in-memory index of segments; segment number to a dict with keys
+        # "size", "mtime", "first_ts", "points" and "downsampled"
+        self._index = {}
+        self._scan()
+        self._import_legacy()
+        self._enforce_limits()
+
+    @classmethod
+    def has_data(cls, directory):
+        """
+        Return whether a directory contains any cache segments or legacy
+        cache files, without creating or scanning a cache in it.
+
+        :param directory: directory to check
+        :type directory: str
+        :rtype: bool
+        """
+        try:
+            files = os.listdir(directory)
+        except OSError:
+            return False
+        return any(
+            cls._segment_re.match(f) or cls._legacy_re.match(f)
+            for f in files
+        )
+
+    def _path(self, seg, suffix='seg'):
+        """
+        Return the path to a segment or one of its companion files.
+
+        :param seg: segment number
+        :type seg: int
+        :param suffix: file suffix
+        :type suffix: str
+        :return: absolute path to the file
+        :rtype: str
+        """
+        return os.path.join(self._dir, '%012d.%s' % (seg, suffix))
+
+    def _import_legacy(self):
+        """
+        Append the contents of any cache files written by older versions
+        (one ``<timestamp>.json`` file per failed send) to the log, oldest
+        first, and remove them.
+        """
+        legacy = sorted(
+            (int(m.group(1)), f) for f in os.listdir(self._dir)
+            for m in [self._legacy_re.match(f)] if m is not None
+        )
+        for _, fname in legacy:
+            fpath = os.path.join(self._dir, fname)
+            logger.info('Importing legacy cache file: %s', fpath)
+            with open(fpath, 'r') as fh:
+                self.append(fh.read())
+            os.unlink(fpath)
+
+    @staticmethod
+    def _min_timestamp(data):
+        """
+        Return the earliest timestamp in plaintext protocol data.
+
+        :param data: newline-separated plaintext protocol data
+        :type data: ``str`` or ``bytes``
+        :return: earliest timestamp, or None if there are no valid datapoints
+        :rtype: int
+        """
+        res = None
+        for line in data.splitlines():
+            try:
+                ts = int(line.split()[2])
+            except (IndexError, ValueError):
+                continue
+            if res is None or ts < res:
+                res = ts
+        return res
+
+    def _update_first_ts(self, seg, data):
+        """
+        Update a segment's earliest timestamp in the index with the earliest
+        timestamp in ``data``.
+
+        :param seg: segment number
+        :type seg: int
+        :param data: plaintext protocol data
+        :type data: ``str`` or ``bytes``
+        """
+        ts = self._min_timestamp(data)
+        entry = self._index[seg]
+        if ts is not None and (entry['first_ts'] is None or
+                               ts < entry['first_ts']):
+            entry['first_ts'] = ts
+
+    def _scan(self):
+        """
+        Build the in-memory index from the segments on disk.
+        """
+        for f in os.listdir(self._dir):
+            m = self._segment_re.match(f)
+            if m is None:
+                continue
+            seg = int(m.group(1))
+            self._index[seg] = {
+                'size': os.path.getsize(self._path(seg)),
+                'mtime': os.path.getmtime(self._path(seg)),
+                'first_ts': None,
+                'points': 0,
+                'downsampled': os.path.exists(self._path(seg, 'ds'))
+            }
+            try:
+                for data, _ in self.read_chunks(
+                    seg, max_lines=10000, max_bytes=1048576
+                ):
+                    self._index[seg]['points'] += data.count('\n')
+                    self._update_first_ts(seg, data)
+            except self._decode_errors:
+                logger.error('Unable to read cache segment %s',
+                             self._path(seg), exc_info=True)
+                self._quarantine(seg)
+        if len(self._index) > 0:
+            logger.info('Found %d cache segments with %d unsent datapoints',
+                        len(self._index), self.depth()[2])
+
+    def segments(self):
+        """
+        Return the list of segment numbers currently in the cache, in
+        chronological order of their earliest datapoint.
+
+        :return: segment numbers, oldest first
+        :rtype: ``list``
+        """
+        return sorted(
+            self._index,
+            key=lambda seg: (self._index[seg]['first_ts'] or 0, seg)
+        )
+
+    def _open_active(self):
+        """
+        Open the segment to append to; a new one, unless this is the first
+        append since startup, we're writing plaintext and the newest segment
+        on disk is a plaintext segment that is not yet full.
+        """
+        newest = max(self._index) if len(self._index) > 0 else 0
+        if newest > 0 and self._last_seg == 0 and not self._compress and \
+                self._index[newest]['size'] < self._segment_bytes and \
+                not self._index[newest]['downsampled'] and \
+                not self._is_compressed(newest):
+            self._active = newest
+        else:
+            self._active = max(newest, self._last_seg) + 1
+            logger.debug('Starting new cache segment: %s',
+                         self._path(self._active))
+            self._index[self._active] = {
+                'size': 0,
+                'mtime': time.time(),
+                'first_ts': None,
+                'points': 0,
+                'downsampled': False
+            }
+        self._last_seg = max(self._last_seg, self._active)
+        self._active_fh = open(self._path(self._active), 'ab')
+        self._encoder = None
+        if self._compress:
+            self._encoder = SegmentEncoder()
+            self._active_fh.write(self._magic)
+
+    def _is_compressed(self, seg):
+        """
+        Return whether a segment is in the compressed format.
+
+        :param seg: segment number
+        :type seg: int
+        :rtype: bool
+        """
+        with open(self._path(seg), 'rb') as fh:
+            return fh.read(len(self._magic)) == self._magic
+
+    def _write(self, fh, encoder, data):
+        """
+        Write plaintext protocol data to a segment file, encoded as frames of
+        at most ``_frame_lines`` lines if ``encoder`` is not None.
+
+        :param fh: open segment file
+        :type fh: file
+        :param encoder: encoder for the segment, or None if it is plaintext
+        :type encoder: :py:class:`~.SegmentEncoder`
+        :param data: newline-separated plaintext protocol data
+        :type data: bytes
+        """
+        if encoder is None:
+            fh.write(data)
+            return
+        lines = data.splitlines(True)
+        for i in range(0, len(lines), self._frame_lines):
+            fh.write(encoder.encode(b''.join(lines[i:i + self._frame_lines])))
+
+    def _close_active(self):
+        """
+        Close the segment currently being appended to, if any.
+        """
+        if self._active_fh is not None:
+            self._active_fh.close()
+        self._active = None
+        self._active_fh = None
+        self._encoder = None
+
+    def append(self, data_str):
+        """
+        Append newline-terminated plaintext protocol data to the log.
+
+        :param data_str: data to append
+        :type data_str: str
+        """
+        if not isinstance(data_str, bytes):
+            data_str = data_str.encode('utf-8')
+        if self._active_fh is None:
+            self._open_active()
+        logger.warning('Caching un-sendable data in: %s',
+                       self._path(self._active))
+        self._write(self._active_fh, self._encoder, data_str)
+        self._active_fh.flush()
+        entry = self._index[self._active]
+        entry['size'] = self._active_fh.tell()
+        entry['mtime'] = time.time()
+        entry['points'] += data_str.count(b'\n')
+        self._update_first_ts(self._active, data_str)
+        if entry['size'] >= self._segment_bytes:
+            self._close_active()
+        self._enforce_limits()
+
+    def depth(self):
+        """
+        Return the current depth of the cache.
+
+        :return: 3-tuple of (number of segments, total size in bytes, number
+          of unsent datapoints)
+        :rtype: tuple
+        """
+        return (
+            len(self._index),
+            sum(e['size'] for e in self._index.values()),
+            sum(e['points'] for e in self._index.values())
+        )
+
+    def _enforce_limits(self):
+        """
+        Apply the age and size limits to the cache; evict segments older than
+        ``max_age``, then thin out and finally evict the oldest segments until
+        the cache is within ``max_bytes``. The active segment, and any
+        segment currently being read, are left alone.
+        """
+        segs = [
+            s for s in self.segments()
+            if s != self._active and s not in self._reading
+        ]
+        if self._max_age > 0:
+            cutoff = time.time() - self._max_age
+            for seg in list(segs):
+                if self._index[seg]['mtime'] < cutoff:
+                    logger.warning('Evicting cache segment %s; older than '
+                                   '%s seconds', self._path(seg),
+                                   self._max_age)
+                    self._evict(seg)
+                    segs.remove(seg)
+        if self._max_bytes <= 0:
+            return
+        total = self.depth()[1]
+        threshold = self._max_bytes * self._downsample_at
+        if total > threshold and self._downsample_factor > 1:
+            for seg in segs:
+                if total <= threshold:
+                    break
+                if self._index[seg]['downsampled']:
+                    continue
+                before = self._index[seg]['size']
+                self._downsample(seg)
+                total -= before - self._index[seg]['size']
+        while total > self._max_bytes and len(segs) > 0:
+            seg = segs.pop(0)
+            logger.warning('Cache is larger than %d bytes; evicting oldest '
+                           'segment %s', self._max_bytes, self._path(seg))
+            total -= self._index[seg]['size']
+            self._evict(seg)
+
+    def _evict(self, seg):
+        """
+        Remove a segment and its unsent data from the cache.
+
+        :param seg: segment number
+        :type seg: int
+        """
+        self.evicted_points += self._index[seg]['points']
+        self._remove(seg)
+
+    def _downsample(self, seg):
+        """
+        Rewrite the unsent data in a segment, thinned out by
+        ``downsample_factor`` per metric, and mark it as downsampled.
+
+        :param seg: segment number
+        :type seg: int
+        """
+        n = self._downsample_factor
+        series = defaultdict(list)
+        other = []
+        for data, _ in self.read_chunks(seg, max_bytes=1048576):
+            for line in data.splitlines():
+                parts = line.split()
+                try:
+                    series[parts[0]].append((int(parts[2]), float(parts[1])))
+                except (IndexError, ValueError):
+                    other.append(line)
+        if seg not in self._index:
+            # quarantined while reading
+            return
+        # only the data before any damage is kept
+        self._damaged.pop(seg, None)
+        before = len(other) + sum(len(v) for v in series.values())
+        points = []
+        for name, vals in series.items():
+            if self._downsample_method == 'nth':
+                points.extend(
+                    (v[0], name, v[1]) for v in vals[::n]
+                )
+                continue
+            for i in range(0, len(vals), n):
+                window = vals[i:i + n]
+                points.append((
+                    window[0][0], name,
+                    sum(v[1] for v in window) / len(window)
+                ))
+        lines = other + [
+            '%s %s %d' % (p[1], p[2], p[0]) for p in sorted(points)
+        ]
+        logger.warning('Downsampling cache segment %s from %d to %d points',
+                       self._path(seg), before, len(lines))
+        tmp = self._path(seg, 'seg.tmp')
+        with open(tmp, 'wb') as fh:
+            encoder = None
+            if self._compress:
+                encoder = SegmentEncoder()
+                fh.write(self._magic)
+            if len(lines) > 0:
+                self._write(
+                    fh, encoder, ('\n'.join(lines) + '\n').encode('utf-8')
+                )
+        os.rename(tmp, self._path(seg))
+        if os.path.exists(self._path(seg, 'ckpt')):
+            os.unlink(self._path(seg, 'ckpt'))
+        with open(self._path(seg, 'ds'), 'w') as fh:
+            fh.write('%d\n' % n)
+        self._index[seg].update({
+            'size': os.path.getsize(self._path(seg)),
+            'first_ts': self._min_timestamp('\n'.join(lines)),
+            'points': len(lines),
+            'downsampled': True
+        })
+        self.evicted_points += before - len(lines)
+
+    def _remove(self, seg):
+        """
+        Remove a segment and its companion files.
+
+        :param seg: segment number
+        :type seg: int
+        """
+        if seg == self._active:
+            self._close_active()
+        self._index.pop(seg, None)
+        self._damaged.pop(seg, None)
+        os.unlink(self._path(seg))
+        for suffix in ['ckpt', 'ds']:
+            if os.path.exists(self._path(seg, suffix)):
+                os.unlink(self._path(seg, suffix))
+
+    def discard(self, seg):
+        """
+        Remove a segment and its companion files regardless of whether its
+        data has been sent, i.e. once its data has been moved elsewhere.
+
+        :param seg: segment number
+        :type seg: int
+        """
+        if seg in self._index:
+            self._remove(seg)
+
+    def _quarantine(self, seg):
+        """
+        Move a damaged segment aside, to ``<segment>.bad``, so that it is
+        kept for inspection but no longer read or replayed, and remove its
+        companion files.
+
+        :param seg: segment number
+        :type seg: int
+        """
+        logger.error('Cache segment %s is damaged; moving it to %s',
+                     self._path(seg), self._path(seg, 'bad'))
+        if seg == self._active:
+            self._close_active()
+        self._index.pop(seg, None)
+        self._damaged.pop(seg, None)
+        # never re-use the number, so the .bad file isn't overwritten
+        self._last_seg = max(self._last_seg, seg)
+        os.rename(self._path(seg), self._path(seg, 'bad'))
+        for suffix in ['ckpt', 'ds']:
+            if os.path.exists(self._path(seg, suffix)):
+                os.unlink(self._path(seg, suffix))
+
+    def committed(self, seg):
+        """
+        Return the committed (successfully sent) offset for a segment.
+
+        :param seg: segment number
+        :type seg: int
+        :return: committed offset in bytes
+        :rtype: int
+        """
+        return self.progress(seg)[0]
+
+    def progress(self, seg):
+        """
+        Return the replay progress of a segment; the committed offset, and
+        the number of lines after it that have also been sent.
+
+        :param seg: segment number
+        :type seg: int
+        :return: 2-tuple of (committed offset in bytes, lines sent after it)
+        :rtype: tuple
+        """
+        try:
+            with open(self._path(seg, 'ckpt'), 'r') as fh:
+                parts = [int(x) for x in fh.read().split()]
+        except (IOError, OSError, ValueError):
+            return 0, 0
+        if len(parts) == 1:
+            return parts[0], 0
+        if len(parts) != 2:
+            return 0, 0
+        return parts[0], parts[1]
+
+    def read_chunks(self, seg, max_lines=1000, max_bytes=65536):
+        """
+        Stream the complete lines of a segment after its committed offset,
+        as plaintext protocol data in chunks of at most ``max_lines`` lines
+        and ``max_bytes`` bytes. Compressed segments are read a frame at a
+        time, so chunks always end on a frame boundary; a single line or
+        frame larger than the limits is returned on its own. Lines already
+        sent according to the segment's progress marker are skipped. Only one
+        chunk is held in memory at a time.
+
+        Damaged data doesn't raise. Lines of plaintext segments that aren't
+        valid UTF-8 are logged and skipped. Reading a compressed segment
+        stops at the last good frame before a damaged one; once everything
+        before the damage has been committed, the segment is moved aside to
+        ``<segment>.bad`` (see :py:meth:`~.commit`), so that replay carries
+        on with the next segment.
+
+        The segment's progress is read, and the segment protected from
+        downsampling and eviction, before this returns; callers sharing the
+        cache between threads should call it under the same lock as
+        :py:meth:`~.append`, and use the returned reader's ``progress``
+        rather than calling :py:meth:`~.progress` separately.
+
+        :param seg: segment number
+        :type seg: int
+        :param max_lines: maximum number of lines per chunk
+        :type max_lines: int
+        :param max_bytes: maximum number of bytes per chunk
+        :type max_bytes: int
+        :return: iterator of 2-tuples of (chunk data, offset of the end of
+          the chunk)
+        :rtype: :py:class:`~.ChunkReader`
+        """
+        progress = self.progress(seg)
+        self._reading.add(seg)
+        return ChunkReader(
+            self, seg, progress,
+            self._chunks(seg, progress[0], progress[1], max_lines, max_bytes)
+        )
+
+    def _chunks(self, seg, offset, skip, max_lines, max_bytes):
+        """
+        Generator for :py:meth:`~.read_chunks`.
+
+        :param seg: segment number
+        :type seg: int
+        :param offset: committed offset to start reading at
+        :type offset: int
+        :param skip: number of lines after ``offset`` to skip
+        :type skip: int
+        :param max_lines: maximum number of lines per chunk
+        :type max_lines: int
+        :param max_bytes: maximum number of bytes per chunk
+        :type max_bytes: int
+        :return: generator of 2-tuples of (chunk data, offset of the end of
+          the chunk)
+        :rtype: ``generator``
+        """
+        damaged = False
+        yielded = False
+        with open(self._path(seg), 'rb') as fh:
+            if fh.read(len(self._magic)) == self._magic:
+                blocks = self._read_frames(fh, offset)
+            else:
+                fh.seek(offset)
+                blocks = self._read_lines(fh, offset)
+            chunk = []
+            lines = 0
+            size = 0
+            try:
+                for end, block in blocks:
+                    if skip > 0:
+                        block_lines = block.splitlines(True)
+                        block = b''.join(block_lines[skip:])
+                        skip = max(0, skip - len(block_lines))
+                        if len(block) == 0:
+                            offset = end
+                            continue
+                    n = block.count(b'\n')
+                    if len(chunk) > 0 and (
+                        lines + n > max_lines or
+                        size + len(block) > max_bytes
+                    ):
+                        yield b''.join(chunk).decode('utf-8'), offset
+                        yielded = True
+                        chunk = []
+                        lines = 0
+                        size = 0
+                    chunk.append(block)
+                    lines += n
+                    size += len(block)
+                    offset = end
+            except self._decode_errors:
+                logger.error('Unable to read cache segment %s after offset '
+                             '%d', self._path(seg), offset, exc_info=True)
+                # a compressed segment can't be read past a bad frame, as
+                # the decoder state depends on every frame before it; the
+                # segment is quarantined once the data before it is sent
+                self._damaged[seg] = offset
+                damaged = True
+            if len(chunk) > 0:
+                yield b''.join(chunk).decode('utf-8'), offset
+                yielded = True
+        if damaged and not yielded:
+            # everything before the damage has already been sent
+            self._quarantine(seg)
+
+    def _read_lines(self, fh, offset):
+        """
+        Read a plaintext segment line by line. Lines that aren't valid UTF-8
+        are logged and returned empty.
+
+        :param fh: segment file, positioned at ``offset``
+        :type fh: file
+        :param offset: current position in the file
+        :type offset: int
+        :return: generator of 2-tuples of (offset of the end of the line,
+          line)
+        :rtype: ``generator``
+        """
+        while True:
+            line = fh.readline()
+            # stop at EOF, or at a trailing partial line from an
+            # interrupted write
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            try:
+                line.decode('utf-8')
+            except UnicodeDecodeError:
+                # a damaged line can be skipped without losing the rest
+                logger.error('Skipping invalid line in cache segment %s '
+                             'ending at offset %d: %r', fh.name, offset, line)
+                line = b''
+            yield offset, line
+
+    def _read_frames(self, fh, offset):
+        """
+        Read and decode a compressed segment frame by frame. All frames are
+        decoded, to rebuild the decoder state, but only those after
+        ``offset`` are returned. A damaged frame raises one of
+        ``_decode_errors``.
+
+        :param fh: segment file, positioned after the header
+        :type fh: file
+        :param offset: offset of the first frame to return
+        :type offset: int
+        :return: generator of 2-tuples of (offset of the end of the frame,
+          decoded plaintext protocol data)
+        :rtype: ``generator``
+        """
+        decoder = SegmentDecoder()
+        while True:
+            header = fh.read(4)
+            if len(header) < 4:
+                return
+            length = struct.unpack('!I', header)[0]
+            payload = fh.read(length)
+            # stop at a trailing partial frame from an interrupted write
+            if len(payload) < length:
+                return
+            data = decoder.decode(payload)
+            # raises UnicodeDecodeError here rather than mid-chunk
+            data.decode('utf-8')
+            if fh.tell() > offset:
+                yield fh.tell(), data
+
+    def commit(self, seg, offset, points=0, lines=0):
+        """
+        Record that a segment's data up to ``offset`` has been sent, along
+        with the first ``lines`` lines after it. If that is all of the
+        segment's data, the segment is removed; if it is all of the data
+        before a damaged part of the segment, the segment is quarantined.
+
+        :param seg: segment number
+        :type seg: int
+        :param offset: offset in bytes up to which data has been sent
+        :type offset: int
+        :param points: number of datapoints sent since the last commit, for
+          tracking the depth of the cache
+        :type points: int
+        :param lines: number of lines after ``offset`` that have been sent
+        :type lines: int
+        """
+        self._index[seg]['points'] -= points
+        if seg in self._damaged and offset >= self._damaged[seg]:
+            # everything readable has been sent
+            self._quarantine(seg)
+            return
+        if offset >= self._index[seg]['size']:
+            logger.debug('Removing fully-sent cache segment: %s',
+                         self._path(seg))
+            self._remove(seg)
+            return
+        # fsync the new checkpoint before renaming it into place, so that
+        # data already sent isn't re-sent after a power loss
+        tmp = self._path(seg, 'ckpt.tmp')
+        with open(tmp, 'w') as fh:
+            if lines > 0:
+                fh.write('%d %d\n' % (offset, lines))
+            else:
+                fh.write('%d\n' % offset)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self._path(seg, 'ckpt'))
+
+    def close(self):
+        """
+        Close any open segment file.
+        """
+        self._close_active()
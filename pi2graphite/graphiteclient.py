@@ -36,116 +36,1801 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 """
 
 import logging
-import socket
 import os
+import socket
+import select
 import time
+import struct
+import threading
+import random
+import hashlib
+import bisect
+from collections import deque
+import re
+import fnmatch
+from multiprocessing.pool import ThreadPool
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from pi2graphite.diskcache import DiskCache
 
 logger = logging.getLogger(__name__)
 
 
-class CachingGraphiteClient(object):
+class ResolverCache(object):
     """
-    Graphite client that caches data locally and sends when connection
-    resumes.
+    Cache of DNS lookups (:py:func:`socket.getaddrinfo` results), each kept
+    for ``ttl`` seconds. If a lookup fails, the last successful result for
+    the same host and port is used instead (and kept for another ``ttl``
+    seconds before trying again), however old it is.
     """
 
-    def __init__(self, host, port=2003, metric_prefix=''):
+    def __init__(self, ttl=300):
         """
-        Initialize CachingGraphiteClient.
+        Initialize ResolverCache.
+
+        :param ttl: number of seconds to cache each lookup for
+        :type ttl: float
+        """
+        self._ttl = ttl
+        # (host, port, socktype) to (expiry time, getaddrinfo result)
+        self._cache = {}
+        #: number of DNS lookups made
+        self.lookups = 0
+        #: number of DNS lookups that failed
+        self.failures = 0
+        #: total wall-clock seconds spent on DNS lookups
+        self.resolve_time = 0.0
+
+    def resolve(self, host, port, socktype=socket.SOCK_STREAM):
+        """
+        Resolve a host and port to a list of addresses.
+
+        :param host: host name or IP
+        :type host: str
+        :param port: port number
+        :type port: int
+        :param socktype: socket type, :py:data:`socket.SOCK_STREAM` or
+          :py:data:`socket.SOCK_DGRAM`
+        :type socktype: int
+        :return: list of :py:func:`socket.getaddrinfo` 5-tuples
+        :rtype: ``list``
+        :raises: :py:exc:`socket.gaierror` if the lookup fails and there is
+          no previous result to fall back to
+        """
+        key = (host, port, socktype)
+        cached = self._cache.get(key)
+        if cached is not None and time.time() < cached[0]:
+            return cached[1]
+        self.lookups += 1
+        start = time.time()
+        try:
+            res = socket.getaddrinfo(host, port, 0, socktype)
+        except Exception:
+            self.failures += 1
+            if cached is None:
+                raise
+            logger.warning('Unable to resolve %s; using last known address',
+                           host, exc_info=True)
+            res = cached[1]
+        finally:
+            self.resolve_time += time.time() - start
+        self._cache[key] = (time.time() + self._ttl, res)
+        return res
+
+    def expire(self, host, port, socktype=socket.SOCK_STREAM):
+        """
+        Expire the cached lookup for a host and port, so that it is
+        re-resolved next time; i.e. if none of its addresses are reachable.
+        The expired result is still kept to fall back to.
+
+        :param host: host name or IP
+        :type host: str
+        :param port: port number
+        :type port: int
+        :param socktype: socket type
+        :type socktype: int
+        """
+        key = (host, port, socktype)
+        if key in self._cache:
+            self._cache[key] = (0, self._cache[key][1])
+
+
+class GraphiteConnection(object):
+    """
+    Long-lived TCP connection to a Graphite (carbon) listener. The socket is
+    kept open and re-used across sends, and is transparently re-opened when
+    the peer has closed it or a send on it fails.
+
+    A peer that disappears without closing the connection (powered off, or
+    a NAT or firewall entry dropped) can't be seen from our side until TCP
+    gives up retransmitting, which by default takes around 15 minutes;
+    meanwhile sends succeed into the kernel's buffer and are lost. Where the
+    platform supports them, TCP keepalives are enabled to find such
+    connections while idle, and ``TCP_USER_TIMEOUT`` drops the connection
+    once sent data has gone unacknowledged for the send timeout.
+    """
+
+    #: seconds a connection is idle before sending keepalive probes
+    KEEPALIVE_IDLE = 30
+    #: seconds between keepalive probes
+    KEEPALIVE_INTERVAL = 10
+    #: number of unanswered keepalive probes before the connection is dropped
+    KEEPALIVE_COUNT = 3
+
+    def __init__(self, host, port, timeout=10, send_timeout=None,
+                 nodelay=False, sndbuf=0, resolver=None):
+        """
+        Initialize GraphiteConnection. The connection itself is not opened
+        until the first call to :py:meth:`~.send`.
 
         :param host: graphite host name or IP
         :type host: str
-        :param port: graphite plaintext port
+        :param port: graphite port
         :type port: int
+        :param timeout: socket connect timeout in seconds
+        :type timeout: float
+        :param send_timeout: socket send timeout in seconds; if None, the same
+          as ``timeout``
+        :type send_timeout: float
+        :param nodelay: whether to set ``TCP_NODELAY`` on the socket
+        :type nodelay: bool
+        :param sndbuf: socket send buffer size (``SO_SNDBUF``) in bytes; 0 for
+          the OS default
+        :type sndbuf: int
+        :param resolver: DNS cache to resolve ``host`` with; if None, a new
+          one with the default TTL
+        :type resolver: :py:class:`~.ResolverCache`
+        """
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._send_timeout = send_timeout
+        self._nodelay = nodelay
+        self._sndbuf = sndbuf
+        self._resolver = resolver
+        if resolver is None:
+            self._resolver = ResolverCache()
+        self._sock = None
+        #: number of TCP connections opened
+        self.connects = 0
+        #: number of sends that re-used an already-open connection
+        self.connects_saved = 0
+        #: total wall-clock seconds spent in :py:meth:`~.send`
+        self.send_time = 0.0
+        #: number of successful sends
+        self.sends = 0
+        #: total bytes successfully sent
+        self.bytes_sent = 0
+        #: wall-clock seconds the most recent successful send took
+        self.send_latency = 0.0
+
+    @property
+    def connected(self):
+        """
+        Return whether or not we currently hold an open socket.
+
+        :rtype: bool
+        """
+        return self._sock is not None
+
+    def _connect(self):
+        """
+        Open a new socket connection to Graphite, trying each of its (cached)
+        addresses in turn.
+        """
+        logger.debug('Opening socket connection to %s:%s',
+                     self._host, self._port)
+        sock = None
+        err = socket.error('no addresses found for %s' % self._host)
+        for addr in self._resolver.resolve(self._host, self._port):
+            try:
+                sock = self._open(addr)
+                break
+            except socket.error as ex:
+                err = ex
+        if sock is None:
+            self._resolver.expire(self._host, self._port)
+            raise err
+        try:
+            if self._nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self._sndbuf > 0:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                self._sndbuf)
+            self._set_keepalive(sock)
+            if self._send_timeout is not None:
+                sock.settimeout(self._send_timeout)
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        self.connects += 1
+
+    def _open(self, addr):
+        """
+        Open a socket connected to one address. Unlike
+        :py:func:`socket.create_connection`, this connects to the full
+        sockaddr from :py:func:`socket.getaddrinfo`, keeping the flowinfo and
+        scope ID of IPv6 addresses, without which link-local addresses (e.g.
+        ``fe80::1%eth0``) can't be connected to.
+
+        :param addr: :py:func:`socket.getaddrinfo` 5-tuple
+        :type addr: tuple
+        :return: the connected socket
+        :rtype: :py:class:`socket.socket`
+        """
+        family, socktype, proto, _, sockaddr = addr
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(self._timeout)
+            sock.connect(sockaddr)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _set_keepalive(self, sock):
+        """
+        Enable TCP keepalives on a socket, and set ``TCP_USER_TIMEOUT`` to
+        the send timeout, so that a dead peer is noticed in about a minute
+        rather than when retransmissions time out. Options the platform
+        doesn't support are skipped.
+
+        :param sock: the socket
+        :type sock: :py:class:`socket.socket`
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, val in [
+            ('TCP_KEEPIDLE', self.KEEPALIVE_IDLE),
+            ('TCP_KEEPINTVL', self.KEEPALIVE_INTERVAL),
+            ('TCP_KEEPCNT', self.KEEPALIVE_COUNT)
+        ]:
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), val)
+        if hasattr(socket, 'TCP_USER_TIMEOUT'):
+            timeout = self._send_timeout
+            if timeout is None:
+                timeout = self._timeout
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                            int(timeout * 1000))
+
+    def _peer_closed(self):
+        """
+        Determine whether the peer has closed or reset our connection, or the
+        kernel has dropped it (i.e. after keepalives or ``TCP_USER_TIMEOUT``
+        found the peer dead). Carbon never writes to its receivers, so a
+        socket that polls as readable either has a pending EOF or a pending
+        error. A peer that has silently gone away isn't detected here until
+        the kernel gives up on the connection.
+
+        :return: whether the connection is no longer usable
+        :rtype: bool
+        """
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+        except (select.error, ValueError):
+            return True
+        if len(readable) == 0:
+            return False
+        try:
+            data = self._sock.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return True
+        return len(data) == 0
+
+    def close(self):
+        """
+        Close the connection, if open.
+        """
+        if self._sock is None:
+            return
+        logger.debug('Closing socket connection to %s:%s',
+                     self._host, self._port)
+        try:
+            self._sock.close()
+        except Exception:
+            logger.debug('Exception closing socket', exc_info=True)
+        self._sock = None
+
+    def send(self, data):
+        """
+        Send data over the connection, connecting first if needed. If a send
+        on a re-used connection fails, reconnect and retry it once.
+
+        The retry resends all of ``data``, as we can't tell how much of it the
+        peer received before the failure, and resuming part way through a
+        line or pickle frame on a new connection would corrupt it. So if the
+        first attempt failed part way through, the peer may receive some
+        datapoints twice.
+
+        Nor is every datapoint guaranteed to arrive: ``sendall`` returns once
+        the data is in the kernel's send buffer, so data handed over just
+        before the peer resets or drops the connection is lost without any
+        error being raised here.
+
+        :param data: data to send
+        :type data: bytes
+        :raises: :py:exc:`socket.error` if the data could not be sent
+        """
+        start = time.time()
+        try:
+            if self._sock is not None and self._peer_closed():
+                logger.info('Connection to %s:%s closed by peer; reconnecting',
+                            self._host, self._port)
+                self.close()
+            if self._sock is not None:
+                try:
+                    self._sock.sendall(data)
+                    self.connects_saved += 1
+                    self._sent(data, start)
+                    return
+                except socket.error:
+                    logger.warning('Send on existing connection to %s:%s '
+                                   'failed; reconnecting', self._host,
+                                   self._port, exc_info=True)
+                    self.close()
+            self._connect()
+            self._sock.sendall(data)
+            self._sent(data, start)
+        except Exception:
+            self.close()
+            raise
+        finally:
+            self.send_time += time.time() - start
+
+    def _sent(self, data, start):
+        """
+        Update the send counters after successfully sending ``data``.
+
+        :param data: data that was sent
+        :type data: bytes
+        :param start: time the send started at
+        :type start: float
+        """
+        self.sends += 1
+        self.bytes_sent += len(data)
+        self.send_latency = time.time() - start
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter. Tokens accrue at ``rate`` per second up to
+    ``capacity``; taking more tokens than are available puts the bucket into
+    debt, and the caller is told how long to wait for it to be repaid.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Initialize TokenBucket; it starts full.
+
+        :param rate: tokens added per second
+        :type rate: float
+        :param capacity: maximum number of tokens; defaults to ``rate``
+          (i.e. a one-second burst)
+        :type capacity: float
+        """
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self._capacity
+        self._last = time.time()
+
+    def reserve(self, amount):
+        """
+        Take ``amount`` tokens from the bucket, and return the number of
+        seconds the caller must wait before using them.
+
+        :param amount: number of tokens to take
+        :type amount: float
+        :return: seconds to wait
+        :rtype: float
+        """
+        now = time.time()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._last) * self._rate
+        )
+        self._last = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self._rate
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for sends to Graphite. After ``failure_threshold``
+    consecutive failures the breaker opens, and sends are not attempted
+    (callers go straight to the disk cache) until a backoff period has
+    passed. The breaker then goes half-open and allows a single probe send;
+    if it succeeds the breaker closes, otherwise it re-opens with the backoff
+    doubled, up to ``max_backoff``. Each backoff period is randomized by
+    +/- 50% so that many hosts don't probe in lockstep.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    #: numeric values for each state, for sending as metrics
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold=3, backoff=5, max_backoff=300):
+        """
+        Initialize CircuitBreaker, in the closed state.
+
+        :param failure_threshold: number of consecutive failures after which
+          to open the breaker
+        :type failure_threshold: int
+        :param backoff: initial number of seconds to wait before probing
+        :type backoff: float
+        :param max_backoff: maximum number of seconds to wait before probing
+        :type max_backoff: float
+        """
+        self._failure_threshold = failure_threshold
+        self._base_backoff = backoff
+        self._max_backoff = max_backoff
+        self._backoff = backoff
+        self._failures = 0
+        self._retry_at = None
+        self._opened_at = None
+        #: current state
+        self.state = self.CLOSED
+        #: number of state transitions
+        self.transitions = 0
+        self._open_time = 0.0
+
+    @property
+    def open_time(self):
+        """
+        Return the total number of seconds the breaker has spent open or
+        half-open.
+
+        :rtype: float
+        """
+        if self._opened_at is None:
+            return self._open_time
+        return self._open_time + time.time() - self._opened_at
+
+    def _transition(self, state):
+        """
+        Move to a new state.
+
+        :param state: new state
+        :type state: str
+        """
+        logger.warning('Graphite circuit breaker state change: %s -> %s',
+                       self.state, state)
+        self.state = state
+        self.transitions += 1
+
+    def allow(self):
+        """
+        Return whether a send should be attempted now.
+
+        :rtype: bool
+        """
+        if self.state == self.OPEN:
+            if time.time() < self._retry_at:
+                return False
+            self._transition(self.HALF_OPEN)
+        return True
+
+    def success(self):
+        """
+        Record a successful send.
+        """
+        self._failures = 0
+        if self.state == self.CLOSED:
+            return
+        self._transition(self.CLOSED)
+        self._open_time += time.time() - self._opened_at
+        self._opened_at = None
+        self._backoff = self._base_backoff
+
+    def failure(self):
+        """
+        Record a failed send.
+        """
+        self._failures += 1
+        if self.state == self.HALF_OPEN:
+            self._backoff = min(self._backoff * 2, self._max_backoff)
+        elif self._failures < self._failure_threshold:
+            return
+        if self._opened_at is None:
+            self._opened_at = time.time()
+        delay = self._backoff * random.uniform(0.5, 1.5)
+        self._retry_at = time.time() + delay
+        logger.warning('Not sending to Graphite for the next %.1f seconds '
+                       'after %d consecutive failures', delay, self._failures)
+        if self.state != self.OPEN:
+            self._transition(self.OPEN)
+
+
+def release_view(view):
+    """
+    Release a memoryview now, where supported (Python 3), rather than when it
+    is garbage collected; a ``bytearray`` can't be resized while any view of
+    it is alive.
+
+    :param view: the view to release
+    :type view: memoryview
+    """
+    if hasattr(view, 'release'):
+        view.release()
+
+
+class LineSerializer(object):
+    """
+    Serializes datapoints to plaintext protocol lines, as bytes. The encoded
+    prefix and metric name of each metric are cached and re-used on every
+    later send, and lines are written into a single re-used ``bytearray``
+    that can be passed directly to the socket, without building intermediate
+    strings.
+    """
+
+    def __init__(self, prefix='', max_paths=100000):
+        """
+        Initialize LineSerializer.
+
+        :param prefix: prefix to prepend to all metric names
+        :type prefix: str
+        :param max_paths: maximum number of encoded metric paths to cache;
+          the cache is cleared if it grows past this
+        :type max_paths: int
+        """
+        self._prefix = b''
+        if prefix:
+            self._prefix = prefix.encode('utf-8') + b'.'
+        self._max_paths = max_paths
+        self._paths = {}
+        self._buf = bytearray()
+
+    def serialize(self, data_list):
+        """
+        Serialize datapoints to plaintext protocol lines.
+
+        The returned buffer is overwritten by the next call, so callers must
+        be done with it (or copy it) before serializing anything else.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        :return: plaintext protocol data
+        :rtype: bytearray
+        """
+        if len(self._paths) > self._max_paths:
+            self._paths.clear()
+        paths = self._paths
+        buf = self._buf
+        del buf[:]
+        last_ts = None
+        ts_bytes = None
+        for name, value, ts in data_list:
+            path_bytes = paths.get(name)
+            if path_bytes is None:
+                path_bytes = paths[name] = (
+                    self._prefix + name.encode('utf-8') + b' '
+                )
+            if ts != last_ts:
+                last_ts = ts
+                ts_bytes = (' %d\n' % ts).encode('ascii')
+            buf += path_bytes
+            buf += str(value).encode('ascii')
+            buf += ts_bytes
+        return buf
+
+    @staticmethod
+    def chunks(buf, max_bytes=0, max_lines=0):
+        """
+        Split serialized data into chunks of whole lines, each at most
+        ``max_bytes`` bytes and ``max_lines`` lines. A single line longer than
+        ``max_bytes`` is returned as a chunk of its own.
+
+        :param buf: serialized plaintext protocol data
+        :type buf: ``bytes`` or ``bytearray``
+        :param max_bytes: maximum chunk size in bytes; 0 for unlimited
+        :type max_bytes: int
+        :param max_lines: maximum lines per chunk; 0 for unlimited
+        :type max_lines: int
+        :return: list of (start offset, end offset, number of lines) 3-tuples
+        :rtype: ``list``
+        """
+        res = []
+        start = 0
+        while start < len(buf):
+            end = len(buf)
+            if max_bytes > 0 and start + max_bytes < end:
+                # split at the last line boundary that fits, or after the
+                # first line if even that doesn't fit
+                nl = buf.rfind(b'\n', start, start + max_bytes)
+                if nl == -1:
+                    nl = buf.find(b'\n', start + max_bytes)
+                end = nl + 1
+            lines = buf.count(b'\n', start, end)
+            if max_lines > 0 and lines > max_lines:
+                end = start
+                for _ in range(max_lines):
+                    end = buf.find(b'\n', end) + 1
+                lines = max_lines
+            res.append((start, end, lines))
+            start = end
+        return res
+
+
+class UDPSender(object):
+    """
+    Fire-and-forget sender of plaintext protocol datapoints to a carbon UDP
+    listener. Datapoints are packed into datagrams of at most
+    ``max_datagram`` bytes and sent on a non-blocking socket; there is no
+    connection set-up or acknowledgement, and any datagram that can't be sent
+    immediately is dropped (and counted) rather than waited on or cached.
+    """
+
+    def __init__(self, host, port=2003, max_datagram=1472, metric_prefix='',
+                 resolver=None):
+        """
+        Initialize UDPSender.
+
+        :param host: graphite host name or IP
+        :type host: str
+        :param port: carbon UDP listener port
+        :type port: int
+        :param max_datagram: maximum datagram payload size in bytes; the
+          default fits in a 1500 byte Ethernet MTU
+        :type max_datagram: int
         :param metric_prefix: prefix to prepend to all metrics
         :type metric_prefix: str
+        :param resolver: DNS cache to resolve ``host`` with; if None, a new
+          one with the default TTL
+        :type resolver: :py:class:`~.ResolverCache`
         """
         self._host = host
         self._port = port
-        self._metric_prefix = metric_prefix
-        self._cache_dir = '/var/lib/pi2graphite'
-        if not os.path.exists(self._cache_dir):
-            logger.info('Creating cache directory at: %s', self._cache_dir)
-            os.mkdir(self._cache_dir)
+        self._max_datagram = max_datagram
+        self._resolver = resolver
+        if resolver is None:
+            self._resolver = ResolverCache()
+        self._serializer = LineSerializer(prefix=metric_prefix)
+        self._sock = None
+        self._family = None
+        self._addr = None
+        self.datagrams = 0
+        self.points = 0
+        self.dropped_points = 0
+
+    def _datagrams(self, data_list):
+        """
+        Pack datapoints into datagram payloads of at most ``max_datagram``
+        bytes. A single line longer than that is sent in a datagram of its
+        own.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        :return: list of (payload, number of datapoints) 2-tuples
+        :rtype: ``list``
+        """
+        buf = self._serializer.serialize(data_list)
+        return [
+            (bytes(buf[start:end]), lines) for start, end, lines in
+            LineSerializer.chunks(buf, max_bytes=self._max_datagram)
+        ]
+
+    def _socket(self):
+        """
+        Resolve the destination address (from the DNS cache if possible), and
+        return our UDP socket, creating it if it hasn't been already or the
+        address family has changed.
 
-    def _graphite_str(self, data_list):
+        :return: non-blocking UDP socket
+        :rtype: socket.socket
         """
-        Generate a string to send to Graphite.
+        family, socktype, proto, _, addr = self._resolver.resolve(
+            self._host, self._port, socket.SOCK_DGRAM
+        )[0]
+        if self._sock is not None and family != self._family:
+            self.close()
+        if self._sock is None:
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            self._sock = sock
+            self._family = family
+        self._addr = addr
+        return self._sock
+
+    def send(self, data_list):
+        """
+        Send datapoints, dropping any that can't be sent immediately.
 
         :param data_list: list of 3-tuples:
           (metric name, value, integer timestamp)
         :type data_list: ``list``
-        :return: string to send to Graphite
+        """
+        try:
+            sock = self._socket()
+        except Exception:
+            logger.warning('Unable to create UDP socket to %s:%s; dropping '
+                           '%d datapoints', self._host, self._port,
+                           len(data_list), exc_info=True)
+            self.dropped_points += len(data_list)
+            return
+        for payload, points in self._datagrams(data_list):
+            try:
+                sock.sendto(payload, self._addr)
+                self.datagrams += 1
+                self.points += points
+            except Exception:
+                logger.debug('Error sending UDP datagram to %s:%s; dropping '
+                             '%d datapoints', self._host, self._port, points,
+                             exc_info=True)
+                self.dropped_points += points
+
+    def close(self):
+        """
+        Close the socket, if open.
+        """
+        if self._sock is None:
+            return
+        try:
+            self._sock.close()
+        except Exception:
+            logger.debug('Exception closing UDP socket', exc_info=True)
+        self._sock = None
+
+
+class GraphiteDestination(object):
+    """
+    A single Graphite (carbon) destination, with its own connection, disk
+    cache and circuit breaker. Data that can't be sent is cached locally and
+    sent when the connection resumes. Data is always cached in the plaintext
+    protocol format, and converted to the configured protocol when the cache
+    is flushed.
+
+    Cached data is flushed by a background thread, started after the first
+    successful send, so that callers of :py:meth:`~.send` are never
+    blocked replaying a backlog. The connection and cache are shared between
+    the two threads under a lock that the flush thread only holds for one
+    chunk at a time, so live sends are interleaved with replay. Replay can
+    be rate-limited in datapoints and/or bytes per second, and each flush
+    starts after a random delay so that many hosts recovering from the same
+    outage don't all replay at once. Live sends are never rate-limited.
+
+    Sends go through a :py:class:`~.CircuitBreaker`, so that while Graphite
+    is unreachable data is cached immediately instead of waiting for a
+    connection attempt to time out on every poll.
+
+    If ``udp_port`` is set, datapoints can also be sent fire-and-forget over
+    UDP with :py:meth:`~.send_udp`, by a :py:class:`~.UDPSender`.
+
+    If ``queue_max_points`` is set, :py:meth:`~.enqueue` adds data to a
+    bounded in-memory queue instead of sending it, and returns immediately.
+    A background sender thread sends everything queued as one batch; if that
+    fails, the data stays queued and is retried. Queued data is only written
+    to the disk cache ("spilled") once the queue grows past
+    ``queue_max_points``, so short outages never touch the disk.
+    """
+
+    #: seconds :py:meth:`~.close` waits for each background thread to exit
+    CLOSE_TIMEOUT = 30
+
+    def __init__(self, host, port=2003, metric_prefix='',
+                 protocol='plaintext', pickle_batch_size=500,
+                 cache_dir='/var/lib/pi2graphite',
+                 cache_segment_bytes=1048576, cache_max_bytes=0,
+                 cache_max_age=0, cache_downsample_at=0.75,
+                 cache_downsample_factor=2, cache_downsample_method='avg',
+                 cache_compress=True,
+                 replay_chunk_lines=1000,
+                 replay_chunk_bytes=65536, replay_chunk_delay=0.1,
+                 replay_points_per_sec=0, replay_bytes_per_sec=0,
+                 replay_jitter=10, failure_threshold=3, retry_backoff=5,
+                 retry_backoff_max=300, udp_port=None,
+                 udp_max_datagram=1472, queue_max_points=0,
+                 queue_retry_delay=1, max_lines_per_write=0,
+                 max_bytes_per_write=0, connect_timeout=10,
+                 send_timeout=None, tcp_nodelay=False, send_buffer_bytes=0,
+                 dns_cache_ttl=300):
+        """
+        Initialize GraphiteDestination.
+
+        :param host: graphite host name or IP
+        :type host: str
+        :param port: graphite plaintext or pickle port
+        :type port: int
+        :param metric_prefix: prefix to prepend to all metrics
+        :type metric_prefix: str
+        :param protocol: carbon protocol to send with, "plaintext" or "pickle"
+        :type protocol: str
+        :param pickle_batch_size: maximum number of datapoints per pickle
+          protocol frame
+        :type pickle_batch_size: int
+        :param cache_dir: directory to cache unsent data in
+        :type cache_dir: str
+        :param cache_segment_bytes: size in bytes of each on-disk cache
+          segment file
+        :type cache_segment_bytes: int
+        :param cache_max_bytes: maximum total size of the on-disk cache in
+          bytes; 0 for unlimited
+        :type cache_max_bytes: int
+        :param cache_max_age: maximum age of on-disk cache segments in seconds;
+          0 for unlimited
+        :type cache_max_age: int
+        :param cache_downsample_at: fraction of ``cache_max_bytes`` above
+          which to start thinning out the oldest cached data
+        :type cache_downsample_at: float
+        :param cache_downsample_factor: factor to thin out old cached data by
+        :type cache_downsample_factor: int
+        :param cache_downsample_method: how to thin out old cached data;
+          "avg" or "nth"
+        :type cache_downsample_method: str
+        :param cache_compress: whether to write the on-disk cache in the
+          compressed format
+        :type cache_compress: bool
+        :param replay_chunk_lines: maximum number of cached lines to send in
+          each write when flushing the cache
+        :type replay_chunk_lines: int
+        :param replay_chunk_bytes: maximum number of cached bytes to send in
+          each write when flushing the cache
+        :type replay_chunk_bytes: int
+        :param replay_chunk_delay: seconds for the background flush thread to
+          pause between sending each chunk of cached data
+        :type replay_chunk_delay: float
+        :param replay_points_per_sec: maximum rate at which to send cached
+          datapoints; 0 for unlimited
+        :type replay_points_per_sec: float
+        :param replay_bytes_per_sec: maximum rate at which to send cached
+          data, in bytes per second; 0 for unlimited
+        :type replay_bytes_per_sec: float
+        :param replay_jitter: maximum number of seconds to randomly delay the
+          start of each cache flush by
+        :type replay_jitter: float
+        :param failure_threshold: number of consecutive send failures after
+          which to stop trying to send, and cache data immediately
+        :type failure_threshold: int
+        :param retry_backoff: initial number of seconds to wait before
+          retrying after ``failure_threshold`` failures
+        :type retry_backoff: float
+        :param retry_backoff_max: maximum number of seconds to wait before
+          retrying
+        :type retry_backoff_max: float
+        :param udp_port: carbon UDP listener port to send to with
+          :py:meth:`~.send_udp`; None to disable UDP
+        :type udp_port: int
+        :param udp_max_datagram: maximum UDP datagram payload size in bytes
+        :type udp_max_datagram: int
+        :param queue_max_points: high-water mark of the in-memory send queue
+          used by :py:meth:`~.enqueue`, in datapoints; above this, the oldest
+          queued data is spilled to the disk cache
+        :type queue_max_points: int
+        :param queue_retry_delay: seconds for the sender thread to wait
+          before retrying after a failed send
+        :type queue_retry_delay: float
+        :param max_lines_per_write: maximum number of datapoints to send in
+          each socket write; 0 for unlimited
+        :type max_lines_per_write: int
+        :param max_bytes_per_write: maximum number of bytes to send in each
+          socket write with the plaintext protocol; 0 for unlimited
+        :type max_bytes_per_write: int
+        :param connect_timeout: socket connect timeout in seconds
+        :type connect_timeout: float
+        :param send_timeout: socket send timeout in seconds; if None, the
+          same as ``connect_timeout``
+        :type send_timeout: float
+        :param tcp_nodelay: whether to set ``TCP_NODELAY`` on the socket
+        :type tcp_nodelay: bool
+        :param send_buffer_bytes: socket send buffer size in bytes; 0 for the
+          OS default
+        :type send_buffer_bytes: int
+        :param dns_cache_ttl: number of seconds to cache DNS lookups of
+          ``host`` for
+        :type dns_cache_ttl: float
+        """
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._pickle_batch_size = pickle_batch_size
+        self._metric_prefix = metric_prefix
+        self._serializer = LineSerializer(prefix=metric_prefix)
+        self._cache_serializer = LineSerializer(prefix=metric_prefix)
+        self._max_lines_per_write = max_lines_per_write
+        self._max_bytes_per_write = max_bytes_per_write
+        self._resolver = ResolverCache(ttl=dns_cache_ttl)
+        self._conn = GraphiteConnection(
+            host, port, timeout=connect_timeout, send_timeout=send_timeout,
+            nodelay=tcp_nodelay, sndbuf=send_buffer_bytes,
+            resolver=self._resolver
+        )
+        self._breaker = CircuitBreaker(
+            failure_threshold=failure_threshold, backoff=retry_backoff,
+            max_backoff=retry_backoff_max
+        )
+        self._cache = DiskCache(
+            directory=cache_dir, segment_bytes=cache_segment_bytes,
+            max_bytes=cache_max_bytes, max_age=cache_max_age,
+            downsample_at=cache_downsample_at,
+            downsample_factor=cache_downsample_factor,
+            downsample_method=cache_downsample_method,
+            compress=cache_compress
+        )
+        self._replay_chunk_lines = replay_chunk_lines
+        self._replay_chunk_bytes = replay_chunk_bytes
+        self._replay_chunk_delay = replay_chunk_delay
+        self._replay_jitter = replay_jitter
+        self._replay_buckets = []
+        if replay_points_per_sec > 0:
+            self._replay_buckets.append(
+                ('points', TokenBucket(replay_points_per_sec))
+            )
+        if replay_bytes_per_sec > 0:
+            self._replay_buckets.append(
+                ('bytes', TokenBucket(replay_bytes_per_sec))
+            )
+        # held while sending; the connection, breaker and serializer
+        self._lock = threading.RLock()
+        # held while accessing the disk cache, but never while sending, so
+        # that data can always be cached without waiting on the network
+        self._cache_lock = threading.Lock()
+        self._flush_wanted = threading.Event()
+        self._stop = threading.Event()
+        self._flush_thread = None
+        self.sets_flushed = 0
+        self.points_flushed = 0
+        #: number of cached datapoints not re-sent on replay, because they
+        #: had already been sent before an earlier replay was interrupted
+        self.replay_deduped_points = 0
+        # (segment, offset, lines) of the last partly-sent batch counted in
+        # replay_deduped_points
+        self._deduped_batch = (None, None, 0)
+        #: datapoints per second replayed by the most recent cache flush
+        self.replay_rate = 0.0
+        self._udp = None
+        if udp_port is not None:
+            self._udp = UDPSender(
+                host, port=udp_port, max_datagram=udp_max_datagram,
+                metric_prefix=metric_prefix, resolver=self._resolver
+            )
+        self._queue_max_points = queue_max_points
+        self._queue_retry_delay = queue_retry_delay
+        self._queue = deque()
+        self._queued_points = 0
+        self._queue_cond = threading.Condition()
+        self._sender_thread = None
+        self.spilled_points = 0
+
+    @property
+    def name(self):
+        """
+        Return a name for this destination that is safe to use in a Graphite
+        metric path.
+
+        :return: destination name
         :rtype: str
         """
-        parts = [
-            "%s.%s %s %d" % (
-                self._metric_prefix, t[0], t[1], t[2]) for t in data_list
+        return ('%s_%s' % (self._host, self._port)).replace('.', '_')
+
+    def _graphite_pickle(self, data_list):
+        """
+        Generate pickle protocol data to send to Graphite; a series of
+        length-prefixed pickle frames of at most ``pickle_batch_size``
+        datapoints each.
+
+        :param data_list: list of 3-tuples:
+          (full metric path, value, integer timestamp)
+        :type data_list: ``list``
+        :return: pickle protocol data to send to Graphite
+        :rtype: bytes
+        """
+        frames = []
+        for i in range(0, len(data_list), self._pickle_batch_size):
+            payload = pickle.dumps(
+                [
+                    (t[0], (t[2], t[1]))
+                    for t in data_list[i:i + self._pickle_batch_size]
+                ],
+                protocol=2
+            )
+            frames.append(struct.pack('!L', len(payload)) + payload)
+        return b''.join(frames)
+
+    def _prefixed(self, data_list):
+        """
+        Prepend the metric prefix to all metric names in a data list.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        :return: list of 3-tuples:
+          (full metric path, value, integer timestamp)
+        :rtype: ``list``
+        """
+        if not self._metric_prefix:
+            return data_list
+        return [
+            ('%s.%s' % (self._metric_prefix, t[0]), t[1], t[2])
+            for t in data_list
         ]
-        return "\n".join(parts) + "\n"
+
+    def _cache_payload(self, data_str):
+        """
+        Given cached plaintext protocol data, return the data to send to
+        Graphite in our configured protocol.
+
+        :param data_str: cached plaintext protocol data
+        :type data_str: str
+        :return: data to send to Graphite
+        :rtype: ``str`` or ``bytes``
+        """
+        if self._protocol != 'pickle':
+            return data_str
+        data_list = []
+        for line in data_str.splitlines():
+            parts = line.split()
+            if len(parts) != 3:
+                continue
+            data_list.append((parts[0], float(parts[1]), int(parts[2])))
+        return self._graphite_pickle(data_list)
 
     def _graphite_send(self, send_str):
         """
         Send data to graphite
 
         :param send_str: data string to send
-        :type send_str: str
-        :returns: True if send succeeded, False if exception caught
+        :type send_str: ``str``, ``bytes``, ``bytearray`` or ``memoryview``
+        :returns: True if send succeeded, False if exception caught or the
+          circuit breaker is open
         :rtype: bool
         """
-        try:
-            logger.debug('Opening socket connection to %s:%s',
-                         self._host, self._port)
-            sock = socket.create_connection((self._host, self._port), 10)
-            logger.debug('Sending data: "%s"', send_str)
-            sock.sendall(send_str)
-            logger.info('Data sent to Graphite')
-            sock.close()
-            return True
-        except Exception:
-            logger.error('Caught exception sending to Graphite', exc_info=True)
+        if not isinstance(send_str, (bytes, bytearray, memoryview)):
+            send_str = send_str.encode('utf-8')
+        with self._lock:
+            if not self._breaker.allow():
+                logger.info('Circuit breaker open; not sending to %s:%s',
+                            self._host, self._port)
+                return False
+            try:
+                if logger.isEnabledFor(logging.DEBUG):
+                    # a copy, as the log record may outlive a memoryview
+                    logger.debug('Sending data: "%s"', bytes(send_str))
+                self._conn.send(send_str)
+                self._breaker.success()
+                logger.info('Data sent to Graphite at %s:%s',
+                            self._host, self._port)
+                return True
+            except Exception:
+                logger.error('Caught exception sending to Graphite at '
+                             '%s:%s', self._host, self._port, exc_info=True)
+                self._breaker.failure()
         return False
 
+    def _send_cached(self, data_str):
+        """
+        Send a chunk of cached plaintext protocol data in writes of at most
+        ``max_lines_per_write`` lines and ``max_bytes_per_write`` bytes,
+        stopping at the first write that fails.
+
+        :param data_str: cached plaintext protocol data
+        :type data_str: str
+        :return: number of lines that were sent
+        :rtype: int
+        """
+        buf = data_str.encode('utf-8')
+        view = memoryview(buf)
+        sent = 0
+        for start, end, lines in LineSerializer.chunks(
+            buf, max_bytes=self._max_bytes_per_write,
+            max_lines=self._max_lines_per_write
+        ):
+            if self._protocol == 'pickle':
+                data = self._cache_payload(buf[start:end].decode('utf-8'))
+            elif start != 0 or end != len(buf):
+                data = view[start:end]
+            else:
+                data = buf
+            ok = self._graphite_send(data)
+            if data is not buf:
+                release_view(data)
+            if not ok:
+                break
+            sent += lines
+        release_view(view)
+        return sent
+
     def _flush_cache(self):
         """
-        Find and flush all cached metrics.
+        Flush all cached metrics, oldest segment first. Cached data is
+        streamed from disk in bounded chunks (batches), and each chunk's
+        progress is committed as soon as it has been sent. If a chunk is only
+        partly sent, the number of its lines that were sent is committed as a
+        progress marker, so that the next replay only sends the rest of it.
+        The lock is only held while sending each chunk. Between chunks we
+        pause ``replay_chunk_delay`` seconds, or longer if needed to stay
+        within the replay rate limits.
         """
-        files = [
-            f for f in os.listdir(self._cache_dir)
-            if os.path.isfile(os.path.join(self._cache_dir, f))
-        ]
-        if len(files) == 0:
-            logger.debug('No cache files to flush')
+        with self._cache_lock:
+            segments = self._cache.segments()
+        if len(segments) == 0:
+            logger.debug('No cache segments to flush')
             return
-        logger.info('Found %d data cache files to send', len(files))
-        for f in files:
-            fpath = os.path.join(self._cache_dir, f)
-            with open(fpath, 'r') as fh:
-                data = fh.read()
-            res = self._graphite_send(data)
-            if not res:
-                logger.error('Error: graphite send failed during cache flush')
+        logger.info('Found %d data cache segments to send', len(segments))
+        if self._replay_jitter > 0:
+            jitter = random.uniform(0, self._replay_jitter)
+            logger.debug('Waiting %.2f seconds before flushing cache', jitter)
+            self._stop.wait(jitter)
+        began = time.time()
+        flushed = self.points_flushed
+        try:
+            self._flush_segments(segments)
+        finally:
+            elapsed = time.time() - began
+            if self.points_flushed > flushed and elapsed > 0:
+                self.replay_rate = (self.points_flushed - flushed) / elapsed
+
+    def _flush_segments(self, segments):
+        """
+        Flush cached metrics from each of the given segments in turn; see
+        :py:meth:`~._flush_cache`.
+
+        :param segments: segment numbers to flush, oldest first
+        :type segments: ``list``
+        """
+        for seg in segments:
+            with self._cache_lock:
+                # reading the progress and protecting the segment from
+                # downsampling and eviction must be done in one step
+                chunks = self._cache.read_chunks(
+                    seg, max_lines=self._replay_chunk_lines,
+                    max_bytes=self._replay_chunk_bytes
+                )
+            # the batch being replayed is identified by the segment and the
+            # offset it starts at; ``done`` lines of it have been sent
+            start, done = chunks.progress
+            if done > 0:
+                logger.info('Resuming replay of cache segment %d at offset '
+                            '%d; skipping %d datapoints already sent', seg,
+                            start, done)
+                # a batch may be resumed several times; only count each
+                # datapoint skipped once
+                counted = 0
+                if self._deduped_batch[:2] == (seg, start):
+                    counted = self._deduped_batch[2]
+                self.replay_deduped_points += max(0, done - counted)
+                self._deduped_batch = (seg, start, max(done, counted))
+            try:
+                while not self._stop.is_set():
+                    with self._lock:
+                        try:
+                            with self._cache_lock:
+                                data, offset = next(chunks)
+                        except StopIteration:
+                            break
+                        sent = self._send_cached(data)
+                        if sent < data.count('\n'):
+                            logger.error('Error: graphite send failed '
+                                         'during cache flush')
+                            if sent > 0:
+                                with self._cache_lock:
+                                    self._cache.commit(
+                                        seg, start, points=sent,
+                                        lines=done + sent
+                                    )
+                                self.points_flushed += sent
+                            return
+                        with self._cache_lock:
+                            self._cache.commit(seg, offset, points=sent)
+                        self.points_flushed += sent
+                        start, done = offset, 0
+                    self._stop.wait(self._replay_wait(data))
+            finally:
+                with self._cache_lock:
+                    chunks.close()
+            if self._stop.is_set():
                 return
-            os.unlink(fpath)
+            self.sets_flushed += 1
         logger.debug('Done flushing cache')
-        self.send_data(
-            [(
-                'pi2graphite.cached_sets_flushed',
-                len(files),
-                int(time.time())
-            )]
-        )
 
-    def _cache_data(self, data_str):
+    def _replay_wait(self, data):
+        """
+        Take tokens for a chunk of just-sent cached data from the replay rate
+        limiters, and return the number of seconds to wait before sending the
+        next chunk.
+
+        :param data: chunk of plaintext protocol data that was sent
+        :type data: str
+        :return: seconds to wait
+        :rtype: float
+        """
+        wait = self._replay_chunk_delay
+        for kind, bucket in self._replay_buckets:
+            amount = data.count('\n') if kind == 'points' else len(data)
+            wait = max(wait, bucket.reserve(amount))
+        return wait
+
+    def _flush_worker(self):
+        """
+        Main loop of the background cache flush thread; flush the cache each
+        time a flush is requested by :py:meth:`~._request_flush`.
+        """
+        logger.debug('Cache flush thread started')
+        while not self._stop.is_set():
+            self._flush_wanted.wait()
+            self._flush_wanted.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self._flush_cache()
+            except Exception:
+                logger.error('Exception flushing cache', exc_info=True)
+        logger.debug('Cache flush thread exiting')
+
+    def _request_flush(self):
+        """
+        Ask the background flush thread to flush the cache, starting it if
+        it is not already running.
+        """
+        if self._flush_thread is None:
+            self._flush_thread = threading.Thread(
+                target=self._flush_worker, name='pi2graphite-cache-flush'
+            )
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+        self._flush_wanted.set()
+
+    def _cache_data(self, data_list):
         """
         Cache data that we couldn't send on disk.
-        :param data_str: string of data to send
-        :type data_str: str
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        """
+        with self._cache_lock:
+            self._cache.append(
+                bytes(self._cache_serializer.serialize(data_list)).decode(
+                    'utf-8')
+            )
+
+    def append_cache(self, data):
+        """
+        Add already-serialized plaintext protocol data to this destination's
+        disk cache, to be sent when the cache is next flushed.
+
+        :param data: newline-terminated plaintext protocol data
+        :type data: str
+        """
+        with self._cache_lock:
+            self._cache.append(data)
+
+    def _send(self, data_list):
+        """
+        Send metrics to this destination in writes of at most
+        ``max_lines_per_write`` datapoints and ``max_bytes_per_write`` bytes,
+        stopping at the first write that fails. Request a cache flush if all
+        of the data was sent.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        :return: list of the datapoints that were not sent; empty if all of
+          them were
+        :rtype: ``list``
+        """
+        sent = 0
+        with self._lock:
+            if self._protocol == 'pickle':
+                step = self._max_lines_per_write or len(data_list) or 1
+                for i in range(0, len(data_list), step):
+                    chunk = data_list[i:i + step]
+                    if not self._graphite_send(
+                        self._graphite_pickle(self._prefixed(chunk))
+                    ):
+                        break
+                    sent += len(chunk)
+            else:
+                buf = self._serializer.serialize(data_list)
+                # slices of a memoryview don't copy the buffer; they must
+                # all be gone before the serializer next reuses it
+                view = memoryview(buf)
+                for start, end, lines in LineSerializer.chunks(
+                    buf, max_bytes=self._max_bytes_per_write,
+                    max_lines=self._max_lines_per_write
+                ):
+                    data = buf
+                    if start != 0 or end != len(buf):
+                        data = view[start:end]
+                    ok = self._graphite_send(data)
+                    if data is not buf:
+                        release_view(data)
+                    if not ok:
+                        break
+                    sent += lines
+                release_view(view)
+        if sent < len(data_list):
+            return data_list[sent:]
+        logger.info('Successfully sent data to Graphite at %s:%s',
+                    self._host, self._port)
+        self._request_flush()
+        return []
+
+    def send(self, data_list):
+        """
+        Send metrics to this destination, caching them on disk if that fails.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        :return: whether or not the data was sent
+        :rtype: bool
+        """
+        unsent = self._send(data_list)
+        if len(unsent) == 0:
+            return True
+        logger.error('Sending data to Graphite at %s:%s failed; caching %d '
+                     'datapoints on disk.', self._host, self._port,
+                     len(unsent))
+        self._cache_data(unsent)
+        return False
+
+    def _take_spill(self):
+        """
+        Remove the oldest data from the queue until it is back under its
+        high-water mark, and return it. Must be called with
+        ``self._queue_cond`` held.
+
+        :return: list of 3-tuples: (metric name, value, integer timestamp)
+        :rtype: ``list``
+        """
+        spill = []
+        while (self._queued_points > self._queue_max_points and
+               len(self._queue) > 0):
+            batch = self._queue.popleft()
+            self._queued_points -= len(batch)
+            spill.extend(batch)
+        return spill
+
+    def _spill(self, data_list):
+        """
+        Write data removed from the queue by :py:meth:`~._take_spill` to the
+        disk cache.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        """
+        logger.warning('Send queue for %s:%s full; caching %d datapoints on '
+                       'disk', self._host, self._port, len(data_list))
+        self.spilled_points += len(data_list)
+        self._cache_data(data_list)
+
+    def enqueue(self, data_list):
+        """
+        Add metrics to the in-memory send queue, to be sent by the background
+        sender thread, starting it if it is not already running. This never
+        waits on the network.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        """
+        if self._sender_thread is None:
+            self._sender_thread = threading.Thread(
+                target=self._send_worker, name='pi2graphite-sender'
+            )
+            self._sender_thread.daemon = True
+            self._sender_thread.start()
+        with self._queue_cond:
+            self._queue.append(data_list)
+            self._queued_points += len(data_list)
+            spill = self._take_spill()
+            self._queue_cond.notify()
+        if len(spill) > 0:
+            self._spill(spill)
+
+    def _send_worker(self):
+        """
+        Main loop of the background sender thread. Send everything queued by
+        :py:meth:`~.enqueue` as one batch. If that fails, put the unsent part
+        of the batch back at the front of the queue, spill anything over the
+        high-water mark to disk, and retry after ``queue_retry_delay``
+        seconds. If :py:meth:`~.close` was called during the send, it may
+        already have cached the queue without this batch, so write the
+        unsent part to the disk cache instead and exit.
+        """
+        logger.debug('Sender thread started')
+        while True:
+            with self._queue_cond:
+                while len(self._queue) == 0 and not self._stop.is_set():
+                    self._queue_cond.wait()
+                if self._stop.is_set():
+                    break
+                batch = []
+                while len(self._queue) > 0:
+                    batch.extend(self._queue.popleft())
+                self._queued_points = 0
+            try:
+                unsent = self._send(batch)
+            except Exception:
+                logger.error('Exception sending queued data', exc_info=True)
+                unsent = batch
+            if len(unsent) == 0:
+                continue
+            with self._queue_cond:
+                # checked under the lock that close() drains the queue under
+                stopping = self._stop.is_set()
+                if not stopping:
+                    self._queue.appendleft(unsent)
+                    self._queued_points += len(unsent)
+                    spill = self._take_spill()
+            if stopping:
+                logger.info('Caching %d unsent datapoints on disk',
+                            len(unsent))
+                self._cache_data(unsent)
+                break
+            if len(spill) > 0:
+                self._spill(spill)
+            self._stop.wait(self._queue_retry_delay)
+        logger.debug('Sender thread exiting')
+
+    def send_udp(self, data_list):
+        """
+        Send metrics to this destination over UDP. This never blocks, and
+        data that can't be sent is dropped, not cached.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        """
+        self._udp.send(data_list)
+
+    def self_metrics(self, ts, qualifier=''):
+        """
+        Return metrics about this destination, as a data list of metric
+        3-tuples (name, value, timestamp).
+
+        :param ts: data timestamp
+        :type ts: int
+        :param qualifier: string to append to the metric group names, to
+          tell multiple destinations apart
+        :type qualifier: str
+        :return: data list of metric 3-tuples (name, value, timestamp)
+        :rtype: ``list``
+        """
+        with self._cache_lock:
+            segs, size, points = self._cache.depth()
+        cache = 'pi2graphite.cache%s.' % qualifier
+        graphite = 'pi2graphite.graphite%s.' % qualifier
+        res = [
+            (cache + 'segments', segs, ts),
+            (cache + 'bytes', size, ts),
+            (cache + 'points', points, ts),
+            (cache + 'evicted_points', self._cache.evicted_points, ts),
+            (cache + 'sets_flushed', self.sets_flushed, ts),
+            (cache + 'points_flushed', self.points_flushed, ts),
+            (cache + 'replay_deduped_points', self.replay_deduped_points,
+             ts),
+            (cache + 'replay_points_per_sec', round(self.replay_rate, 3), ts),
+            (graphite + 'connects', self._conn.connects, ts),
+            (graphite + 'connects_saved', self._conn.connects_saved, ts),
+            (graphite + 'send_time_sec', round(self._conn.send_time, 6), ts),
+            (graphite + 'sends', self._conn.sends, ts),
+            (graphite + 'bytes_sent', self._conn.bytes_sent, ts),
+            (graphite + 'send_latency_sec',
+             round(self._conn.send_latency, 6), ts),
+            (graphite + 'dns_lookups', self._resolver.lookups, ts),
+            (graphite + 'dns_failures', self._resolver.failures, ts),
+            (graphite + 'dns_resolve_time_sec',
+             round(self._resolver.resolve_time, 6), ts),
+            (graphite + 'breaker_state',
+             CircuitBreaker.STATE_VALUES[self._breaker.state], ts),
+            (graphite + 'breaker_transitions', self._breaker.transitions, ts),
+            (graphite + 'breaker_open_sec',
+             round(self._breaker.open_time, 3), ts)
+        ]
+        if self._udp is not None:
+            udp = 'pi2graphite.udp%s.' % qualifier
+            res.extend([
+                (udp + 'datagrams', self._udp.datagrams, ts),
+                (udp + 'points', self._udp.points, ts),
+                (udp + 'dropped_points', self._udp.dropped_points, ts)
+            ])
+        if self._queue_max_points > 0:
+            queue = 'pi2graphite.queue%s.' % qualifier
+            res.extend([
+                (queue + 'points', self._queued_points, ts),
+                (queue + 'spilled_points', self.spilled_points, ts)
+            ])
+        return res
+
+    def close(self):
+        """
+        Stop the background sender and flush threads, write anything still
+        queued to the disk cache, then close the connection to Graphite, if
+        open, and the disk cache. If the sender thread is still sending after
+        ``CLOSE_TIMEOUT`` seconds, it caches its own batch if that send
+        fails.
+        """
+        # set under the queue lock, so that the sender thread either puts an
+        # unsent batch back before the queue is drained below, or sees this
+        # and caches the batch itself
+        with self._queue_cond:
+            self._stop.set()
+            self._queue_cond.notify()
+        self._flush_wanted.set()
+        if self._sender_thread is not None:
+            self._sender_thread.join(self.CLOSE_TIMEOUT)
+        with self._queue_cond:
+            remaining = []
+            while len(self._queue) > 0:
+                remaining.extend(self._queue.popleft())
+            self._queued_points = 0
+        if len(remaining) > 0:
+            logger.info('Caching %d queued datapoints on disk',
+                        len(remaining))
+            self._cache_data(remaining)
+        if self._flush_thread is not None:
+            self._flush_thread.join(self.CLOSE_TIMEOUT)
+        with self._lock:
+            self._conn.close()
+        with self._cache_lock:
+            self._cache.close()
+        if self._udp is not None:
+            self._udp.close()
+
+
+class ConsistentHashRing(object):
+    """
+    Consistent hash ring for sharding metrics across destinations, compatible
+    with carbon-relay's ``consistent-hashing`` relay method; a metric is sent
+    to the same destination as carbon-relay would send it to, given the same
+    list of (host, instance) destinations.
+    """
+
+    def __init__(self, nodes, replica_count=100):
+        """
+        Initialize ConsistentHashRing.
+
+        :param nodes: list of node keys, (host, instance) 2-tuples
+        :type nodes: ``list``
+        :param replica_count: number of positions on the ring for each node
+        :type replica_count: int
+        """
+        self._replica_count = replica_count
+        self._positions = []
+        self._nodes = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _position(key):
+        """
+        Return the position of a key on the ring.
+
+        :param key: key to hash
+        :type key: str
+        :return: ring position
+        :rtype: int
+        """
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:4], 16)
+
+    def add_node(self, node):
+        """
+        Add a node to the ring.
+
+        :param node: node key, a (host, instance) 2-tuple
+        :type node: tuple
+        """
+        for i in range(self._replica_count):
+            position = self._position('%s:%d' % (node, i))
+            while position in self._positions:
+                position += 1
+            idx = bisect.bisect_left(self._positions, position)
+            self._positions.insert(idx, position)
+            self._nodes.insert(idx, node)
+
+    def get_node(self, key):
+        """
+        Return the node that a key belongs to.
+
+        :param key: key (metric path) to look up
+        :type key: str
+        :return: node key
+        :rtype: tuple
         """
-        fname = os.path.join(self._cache_dir, '%d.json' % int(time.time()))
-        logger.warning('Caching un-sendable data at: %s', fname)
-        with open(fname, 'w') as fh:
-            fh.write(data_str)
+        idx = bisect.bisect_left(self._positions, self._position(key))
+        return self._nodes[idx % len(self._nodes)]
+
+
+class CachingGraphiteClient(object):
+    """
+    Graphite client that sends metrics to one or more
+    :py:class:`~.GraphiteDestination` s, each of which caches data locally
+    that can't be sent and sends it when its connection resumes.
+
+    With multiple destinations, data is either replicated to all of them
+    (``fanout='replicate'``) or sharded across them with a
+    :py:class:`~.ConsistentHashRing` (``fanout='shard'``). Destinations are
+    sent to in parallel, so one slow or unreachable destination doesn't delay
+    delivery to the others.
+
+    Metrics with names matching any of ``udp_patterns`` are sent
+    fire-and-forget over UDP instead, without caching or blocking; use this
+    for high-rate series where occasional loss is acceptable.
+    """
+
+    def __init__(self, host=None, port=2003, metric_prefix='',
+                 destinations=None, fanout='replicate',
+                 cache_dir='/var/lib/pi2graphite', udp_patterns=None,
+                 udp_port=2003, **kwargs):
+        """
+        Initialize CachingGraphiteClient.
+
+        :param host: graphite host name or IP, if ``destinations`` is not
+          specified
+        :type host: str
+        :param port: default graphite plaintext or pickle port
+        :type port: int
+        :param metric_prefix: prefix to prepend to all metrics
+        :type metric_prefix: str
+        :param destinations: list of destination dicts, each with a ``host``
+          key and optional ``port`` and ``instance`` keys. If not specified,
+          send only to ``host`` and ``port``.
+        :type destinations: ``list``
+        :param fanout: how to send data to multiple destinations; "replicate"
+          to send all data to every destination, or "shard" to send each
+          metric to one destination by consistent hashing of its path
+        :type fanout: str
+        :param cache_dir: directory to cache unsent data in. With multiple
+          destinations, each destination caches in its own subdirectory, and
+          anything cached in ``cache_dir`` itself (i.e. from when there was
+          only one destination) is moved into them.
+        :type cache_dir: str
+        :param udp_patterns: list of shell-style wildcard patterns; metrics
+          with names (without the prefix) matching any of them are sent over
+          UDP instead of TCP
+        :type udp_patterns: ``list``
+        :param udp_port: carbon UDP listener port
+        :type udp_port: int
+        :param kwargs: additional keyword arguments to pass to each
+          :py:class:`~.GraphiteDestination`
+        """
+        self._metric_prefix = metric_prefix
+        self._fanout = fanout
+        self._queued = kwargs.get('queue_max_points', 0) > 0
+        kwargs['metric_prefix'] = metric_prefix
+        self._udp_re = None
+        if udp_patterns:
+            self._udp_re = re.compile('|'.join(
+                '(?:%s)' % fnmatch.translate(p) for p in udp_patterns
+            ))
+            kwargs['udp_port'] = udp_port
+        if destinations is None:
+            destinations = [{'host': host}]
+        self._destinations = []
+        for dest in destinations:
+            dest_port = dest.get('port', port)
+            dest_dir = cache_dir
+            if len(destinations) > 1:
+                dest_dir = os.path.join(
+                    cache_dir, '%s_%s' % (dest['host'], dest_port)
+                )
+            self._destinations.append(GraphiteDestination(
+                dest['host'], port=dest_port, cache_dir=dest_dir, **kwargs
+            ))
+        self._ring = None
+        self._nodes = {}
+        self._shard_of = {}
+        if fanout == 'shard' and len(destinations) > 1:
+            for idx, dest in enumerate(destinations):
+                instance = dest.get('instance', None)
+                if instance is not None:
+                    instance = str(instance)
+                self._nodes[(str(dest['host']), instance)] = idx
+            self._ring = ConsistentHashRing(sorted(
+                self._nodes.keys(), key=lambda x: self._nodes[x]
+            ))
+        self._pool = None
+        if len(self._destinations) > 1:
+            self._pool = ThreadPool(len(self._destinations))
+            if DiskCache.has_data(cache_dir):
+                self._migrate_cache(cache_dir)
+
+    def _migrate_cache(self, cache_dir):
+        """
+        Move data cached in the top-level cache directory, from when there
+        was only one destination, into the destinations' own caches; all of
+        them when replicating, or each metric's shard when sharding. Each
+        chunk moved is committed in the old cache, and each segment removed
+        once all of its data has been moved, so an interrupted migration
+        resumes where it stopped (possibly caching the last chunk twice).
+
+        :param cache_dir: top-level cache directory
+        :type cache_dir: str
+        """
+        cache = DiskCache(directory=cache_dir)
+        logger.warning('Moving %d datapoints cached in %s into the caches of '
+                       '%d destinations', cache.depth()[2], cache_dir,
+                       len(self._destinations))
+        try:
+            for seg in cache.segments():
+                chunks = cache.read_chunks(
+                    seg, max_lines=10000, max_bytes=1048576
+                )
+                try:
+                    for data, offset in chunks:
+                        for dest, part in self._split_cached(data):
+                            dest.append_cache(part)
+                        cache.commit(seg, offset, points=data.count('\n'))
+                finally:
+                    chunks.close()
+                cache.discard(seg)
+        finally:
+            cache.close()
+
+    def _split_cached(self, data):
+        """
+        Split cached plaintext protocol data into the data to cache for each
+        destination. Cached metric names already include the prefix.
+
+        :param data: newline-terminated plaintext protocol data
+        :type data: str
+        :return: list of (GraphiteDestination, data) 2-tuples
+        :rtype: ``list``
+        """
+        if self._ring is None:
+            return [(dest, data) for dest in self._destinations]
+        shards = [[] for _ in self._destinations]
+        for line in data.splitlines(True):
+            node = self._ring.get_node(line.split(' ', 1)[0])
+            shards[self._nodes[node]].append(line)
+        return [
+            (self._destinations[idx], ''.join(lines))
+            for idx, lines in enumerate(shards) if len(lines) > 0
+        ]
+
+    def _shard(self, name):
+        """
+        Return the index of the destination that a metric is sharded to, by
+        consistent hashing of its full path. The result is cached for each
+        metric name.
+
+        :param name: metric name
+        :type name: str
+        :return: index of the destination in ``self._destinations``
+        :rtype: int
+        """
+        if len(self._shard_of) > 100000:
+            self._shard_of.clear()
+        path = name
+        if self._metric_prefix:
+            path = '%s.%s' % (self._metric_prefix, name)
+        idx = self._shard_of[name] = self._nodes[self._ring.get_node(path)]
+        return idx
+
+    def _batches(self, data_list):
+        """
+        Split a data list into the data to send to each destination.
+
+        :param data_list: list of 3-tuples:
+          (metric name, value, integer timestamp)
+        :type data_list: ``list``
+        :return: list of (GraphiteDestination, data list) 2-tuples
+        :rtype: ``list``
+        """
+        if self._ring is None:
+            return [(dest, data_list) for dest in self._destinations]
+        shards = [[] for _ in self._destinations]
+        shard_of = self._shard_of
+        for t in data_list:
+            idx = shard_of.get(t[0])
+            if idx is None:
+                idx = self._shard(t[0])
+            shards[idx].append(t)
+        return [
+            (self._destinations[idx], shard)
+            for idx, shard in enumerate(shards) if len(shard) > 0
+        ]
 
     def send_data(self, data_list):
         """
@@ -155,12 +1840,54 @@ class CachingGraphiteClient(object):
           (metric name, value, integer timestamp)
         :type data_list: ``list``
         """
-        data_s = self._graphite_str(data_list)
-        res = self._graphite_send(data_s)
-        if res:
-            logger.info('Successfully sent data to Graphite')
-            self._flush_cache()
+        if self._udp_re is not None:
+            udp_list = []
+            tcp_list = []
+            for t in data_list:
+                if self._udp_re.match(t[0]):
+                    udp_list.append(t)
+                else:
+                    tcp_list.append(t)
+            for dest, batch in self._batches(udp_list):
+                dest.send_udp(batch)
+            data_list = tcp_list
+            if len(data_list) == 0:
+                return
+        batches = self._batches(data_list)
+        if self._queued:
+            for dest, batch in batches:
+                dest.enqueue(batch)
+            return
+        if len(batches) == 1 or self._pool is None:
+            for dest, batch in batches:
+                dest.send(batch)
             return
-        # sending failed
-        logger.error('Sending data to Graphite failed; caching on disk.')
-        self._cache_data(data_s)
+        self._pool.map(lambda b: b[0].send(b[1]), batches)
+
+    def self_metrics(self, ts):
+        """
+        Return metrics about the client itself, as a data list of metric
+        3-tuples (name, value, timestamp). With multiple destinations, the
+        metric group names are qualified with each destination's name.
+
+        :param ts: data timestamp
+        :type ts: int
+        :return: data list of metric 3-tuples (name, value, timestamp)
+        :rtype: ``list``
+        """
+        if len(self._destinations) == 1:
+            return self._destinations[0].self_metrics(ts)
+        res = []
+        for dest in self._destinations:
+            res.extend(dest.self_metrics(ts, qualifier='.' + dest.name))
+        return res
+
+    def close(self):
+        """
+        Close all destinations.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        for dest in self._destinations:
+            dest.close()
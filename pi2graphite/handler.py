@@ -36,10 +36,12 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 """
 
 import logging
+import os
 from datetime import datetime, timedelta
-from time import sleep
+from time import sleep, time
 
 from pi2graphite.graphiteclient import CachingGraphiteClient
+from pi2graphite.utils import process_rss
 from pi2graphite.wifi_collector import WifiCollector
 from pi2graphite.onewire_collector import OneWireCollector
 
@@ -59,9 +61,41 @@ class MetricsHandler(object):
         self._config = config
         self._poll_delta = timedelta(seconds=config.polling_interval)
         self._graphite = CachingGraphiteClient(
-            self._config.graphite_host,
             port=self._config.graphite_port,
-            metric_prefix=self._config.metric_prefix
+            metric_prefix=self._config.metric_prefix,
+            destinations=self._config.graphite_destinations,
+            fanout=self._config.graphite_fanout,
+            protocol=self._config.graphite_protocol,
+            pickle_batch_size=self._config.graphite_pickle_batch_size,
+            cache_dir=self._config.cache_dir,
+            cache_segment_bytes=self._config.cache_segment_bytes,
+            cache_max_bytes=self._config.cache_max_bytes,
+            cache_max_age=self._config.cache_max_age,
+            cache_downsample_at=self._config.cache_downsample_at,
+            cache_downsample_factor=self._config.cache_downsample_factor,
+            cache_downsample_method=self._config.cache_downsample_method,
+            cache_compress=self._config.cache_compress,
+            replay_chunk_lines=self._config.cache_replay_chunk_lines,
+            replay_chunk_bytes=self._config.cache_replay_chunk_bytes,
+            replay_chunk_delay=self._config.cache_replay_chunk_delay,
+            replay_points_per_sec=self._config.cache_replay_points_per_sec,
+            replay_bytes_per_sec=self._config.cache_replay_bytes_per_sec,
+            replay_jitter=self._config.cache_replay_jitter,
+            failure_threshold=self._config.graphite_failure_threshold,
+            retry_backoff=self._config.graphite_retry_backoff,
+            retry_backoff_max=self._config.graphite_retry_backoff_max,
+            udp_patterns=self._config.graphite_udp_patterns,
+            udp_port=self._config.graphite_udp_port,
+            udp_max_datagram=self._config.graphite_udp_max_datagram,
+            queue_max_points=self._config.graphite_queue_max_points,
+            queue_retry_delay=self._config.graphite_queue_retry_delay,
+            max_lines_per_write=self._config.graphite_max_lines_per_write,
+            max_bytes_per_write=self._config.graphite_max_bytes_per_write,
+            connect_timeout=self._config.graphite_connect_timeout,
+            send_timeout=self._config.graphite_send_timeout,
+            tcp_nodelay=self._config.graphite_tcp_nodelay,
+            send_buffer_bytes=self._config.graphite_send_buffer_bytes,
+            dns_cache_ttl=self._config.graphite_dns_cache_ttl
         )
         try:
             self._1wire = OneWireCollector(self._config)
@@ -70,15 +104,64 @@ class MetricsHandler(object):
             self._1wire = None
         if self._config.send_wifi_metrics:
             self._wifi_collector = WifiCollector()
+        # collector name to 2-tuple of (poll duration, datapoints) for the
+        # most recent poll
+        self._poll_stats = {}
+        # seconds the most recent poll started after it was due
+        self._loop_lag = 0.0
 
     def _poll_and_send(self):
         """
         Run one iteration of metrics polling and sending.
         """
         logger.info('Polling...')
+        start = time()
         data = self.do_poll()
+        if self._config.send_self_metrics:
+            ts = int(time())
+            data.extend(self.self_metrics(ts, time() - start, len(data)))
+            data.extend(self._graphite.self_metrics(ts))
         self._graphite.send_data(data)
 
+    def self_metrics(self, ts, poll_time, points):
+        """
+        Return metrics about the daemon itself; the duration of and number
+        of datapoints from the last poll of each collector and in total, how
+        late the last poll started, and process RSS and CPU time. Return them
+        as a data list of metric 3-tuples (name, value, timestamp).
+
+        :param ts: data timestamp
+        :type ts: int
+        :param poll_time: seconds the whole poll took
+        :type poll_time: float
+        :param points: number of datapoints the whole poll returned
+        :type points: int
+        :return: data list of metric 3-tuples (name, value, timestamp)
+        :rtype: ``list``
+        """
+        res = []
+        for name in sorted(self._poll_stats.keys()):
+            duration, count = self._poll_stats[name]
+            res.extend([
+                ('pi2graphite.poll.%s.duration_sec' % name,
+                 round(duration, 6), ts),
+                ('pi2graphite.poll.%s.points' % name, count, ts)
+            ])
+        res.extend([
+            ('pi2graphite.loop.poll_sec', round(poll_time, 6), ts),
+            ('pi2graphite.loop.points', points, ts),
+            ('pi2graphite.loop.lag_sec', round(self._loop_lag, 6), ts)
+        ])
+        rss = process_rss()
+        if rss is not None:
+            res.append(('pi2graphite.process.rss_bytes', rss, ts))
+        times = os.times()
+        res.extend([
+            ('pi2graphite.process.cpu_user_sec', round(times[0], 3), ts),
+            ('pi2graphite.process.cpu_system_sec', round(times[1], 3), ts)
+        ])
+        return res
+
     def do_poll(self):
         """
         Do a single metrics poll. Return the result data as a list of 3-tuples,
@@ -88,30 +171,58 @@ class MetricsHandler(object):
         :rtype: tuple
         """
         results = []
+        start = time()
         try:
-            self._1wire = OneWireCollector(self._config)
+            if self._1wire is None:
+                self._1wire = OneWireCollector(self._config)
             results.extend(self._1wire.poll())
         except Exception:
             logger.error('Exception polling OneWire', exc_info=True)
-            self._1wire = None
+            self._close_1wire()
+        self._poll_stats['onewire'] = (time() - start, len(results))
         if self._config.send_wifi_metrics:
-            results.extend(self._wifi_collector.poll())
+            start = time()
+            wifi = self._wifi_collector.poll()
+            self._poll_stats['wifi'] = (time() - start, len(wifi))
+            results.extend(wifi)
         return results
 
+    def _close_1wire(self):
+        """
+        Close and discard the OneWireCollector, if any, so that a new one is
+        created on the next poll.
+        """
+        if self._1wire is None:
+            return
+        try:
+            self._1wire.close()
+        except Exception:
+            logger.error('Exception closing OneWireCollector', exc_info=True)
+        self._1wire = None
+
     def run(self):
         """
         Enter the main metrics polling loop.
         """
         logger.info('Entering main loop')
-        while True:
-            start = datetime.now()
-            self._poll_and_send()
-            poll_len = datetime.now() - start
-            if poll_len > self._poll_delta:
-                logger.info('Poll took longer than configured interval '
-                            '(interval=%s, poll took %s)',
-                            self._poll_delta, poll_len)
-            else:
-                s = (self._poll_delta - poll_len).total_seconds()
-                logger.debug('Sleeping %s seconds until next poll', s)
-                sleep(s)
+        due = None
+        try:
+            while True:
+                start = datetime.now()
+                if due is not None:
+                    self._loop_lag = max(0, (start - due).total_seconds())
+                due = start + self._poll_delta
+                self._poll_and_send()
+                poll_len = datetime.now() - start
+                if poll_len > self._poll_delta:
+                    logger.info('Poll took longer than configured interval '
+                                '(interval=%s, poll took %s)',
+                                self._poll_delta, poll_len)
+                else:
+                    s = (self._poll_delta - poll_len).total_seconds()
+                    logger.debug('Sleeping %s seconds until next poll', s)
+                    sleep(s)
+        finally:
+            self._close_1wire()
+            # cache anything still queued for sending
+            self._graphite.close()
@@ -36,18 +36,173 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 """
 
 import logging
+import os
+import threading
 import time
+from glob import glob
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from w1thermsensor import W1ThermSensor
 
+from pi2graphite.dirwatch import DirectoryWatcher
+
 logger = logging.getLogger(__name__)
 
+if hasattr(os, 'pread'):
+    def _pread(fd, size):
+        return os.pread(fd, size, 0)
+else:  # python < 3.3
+    def _pread(fd, size):
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class SensorReadError(Exception):
+    """
+    Raised when a sensor's ``w1_slave`` file doesn't hold a valid reading.
+    """
+    pass
+
+
+def parse_w1_slave(data):
+    """
+    Parse the contents of a w1_therm sensor's ``w1_slave`` file, i.e.::
+
+        72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        72 01 4b 46 7f ff 0e 10 57 t=23125
+
+    and return the temperature in millidegrees Celsius.
+
+    :param data: ``w1_slave`` file contents
+    :type data: bytes
+    :return: temperature in millidegrees Celsius
+    :rtype: int
+    :raises: :py:exc:`~.SensorReadError` if the CRC check failed or there's
+      no temperature
+    """
+    eol = data.find(b'\n')
+    if eol < 3 or data[eol - 3:eol] != b'YES':
+        raise SensorReadError('CRC check failed: %r' % data)
+    pos = data.find(b't=', eol)
+    if pos < 0:
+        raise SensorReadError('No temperature: %r' % data)
+    end = data.find(b'\n', pos)
+    if end < 0:
+        end = len(data)
+    try:
+        return int(data[pos + 2:end])
+    except ValueError:
+        raise SensorReadError('Invalid temperature: %r' % data)
+
+
+class SysfsSensor(object):
+    """
+    A 1-Wire temperature sensor read directly from its ``w1_slave`` file in
+    sysfs, bypassing w1thermsensor. The file is opened on the first read and
+    kept open; each read rereads it from the start, which makes the kernel
+    take a new reading. Has the same ``slave_prefix`` and ``id`` attributes
+    as ``w1thermsensor.core.W1ThermSensor``.
+    """
+
+    def __init__(self, base_dir, dirname):
+        """
+        :param base_dir: 1-Wire devices directory, i.e. /sys/bus/w1/devices
+        :type base_dir: str
+        :param dirname: sensor directory name under ``base_dir``
+        :type dirname: str
+        """
+        self.slave_prefix = dirname[:3]
+        self.id = dirname[3:]
+        self.path = os.path.join(base_dir, dirname, 'w1_slave')
+        self._fd = None
+
+    def __repr__(self):
+        return '<SysfsSensor %s%s>' % (self.slave_prefix, self.id)
+
+    def read_millicelsius(self):
+        """
+        Read the sensor, and return the temperature in millidegrees Celsius.
+        On any error the file is closed, to be reopened on the next read, in
+        case the sensor was removed and re-added.
+
+        :return: temperature in millidegrees Celsius
+        :rtype: int
+        """
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            # w1_slave is two lines of under 40 characters each
+            return parse_w1_slave(_pread(self._fd, 256))
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Close the ``w1_slave`` file, if open.
+        """
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
 
 class OneWireCollector(object):
 
     def __init__(self, config):
-        self._1w = W1ThermSensor()
         self._config = config
+        self._threads = config.onewire_read_threads
+        self._timeout = config.onewire_sensor_timeout
+        # thread pool for concurrent reads; created on first use
+        self._pool = None
+        self._bulk_read = config.onewire_bulk_read
+        self._native = config.onewire_reader == 'sysfs'
+        # W1ThermSensor() scans the bus, and raises if it finds no sensors
+        self._1w = None if self._native else W1ThermSensor()
+        # sensor directory name to SysfsSensor, when using the sysfs reader
+        self._handles = {}
+        self._rescan_interval = config.onewire_rescan_interval
+        # sensors found by the last scan of the bus, or None to rescan on
+        # the next poll
+        self._sensors = None
+        self._scanned = 0
+        # sensor directory name to metric name
+        self._names = {}
+        # protects _sensors, which the watcher thread updates
+        self._lock = threading.Lock()
+        self._watcher = None
+        interval = config.onewire_hotplug_interval
+        if interval > 0:
+            try:
+                self._watcher = DirectoryWatcher(
+                    W1ThermSensor.BASE_DIRECTORY, self._sensors_changed,
+                    interval=interval
+                )
+                self._watcher.start()
+            except Exception:
+                logger.error('Unable to watch for 1wire sensors being added '
+                             'or removed', exc_info=True)
+                self._watcher = None
+
+    def close(self):
+        """
+        Stop watching for sensors being added or removed, shut down the read
+        thread pool, and close any open sensor files. Reads still hung in the
+        kernel can't be interrupted; their threads exit when they return.
+        """
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = {}
 
     def poll(self):
         """
@@ -57,18 +212,297 @@ class OneWireCollector(object):
         :rtype: ``list``
         """
         logger.info('Polling w1')
-        ts = int(time.time())
-        stats = []
+        start = time.time()
+        ts = int(start)
+        sensors = self._get_sensors(start)
+        if self._bulk_read and sensors:
+            self._bulk_convert()
+        if self._threads > 1 and len(sensors) > 1:
+            stats = self._poll_parallel(sensors, ts)
+        else:
+            stats = []
+            for sensor in sensors:
+                try:
+                    stats.extend(self._poll_sensor(sensor, ts))
+                except Exception:
+                    logger.error('Error polling sensor %s', sensor,
+                                 exc_info=True)
+                    self._sensors = None
+        logger.info('Polled %d 1wire sensors in %.3f seconds', len(sensors),
+                    time.time() - start)
+        return stats
+
+    def _get_sensors(self, now):
+        """
+        Return the list of sensors to poll. The bus is only rescanned every
+        ``rescanInterval`` seconds, or on the poll after one where a sensor
+        couldn't be read (i.e. it may have been removed or replaced).
+        Between rescans, sensors being added or removed are picked up by
+        :py:meth:`~._sensors_changed`.
+
+        :param now: current time
+        :type now: float
+        :return: the sensors to poll
+        :rtype: ``list`` of ``w1thermsensor.core.W1ThermSensor``
+        """
+        with self._lock:
+            if (
+                self._sensors is not None and
+                now - self._scanned < self._rescan_interval
+            ):
+                return self._sensors
+            try:
+                sensors = self._scan()
+            except Exception:
+                logger.error("Unable to list 1wire sensors", exc_info=True)
+                self._sensors = None
+                return []
+            for sensor in sensors:
+                self._resolve_name(self._dirname(sensor))
+            logger.debug('Found %d 1wire sensors', len(sensors))
+            self._sensors = sensors
+            self._scanned = now
+            return sensors
+
+    def _scan(self):
+        """
+        List the sensors on the bus.
+
+        :return: the sensors on the bus
+        :rtype: ``list`` of ``w1thermsensor.core.W1ThermSensor`` or
+          :py:class:`~.SysfsSensor`
+        """
+        if not self._native:
+            return self._1w.get_available_sensors()
+        found = [
+            d for d in sorted(os.listdir(W1ThermSensor.BASE_DIRECTORY))
+            if self._is_sensor_dir(d)
+        ]
+        for dirname in set(self._handles) - set(found):
+            self._handles.pop(dirname).close()
+        return [self._handle(dirname) for dirname in found]
+
+    def _handle(self, dirname):
+        """
+        Return the :py:class:`~.SysfsSensor` for a sensor, reusing the
+        existing one (and its open file) if there is one.
+
+        :param dirname: directory name under /sys/bus/w1/devices/
+        :type dirname: str
+        :return: the sensor
+        :rtype: :py:class:`~.SysfsSensor`
+        """
+        if dirname not in self._handles:
+            self._handles[dirname] = SysfsSensor(
+                W1ThermSensor.BASE_DIRECTORY, dirname)
+        return self._handles[dirname]
+
+    @staticmethod
+    def _is_sensor_dir(dirname):
+        """
+        Return whether or not a 1-Wire devices directory entry is a
+        temperature sensor supported by w1thermsensor.
+
+        :param dirname: directory name under /sys/bus/w1/devices/
+        :type dirname: str
+        :rtype: bool
+        """
+        return (
+            dirname[2:3] == '-' and
+            dirname[:2] in W1ThermSensor.RESOLVE_TYPE_STR
+        )
+
+    def _sensors_changed(self, added, removed):
+        """
+        Callback for :py:class:`~pi2graphite.dirwatch.DirectoryWatcher`;
+        update the cached sensor list when entries are added to or removed
+        from the 1-Wire devices directory.
+
+        :param added: names of directory entries added
+        :type added: set
+        :param removed: names of directory entries removed
+        :type removed: set
+        """
+        with self._lock:
+            if self._sensors is None:
+                # the next poll rescans the bus anyway
+                return
+            kept = [
+                s for s in self._sensors if self._dirname(s) not in removed
+            ]
+            for dirname in removed:
+                if dirname in self._handles:
+                    self._handles.pop(dirname).close()
+            new = [self._new_sensor(dirname) for dirname in sorted(added)]
+            new = [s for s in new if s is not None]
+            if len(kept) == len(self._sensors) and not new:
+                return
+            self._sensors = kept + new
+            logger.info('1wire sensors changed; now polling %d sensors',
+                        len(self._sensors))
+
+    def _new_sensor(self, dirname):
+        """
+        Return a sensor for a newly-added 1-Wire devices directory entry.
+
+        :param dirname: directory name under /sys/bus/w1/devices/
+        :type dirname: str
+        :return: the sensor, or None if the entry isn't a supported sensor
+        :rtype: ``w1thermsensor.core.W1ThermSensor`` or
+          :py:class:`~.SysfsSensor`
+        """
+        if not self._is_sensor_dir(dirname):
+            return None
         try:
-            sensors = self._1w.get_available_sensors()
+            if self._native:
+                sensor = self._handle(dirname)
+                if not os.path.exists(sensor.path):
+                    raise SensorReadError('%s does not exist' % sensor.path)
+            else:
+                sensor = W1ThermSensor(
+                    W1ThermSensor.RESOLVE_TYPE_STR[dirname[:2]], dirname[3:]
+                )
         except Exception:
-            logger.error("Unable to list 1wire sensors", exc_info=True)
-            return []
-        for sensor in sensors:
+            logger.warning('Unable to add 1wire sensor %s', dirname,
+                           exc_info=True)
+            return None
+        self._resolve_name(dirname)
+        logger.info('Found new 1wire sensor %s', dirname)
+        return sensor
+
+    def _resolve_name(self, dirname):
+        """
+        Look up and cache the metric name for a sensor, if not already
+        cached.
+
+        :param dirname: directory name under /sys/bus/w1/devices/
+        :type dirname: str
+        """
+        if dirname not in self._names:
+            self._names[dirname] = self._config.metric_name_for_sensor(dirname)
+
+    @staticmethod
+    def _dirname(sensor):
+        """
+        Return the directory name under /sys/bus/w1/devices/ of a sensor.
+
+        :param sensor: the sensor
+        :type sensor: ``w1thermsensor.core.W1ThermSensor``
+        :return: sensor directory name
+        :rtype: str
+        """
+        return '%s%s' % (sensor.slave_prefix, sensor.id)
+
+    def _bulk_convert(self):
+        """
+        Start a temperature conversion on every sensor of every bus master
+        that supports it (``therm_bulk_read``, Linux 5.10+), and wait for the
+        conversions to finish. Sensors on those buses then return the
+        converted temperature immediately when read, instead of each doing
+        their own conversion of up to 750ms. Sensors on buses without bulk
+        read support are unaffected, and do a conversion when read as usual.
+        """
+        paths = glob(os.path.join(
+            W1ThermSensor.BASE_DIRECTORY, 'w1_bus_master*', 'therm_bulk_read'
+        ))
+        pending = []
+        for path in sorted(paths):
             try:
-                stats.extend(self._poll_sensor(sensor, ts))
-            except Exception:
-                logger.error('Error polling sensor %s', sensor, exc_info=True)
+                with open(path, 'w') as fh:
+                    fh.write('trigger\n')
+                pending.append(path)
+            except (IOError, OSError):
+                logger.warning('Unable to trigger bulk conversion via %s; '
+                               'sensors on this bus will be read one at a '
+                               'time', path, exc_info=True)
+        if not pending:
+            logger.debug('No 1wire bus masters support bulk conversion')
+            return
+        logger.debug('Triggered bulk conversion via: %s', pending)
+        deadline = time.time() + self._timeout
+        while pending and time.time() < deadline:
+            # -1 while any sensor on the bus is still converting
+            pending = [p for p in pending if self._bulk_status(p) == -1]
+            if pending:
+                time.sleep(0.05)
+        if pending:
+            logger.warning('Bulk conversion not complete after %s seconds '
+                           'on: %s', self._timeout, pending)
+
+    def _bulk_status(self, path):
+        """
+        Return the status of a bus master's bulk conversion; -1 while any
+        sensor is still converting, 1 when conversions are complete but some
+        sensors haven't been read yet, 0 when there is nothing pending.
+        Errors are treated as nothing pending.
+
+        :param path: path to the bus master's ``therm_bulk_read`` file
+        :type path: str
+        :return: bulk conversion status
+        :rtype: int
+        """
+        try:
+            with open(path, 'r') as fh:
+                return int(fh.read().strip())
+        except (IOError, OSError, ValueError):
+            logger.debug('Unable to read %s', path, exc_info=True)
+            return 0
+
+    def _poll_parallel(self, sensors, ts):
+        """
+        Poll sensors concurrently, in a pool of ``readThreads`` threads kept
+        for the life of the collector. A sensor that hasn't returned a
+        reading ``sensorTimeout`` seconds after its read started is skipped.
+        As reads that hang can't be interrupted, and keep their thread busy
+        (including into later polls), any sensor whose read hasn't even
+        started by the time every round of reads should have finished is
+        skipped too. Hung reads therefore never hold up a poll for longer
+        than that, and never tie up more than ``readThreads`` threads.
+
+        :param sensors: the sensors to poll
+        :type sensors: ``list`` of ``w1thermsensor.core.W1ThermSensor``
+        :param ts: data timestamp
+        :type ts: int
+        :return: data list of metric 3-tuples (name, value, timestamp)
+        :rtype: ``list``
+        """
+        threads = min(self._threads, len(sensors))
+        rounds = (len(sensors) + threads - 1) // threads
+        deadline = time.time() + self._timeout * rounds
+        started = {}
+
+        def read(idx, sensor):
+            started[idx] = time.time()
+            return self._poll_sensor(sensor, ts)
+
+        stats = []
+        if self._pool is None:
+            self._pool = ThreadPool(self._threads)
+        results = [
+            self._pool.apply_async(read, (idx, sensor))
+            for idx, sensor in enumerate(sensors)
+        ]
+        for idx, sensor in enumerate(sensors):
+            while True:
+                begun = started.get(idx)
+                if begun is not None:
+                    wait = begun + self._timeout - time.time()
+                else:
+                    # check back shortly to see if the read has started
+                    wait = min(0.05, deadline - time.time())
+                try:
+                    stats.extend(results[idx].get(max(0, wait)))
+                except TimeoutError:
+                    if begun is None and time.time() < deadline:
+                        continue
+                    logger.error('Timed out polling sensor %s after %s '
+                                 'seconds', sensor, self._timeout)
+                    self._sensors = None
+                except Exception:
+                    logger.error('Error polling sensor %s', sensor,
+                                 exc_info=True)
+                    self._sensors = None
+                break
         return stats
 
     def _poll_sensor(self, sensor, ts):
@@ -76,19 +510,25 @@ class OneWireCollector(object):
         Return stats for a single sensor.
 
         :param sensor: The sensor to return stats for
-        :type sensor: ``w1thermsensor.core.W1ThermSensor``
+        :type sensor: ``w1thermsensor.core.W1ThermSensor`` or
+          :py:class:`~.SysfsSensor`
         :param ts: data timestamp
         :type ts: int
         :return: data list of metric 3-tuples (name, value, timestamp)
         :rtype: ``list``
         """
-        dirname = '%s%s' % (sensor.slave_prefix, sensor.id)
-        name = self._config.metric_name_for_sensor(dirname)
+        dirname = self._dirname(sensor)
+        name = self._names.get(dirname, dirname)
         logger.debug('Polling sensor %s%s (metric name: %s)',
                      sensor.slave_prefix, sensor.id, name)
-        temps = sensor.get_temperatures([
-            W1ThermSensor.DEGREES_C,
-            W1ThermSensor.DEGREES_F])
+        if self._native:
+            # same conversions as w1thermsensor, from a single read
+            temp_c = sensor.read_millicelsius() * 0.001
+            temps = [temp_c, temp_c * 1.8 + 32.0]
+        else:
+            temps = sensor.get_temperatures([
+                W1ThermSensor.DEGREES_C,
+                W1ThermSensor.DEGREES_F])
         return [
             ('%s.temp_c' % name, temps[0], ts),
             ('%s.temp_f' % name, temps[1], ts)
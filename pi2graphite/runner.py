@@ -38,6 +38,7 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 import sys
 import argparse
 import logging
+import signal
 
 from pi2graphite.version import VERSION, PROJECT_URL
 from pi2graphite.config import Config
@@ -107,6 +108,22 @@ def set_log_level_format(level, format):
     logger.setLevel(level)
 
 
+def handle_sigterm(signum, frame):
+    """
+    Signal handler for SIGTERM, which systemd uses to stop the service. Raise
+    :py:exc:`SystemExit` so that :py:meth:`~.MetricsHandler.run` unwinds
+    normally and writes anything still queued for sending to the disk cache;
+    Python's default SIGTERM handling exits without doing so.
+
+    :param signum: signal number
+    :type signum: int
+    :param frame: current stack frame
+    :type frame: frame
+    """
+    logger.warning('Received signal %d; exiting', signum)
+    raise SystemExit(0)
+
+
 def main(args=None):
     """
     Main entry point
@@ -137,6 +154,7 @@ def main(args=None):
             set_log_info()
 
     handler = MetricsHandler(config)
+    signal.signal(signal.SIGTERM, handle_sigterm)
     handler.run()
 
 
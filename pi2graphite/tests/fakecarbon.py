@@ -0,0 +1,356 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+
+import logging
+import socket
+import select
+import struct
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+logger = logging.getLogger(__name__)
+
+
+class FakeCarbon(object):
+    """
+    In-process stand-in for a carbon line (plaintext) or pickle receiver,
+    listening on localhost, that records every datapoint it receives. Faults
+    can be switched on and off while it is running, with :py:meth:`~.fault`:
+
+    - ``refuse`` - stop listening and reset all open connections, so that
+      connection attempts are refused.
+    - ``slow`` - read at most ``read_bytes`` bytes every ``read_delay``
+      seconds from each connection.
+    - ``half_open`` - accept connections but never read from or close them,
+      like a peer that has gone away without the connection being torn down.
+    - ``reset`` - reset each connection as soon as it has sent
+      ``reset_after`` bytes since the fault was injected, discarding any
+      incomplete line or frame.
+    """
+
+    #: faults that can be injected
+    faults = ['refuse', 'slow', 'half_open', 'reset']
+
+    def __init__(self, protocol='plaintext', port=0):
+        """
+        Initialize FakeCarbon. Call :py:meth:`~.start` to start listening.
+
+        :param protocol: protocol to receive; "plaintext" or "pickle"
+        :type protocol: str
+        :param port: port to listen on; 0 for an ephemeral port
+        :type port: int
+        """
+        self._protocol = protocol
+        self.port = port
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener = None
+        self._thread = None
+        self._conns = []
+        self._fault = None
+        self._read_bytes = 1024
+        self._read_delay = 0.1
+        self._reset_after = 0
+        #: datapoints received, as 3-tuples (name, value, timestamp)
+        self.points = []
+        #: number of connections accepted
+        self.connections = 0
+        #: number of connections reset by the ``reset`` fault
+        self.resets = 0
+
+    def start(self):
+        """
+        Start listening, and set :py:attr:`~.port` to the port listened on.
+        """
+        self._listen()
+        self._thread = threading.Thread(
+            target=self._accept_loop, name='fake-carbon'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop listening and close all connections.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self._close_listener()
+        self._reset_all()
+
+    def _listen(self):
+        """
+        Open the listening socket, on the same port as before if we have
+        already listened once.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', self.port))
+        sock.listen(16)
+        self.port = sock.getsockname()[1]
+        self._listener = sock
+
+    def _close_listener(self):
+        """
+        Close the listening socket, if open.
+        """
+        if self._listener is None:
+            return
+        # shut down first; just closing it leaves it listening until any
+        # select() on it in the accept thread returns
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._listener.close()
+        self._listener = None
+
+    def _reset_all(self):
+        """
+        Reset all open connections.
+        """
+        with self._lock:
+            conns = self._conns
+            self._conns = []
+        for conn in conns:
+            self._reset(conn)
+
+    @staticmethod
+    def _reset(conn):
+        """
+        Close a connection with a TCP RST rather than a FIN.
+
+        :param conn: connection to reset
+        :type conn: socket.socket
+        """
+        try:
+            conn.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0)
+            )
+            conn.close()
+        except socket.error:
+            pass
+
+    def fault(self, fault=None, read_bytes=1024, read_delay=0.1,
+              reset_after=0):
+        """
+        Inject a fault, or clear it if ``fault`` is None.
+
+        :param fault: fault to inject; one of :py:attr:`~.faults`, or None
+        :type fault: str
+        :param read_bytes: for ``slow``, bytes to read at a time
+        :type read_bytes: int
+        :param read_delay: for ``slow``, seconds to wait between reads
+        :type read_delay: float
+        :param reset_after: for ``reset``, bytes to read from each
+          connection before resetting it
+        :type reset_after: int
+        """
+        if fault is not None and fault not in self.faults:
+            raise ValueError('fault must be one of %s' % self.faults)
+        logger.debug('FakeCarbon fault: %s', fault)
+        self._read_bytes = read_bytes
+        self._read_delay = read_delay
+        self._reset_after = reset_after
+        prev = self._fault
+        self._fault = fault
+        if fault == 'refuse':
+            self._close_listener()
+            self._reset_all()
+        elif prev == 'refuse':
+            self._listen()
+        elif prev == 'half_open':
+            # connections held open by the fault are dead to the client
+            self._reset_all()
+
+    def _accept_loop(self):
+        """
+        Accept connections and start a thread to read from each.
+        """
+        while not self._stop.is_set():
+            sock = self._listener
+            if sock is None:
+                time.sleep(0.05)
+                continue
+            try:
+                r, _, _ = select.select([sock], [], [], 0.05)
+                if len(r) == 0:
+                    continue
+                conn, _ = sock.accept()
+            except (socket.error, ValueError):
+                # the listener was closed out from under us
+                continue
+            with self._lock:
+                self._conns.append(conn)
+                self.connections += 1
+            t = threading.Thread(target=self._read_loop, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _read_loop(self, conn):
+        """
+        Read and parse data from a connection until it is closed.
+
+        :param conn: accepted connection
+        :type conn: socket.socket
+        """
+        buf = b''
+        received = 0
+        while not self._stop.is_set():
+            if self._fault == 'half_open':
+                time.sleep(0.05)
+                continue
+            try:
+                r, _, _ = select.select([conn], [], [], 0.05)
+                if len(r) == 0:
+                    continue
+                fault = self._fault
+                data = conn.recv(
+                    self._read_bytes if fault == 'slow' else 65536
+                )
+            except (socket.error, ValueError):
+                break
+            if len(data) == 0:
+                break
+            if fault != 'reset':
+                received = 0
+            elif received + len(data) >= \
+                    self._reset_after:
+                # whatever was buffered but not yet parsed is lost
+                buf += data[:max(0, self._reset_after - received)]
+                self._parse(buf)
+                with self._lock:
+                    self.resets += 1
+                    if conn in self._conns:
+                        self._conns.remove(conn)
+                self._reset(conn)
+                return
+            received += len(data)
+            buf = self._parse(buf + data)
+            if fault == 'slow':
+                time.sleep(self._read_delay)
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        conn.close()
+
+    def _parse(self, buf):
+        """
+        Parse all complete lines or pickle frames in ``buf``, recording their
+        datapoints, and return whatever is left over.
+
+        :param buf: received data
+        :type buf: bytes
+        :return: unparsed remainder of ``buf``
+        :rtype: bytes
+        """
+        points = []
+        if self._protocol == 'pickle':
+            while len(buf) >= 4:
+                length = struct.unpack('!L', buf[:4])[0]
+                if len(buf) < length + 4:
+                    break
+                for name, (ts, value) in pickle.loads(buf[4:length + 4]):
+                    if isinstance(name, bytes):
+                        name = name.decode('utf-8')
+                    points.append((name, float(value), int(ts)))
+                buf = buf[length + 4:]
+        else:
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                parts = line.decode('utf-8').split()
+                if len(parts) == 3:
+                    points.append(
+                        (parts[0], float(parts[1]), int(float(parts[2])))
+                    )
+        with self._lock:
+            self.points.extend(points)
+        return buf
+
+    def received(self, prefix=''):
+        """
+        Return the datapoints received so far whose names start with
+        ``prefix``.
+
+        :param prefix: metric name prefix to filter on
+        :type prefix: str
+        :return: list of 3-tuples (name, value, timestamp)
+        :rtype: ``list``
+        """
+        with self._lock:
+            return [p for p in self.points if p[0].startswith(prefix)]
+
+    def duplicates(self, prefix=''):
+        """
+        Return the number of datapoints received more than once for the same
+        metric name and timestamp, counting each extra copy.
+
+        :param prefix: metric name prefix to filter on
+        :type prefix: str
+        :return: number of duplicate datapoints
+        :rtype: int
+        """
+        points = self.received(prefix)
+        return len(points) - len(set((p[0], p[2]) for p in points))
+
+    def wait_for(self, count, prefix='', timeout=5):
+        """
+        Wait until at least ``count`` datapoints whose names start with
+        ``prefix`` have been received, or ``timeout`` seconds have passed.
+
+        :param count: number of datapoints to wait for
+        :type count: int
+        :param prefix: metric name prefix to filter on
+        :type prefix: str
+        :param timeout: maximum seconds to wait
+        :type timeout: float
+        :return: whether ``count`` datapoints were received
+        :rtype: bool
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            if len(self.received(prefix)) >= count:
+                return True
+            time.sleep(0.02)
+        return len(self.received(prefix)) >= count
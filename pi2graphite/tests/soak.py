@@ -0,0 +1,423 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import logging
+from copy import deepcopy
+
+from pi2graphite.config import Config
+from pi2graphite.handler import MetricsHandler
+from pi2graphite.tests.fakecarbon import FakeCarbon
+
+# https://code.google.com/p/mock/issues/detail?id=249
+# py>=3.4 should use unittest.mock not the mock package on pypi
+if (
+        sys.version_info[0] < 3 or
+        sys.version_info[0] == 3 and sys.version_info[1] < 4
+):
+    from mock import patch
+else:
+    from unittest.mock import patch
+
+FORMAT = "[%(asctime)s %(levelname)s] %(message)s"
+logging.basicConfig(level=logging.WARNING, format=FORMAT)
+logger = logging.getLogger()
+
+#: extra arguments to :py:meth:`~.FakeCarbon.fault` for each fault
+FAULT_ARGS = {
+    'slow': {'read_bytes': 256, 'read_delay': 0.05},
+    'reset': {'reset_after': 4096}
+}
+
+
+class FakeCollector(object):
+    """
+    Stand-in for :py:class:`~pi2graphite.onewire_collector.OneWireCollector`
+    returning one datapoint per fake sensor on each poll. Each poll uses the
+    timestamp after the previous poll's, so that every datapoint generated is
+    unique by name and timestamp, and losses and duplicates received by
+    carbon can be counted exactly however fast we poll.
+    """
+
+    def __init__(self, sensors=10):
+        self._sensors = sensors
+        self._ts = int(time.time())
+        #: total number of datapoints generated
+        self.generated = 0
+
+    def poll(self):
+        """
+        Poll. Return a data list of metric 3-tuples (name, value, timestamp)
+
+        :return: data list of metric 3-tuples (name, value, timestamp)
+        :rtype: ``list``
+        """
+        self._ts += 1
+        self.generated += self._sensors
+        return [
+            ('sensor%03d.temp_c' % i, 20.0 + i / 10.0, self._ts)
+            for i in range(self._sensors)
+        ]
+
+
+class Soak(object):
+    """
+    Soak test of :py:class:`~pi2graphite.handler.MetricsHandler` against a
+    :py:class:`~pi2graphite.tests.fakecarbon.FakeCarbon`, through repeated
+    simulated outages. Each cycle polls normally for a while, then injects a
+    fault for a while, then clears it and keeps polling until everything
+    queued and cached has been sent. For each cycle we record the peak cache
+    size during the outage, how long it took to recover and the replay
+    throughput; at the end, how many datapoints were lost or duplicated.
+
+    Some loss is expected: a send which the kernel accepted just before carbon
+    went away is not retried, so each outage loses about one poll's worth of
+    datapoints (e.g. 10 per cycle with ``-f refuse`` and 10 sensors).
+    """
+
+    def __init__(self, workdir, protocol='plaintext', sensors=10,
+                 interval=0.1, overrides=None):
+        """
+        :param workdir: directory for the config file and disk cache
+        :type workdir: str
+        :param protocol: Graphite protocol to use; "plaintext" or "pickle"
+        :type protocol: str
+        :param sensors: number of fake sensors to poll
+        :type sensors: int
+        :param interval: seconds between polls
+        :type interval: float
+        :param overrides: dict of config block name to dict of settings to
+          override in that block
+        :type overrides: dict
+        """
+        self._workdir = workdir
+        self._protocol = protocol
+        self._interval = interval
+        self._overrides = overrides or {}
+        self.carbon = FakeCarbon(protocol=protocol)
+        self.collector = FakeCollector(sensors)
+        self.handler = None
+        #: list of per-cycle result dicts
+        self.cycles = []
+
+    def _config(self):
+        """
+        Write a config file pointing at our FakeCarbon, and load it.
+
+        :return: loaded configuration
+        :rtype: :py:class:`~pi2graphite.config.Config`
+        """
+        conf = deepcopy(Config._example)
+        conf['graphite'].update({
+            'host': '127.0.0.1',
+            'port': self.carbon.port,
+            'metricPrefix': 'soak',
+            'protocol': self._protocol,
+            'retryBackoff': 1,
+            'retryBackoffMax': 5,
+            'queueRetryDelay': 0.5,
+            'connectTimeout': 1,
+            'sendTimeout': 2
+        })
+        conf['cache'].update({
+            'directory': os.path.join(self._workdir, 'cache'),
+            'replayChunkDelay': 0,
+            'replayJitter': 0
+        })
+        conf['send_wifi_metrics'] = False
+        conf['sensor_names'] = {}
+        conf['polling_interval'] = self._interval
+        for block, settings in self._overrides.items():
+            conf[block].update(settings)
+        path = os.path.join(self._workdir, 'config.json')
+        with open(path, 'w') as fh:
+            json.dump(conf, fh)
+        return Config(path)
+
+    def _stats(self):
+        """
+        Return the client's self-metrics summed across destinations, as a
+        dict keyed by (group, name); i.e. ``('cache', 'points')``.
+
+        :rtype: dict
+        """
+        res = {}
+        for name, value, _ in self.handler._graphite.self_metrics(0):
+            parts = name.split('.')
+            key = (parts[1], parts[-1])
+            res[key] = res.get(key, 0) + value
+        return res
+
+    def _backlog(self, stats):
+        """
+        Return the number of datapoints queued or cached but not yet sent.
+
+        :param stats: return value of :py:meth:`~._stats`
+        :type stats: dict
+        :rtype: int
+        """
+        return stats.get(('cache', 'points'), 0) + \
+            stats.get(('queue', 'points'), 0)
+
+    def _poll(self):
+        """
+        Poll and send once, then sleep for the rest of the interval. Stats
+        are taken at the end of the interval, once the sender thread has had
+        a chance to send what was just polled.
+
+        :return: return value of :py:meth:`~._stats`
+        :rtype: dict
+        """
+        start = time.time()
+        self.handler._poll_and_send()
+        time.sleep(max(0, self._interval - (time.time() - start)))
+        return self._stats()
+
+    def _poll_for(self, seconds):
+        """
+        Poll for ``seconds`` seconds, and return the peak cache size in bytes
+        and datapoints seen.
+
+        :return: 2-tuple of (peak cache bytes, peak cache datapoints)
+        :rtype: tuple
+        """
+        end = time.time() + seconds
+        peak_bytes = 0
+        peak_points = 0
+        while time.time() < end:
+            stats = self._poll()
+            peak_bytes = max(peak_bytes, stats.get(('cache', 'bytes'), 0))
+            peak_points = max(peak_points, self._backlog(stats))
+        return peak_bytes, peak_points
+
+    def _poll_until_drained(self, timeout):
+        """
+        Poll until nothing is left queued or cached, or ``timeout`` seconds
+        have passed.
+
+        :return: whether everything was sent
+        :rtype: bool
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            if self._backlog(self._poll()) == 0:
+                return True
+        return False
+
+    def _received(self):
+        """
+        Return the set of unique (name, timestamp) pairs of fake sensor
+        datapoints received by carbon.
+
+        :rtype: set
+        """
+        return set(
+            (p[0], p[2]) for p in self.carbon.received('soak.sensor')
+        )
+
+    def run(self, cycles=3, up=10, down=10, faults=None, recover_timeout=120):
+        """
+        Run the soak test.
+
+        :param cycles: number of outages to simulate
+        :type cycles: int
+        :param up: seconds to poll normally before each outage
+        :type up: float
+        :param down: seconds each outage lasts
+        :type down: float
+        :param faults: list of FakeCarbon faults to cycle through, one per
+          outage; defaults to all of them
+        :type faults: list
+        :param recover_timeout: maximum seconds to wait for the backlog to
+          be sent after each outage
+        :type recover_timeout: float
+        :return: summary dict of totals across all cycles
+        :rtype: dict
+        """
+        faults = faults or FakeCarbon.faults
+        self.carbon.start()
+        collector = self.collector
+        with patch('pi2graphite.handler.OneWireCollector',
+                   lambda config: collector):
+            self.handler = MetricsHandler(self._config())
+            lost = 0
+            dupes = 0
+            try:
+                for i in range(cycles):
+                    fault = faults[i % len(faults)]
+                    self._poll_for(up)
+                    logger.warning('Cycle %d: injecting fault %s', i, fault)
+                    self.carbon.fault(fault, **FAULT_ARGS.get(fault, {}))
+                    peak_bytes, peak_points = self._poll_for(down)
+                    flushed = self._stats().get(('cache', 'points_flushed'), 0)
+                    self.carbon.fault(None)
+                    start = time.time()
+                    recovered = self._poll_until_drained(recover_timeout)
+                    elapsed = time.time() - start
+                    replayed = self._stats().get(
+                        ('cache', 'points_flushed'), 0) - flushed
+                    prev_lost, prev_dupes = lost, dupes
+                    lost = self.collector.generated - len(self._received())
+                    dupes = self.carbon.duplicates('soak.sensor')
+                    self.cycles.append({
+                        'fault': fault,
+                        'peak_cache_bytes': peak_bytes,
+                        'peak_backlog_points': peak_points,
+                        'recovered': recovered,
+                        'recovery_sec': elapsed,
+                        'replayed_points': replayed,
+                        'replay_points_per_sec': (
+                            replayed / elapsed if elapsed > 0 else 0
+                        ),
+                        'lost_points': lost - prev_lost,
+                        'duplicate_points': dupes - prev_dupes
+                    })
+            finally:
+                self.handler._graphite.close()
+        # let carbon finish reading whatever is in flight
+        time.sleep(1)
+        self.carbon.stop()
+        generated = self.collector.generated
+        unique = len(self._received())
+        dupes = self.carbon.duplicates('soak.sensor')
+        return {
+            'generated': generated,
+            'received': unique,
+            'lost': generated - unique,
+            'duplicates': dupes,
+            'duplicate_rate': float(dupes) / unique if unique > 0 else 0.0
+        }
+
+
+def parse_args(argv):
+    """
+    Use Argparse to parse command-line arguments.
+
+    :param argv: list of arguments to parse (``sys.argv[1:]``)
+    :type argv: ``list``
+    :return: parsed arguments
+    :rtype: :py:class:`argparse.Namespace`
+    """
+    p = argparse.ArgumentParser(
+        description='Soak-test pi2graphite against a local fake carbon '
+                    'through simulated outages'
+    )
+    p.add_argument('-c', '--cycles', dest='cycles', type=int, default=4,
+                   help='number of outages to simulate (default: 4)')
+    p.add_argument('-u', '--up', dest='up', type=float, default=10,
+                   help='seconds to run normally before each outage '
+                        '(default: 10)')
+    p.add_argument('-d', '--down', dest='down', type=float, default=10,
+                   help='seconds each outage lasts (default: 10)')
+    p.add_argument('-f', '--faults', dest='faults', type=str,
+                   default=','.join(FakeCarbon.faults),
+                   help='comma-separated faults to cycle through (default: '
+                        '%s)' % ','.join(FakeCarbon.faults))
+    p.add_argument('-s', '--sensors', dest='sensors', type=int, default=50,
+                   help='number of fake sensors (default: 50)')
+    p.add_argument('-i', '--interval', dest='interval', type=float,
+                   default=0.1, help='seconds between polls (default: 0.1)')
+    p.add_argument('-p', '--protocol', dest='protocol', type=str,
+                   default='plaintext', choices=['plaintext', 'pickle'],
+                   help='Graphite protocol (default: plaintext)')
+    p.add_argument('-q', '--queue-max-points', dest='queue_max_points',
+                   type=int, default=None,
+                   help='override graphite queueMaxPoints; 0 to send '
+                        'synchronously and cache every failed send on disk')
+    p.add_argument('-k', '--keep', dest='keep', action='store_true',
+                   default=False,
+                   help='keep the working directory (config and cache)')
+    p.add_argument('-v', '--verbose', dest='verbose', action='count',
+                   default=0,
+                   help='verbose output. specify twice for debug-level output.')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run a soak test and print the results.
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.verbose > 1:
+        logger.setLevel(logging.DEBUG)
+    elif args.verbose == 1:
+        logger.setLevel(logging.INFO)
+    workdir = tempfile.mkdtemp(prefix='pi2graphite-soak-')
+    try:
+        overrides = {}
+        if args.queue_max_points is not None:
+            overrides['graphite'] = {'queueMaxPoints': args.queue_max_points}
+        soak = Soak(
+            workdir, protocol=args.protocol, sensors=args.sensors,
+            interval=args.interval, overrides=overrides
+        )
+        totals = soak.run(
+            cycles=args.cycles, up=args.up, down=args.down,
+            faults=args.faults.split(',')
+        )
+    finally:
+        if args.keep:
+            print('Working directory: %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+    print('%-10s %12s %12s %10s %10s %12s %8s %8s' % (
+        'fault', 'cache_bytes', 'backlog_pts', 'recover_s', 'replayed',
+        'replay_pt/s', 'lost', 'dupes'
+    ))
+    for c in soak.cycles:
+        print('%-10s %12d %12d %10.2f %10d %12.1f %8d %8d%s' % (
+            c['fault'], c['peak_cache_bytes'], c['peak_backlog_points'],
+            c['recovery_sec'], c['replayed_points'],
+            c['replay_points_per_sec'], c['lost_points'],
+            c['duplicate_points'],
+            '' if c['recovered'] else ' (did not recover)'
+        ))
+    print('generated=%d received=%d lost=%d duplicates=%d '
+          'duplicate_rate=%.4f' % (
+              totals['generated'], totals['received'], totals['lost'],
+              totals['duplicates'], totals['duplicate_rate']
+          ))
+
+
+if __name__ == "__main__":
+    main()
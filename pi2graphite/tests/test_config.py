@@ -35,6 +35,7 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 ##################################################################################
 """
 import sys
+import pytest
 from copy import deepcopy
 
 from pi2graphite.config import Config, InvalidConfigError
@@ -120,3 +121,129 @@ class TestConfig(object):
     def test_validate_ok(self):
         self.cls._config = deepcopy(self.cls._example)
         self.cls._validate_config()
+
+    def test_validate_bad_protocol(self):
+        self.cls._config = deepcopy(self.cls._example)
+        self.cls._config['graphite']['protocol'] = 'foo'
+        with pytest.raises(InvalidConfigError) as excinfo:
+            self.cls._validate_config()
+        assert exc_msg(excinfo.value) == 'Invalid Configuration File: ' \
+            'graphite protocol must be one of [\'plaintext\', \'pickle\']'
+
+    def test_graphite_port_defaults(self):
+        self.cls._config = {'graphite': {}}
+        assert self.cls.graphite_protocol == 'plaintext'
+        assert self.cls.graphite_port == 2003
+        self.cls._config = {'graphite': {'protocol': 'pickle'}}
+        assert self.cls.graphite_port == 2004
+        assert self.cls.graphite_pickle_batch_size == 500
+        self.cls._config = {'graphite': {'protocol': 'pickle', 'port': 1234}}
+        assert self.cls.graphite_port == 1234
+
+    def test_graphite_destinations_default(self):
+        self.cls._config = {'graphite': {'host': 'foo'}}
+        assert self.cls.graphite_destinations == [
+            {'host': 'foo', 'port': 2003, 'instance': None}
+        ]
+        assert self.cls.graphite_fanout == 'replicate'
+
+    def test_graphite_destinations(self):
+        self.cls._config = {'graphite': {
+            'protocol': 'pickle',
+            'fanout': 'shard',
+            'destinations': [
+                {'host': 'a'},
+                {'host': 'a', 'port': 2104, 'instance': 'b'}
+            ]
+        }}
+        self.cls._validate_config()
+        assert self.cls.graphite_destinations == [
+            {'host': 'a', 'port': 2004, 'instance': None},
+            {'host': 'a', 'port': 2104, 'instance': 'b'}
+        ]
+        assert self.cls.graphite_fanout == 'shard'
+
+    def test_validate_bad_fanout(self):
+        self.cls._config = deepcopy(self.cls._example)
+        self.cls._config['graphite']['fanout'] = 'foo'
+        with pytest.raises(InvalidConfigError) as excinfo:
+            self.cls._validate_config()
+        assert exc_msg(excinfo.value) == 'Invalid Configuration File: ' \
+            'graphite fanout must be one of [\'replicate\', \'shard\']'
+
+    def test_validate_bad_destinations(self):
+        self.cls._config = deepcopy(self.cls._example)
+        self.cls._config['graphite']['destinations'] = [{'port': 2003}]
+        with pytest.raises(InvalidConfigError) as excinfo:
+            self.cls._validate_config()
+        assert exc_msg(excinfo.value) == 'Invalid Configuration File: ' \
+            'each graphite destination must have a "host"'
+
+    def test_validate_duplicate_shard_destinations(self):
+        self.cls._config = deepcopy(self.cls._example)
+        self.cls._config['graphite']['fanout'] = 'shard'
+        self.cls._config['graphite']['destinations'] = [
+            {'host': 'a', 'port': 2003}, {'host': 'a', 'port': 2103}
+        ]
+        with pytest.raises(InvalidConfigError) as excinfo:
+            self.cls._validate_config()
+        assert exc_msg(excinfo.value) == 'Invalid Configuration File: ' \
+            'graphite destinations must have unique (host, instance) ' \
+            'pairs when sharding'
+        self.cls._config['graphite']['fanout'] = 'replicate'
+        self.cls._validate_config()
+
+    def test_graphite_socket_defaults(self):
+        self.cls._config = {'graphite': {}}
+        assert self.cls.graphite_max_lines_per_write == 1000
+        assert self.cls.graphite_max_bytes_per_write == 65536
+        assert self.cls.graphite_connect_timeout == 10
+        assert self.cls.graphite_send_timeout == 30
+        assert self.cls.graphite_tcp_nodelay is False
+        assert self.cls.graphite_send_buffer_bytes == 0
+        assert self.cls.graphite_dns_cache_ttl == 300
+        self.cls._config = {'graphite': {'sendTimeout': 60}}
+        assert self.cls.graphite_send_timeout == 60
+
+    def test_onewire_defaults(self):
+        self.cls._config = {}
+        assert self.cls.onewire_bulk_read is True
+        assert self.cls.onewire_hotplug_interval == 5
+        assert self.cls.onewire_read_threads == 1
+        assert self.cls.onewire_reader == 'w1thermsensor'
+        assert self.cls.onewire_rescan_interval == 300
+        assert self.cls.onewire_sensor_timeout == 10
+        self.cls._config = {
+            'onewire': {
+                'bulkRead': False, 'hotplugInterval': 0, 'readThreads': 4,
+                'reader': 'sysfs', 'rescanInterval': 0, 'sensorTimeout': 2.5
+            }
+        }
+        assert self.cls.onewire_bulk_read is False
+        assert self.cls.onewire_hotplug_interval == 0
+        assert self.cls.onewire_read_threads == 4
+        assert self.cls.onewire_reader == 'sysfs'
+        assert self.cls.onewire_rescan_interval == 0
+        assert self.cls.onewire_sensor_timeout == 2.5
+
+    def test_send_self_metrics(self):
+        self.cls._config = {}
+        assert self.cls.send_self_metrics is True
+        self.cls._config = {'send_self_metrics': False}
+        assert self.cls.send_self_metrics is False
+
+    def test_validate_bad_read_threads(self):
+        self.cls._config = deepcopy(self.cls._example)
+        self.cls._config['onewire']['readThreads'] = 0
+        with pytest.raises(InvalidConfigError) as excinfo:
+            self.cls._validate_config()
+        assert exc_msg(excinfo.value) == 'Invalid Configuration File: ' \
+            'onewire readThreads must be an integer of at least 1'
+
+    def test_validate_bad_reader(self):
+        self.cls._config = deepcopy(self.cls._example)
+        self.cls._config['onewire']['reader'] = 'foo'
+        with pytest.raises(InvalidConfigError) as excinfo:
+            self.cls._validate_config()
+        assert exc_msg(excinfo.value) == 'Invalid Configuration File: ' \
+            'onewire reader must be one of [\'w1thermsensor\', \'sysfs\']'
@@ -0,0 +1,206 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import pytest
+
+from pi2graphite.dirwatch import (
+    DirectoryWatcher, fs_type, EVENT_HEADER, IN_CREATE, IN_IGNORED
+)
+
+# https://code.google.com/p/mock/issues/detail?id=249
+# py>=3.4 should use unittest.mock not the mock package on pypi
+if (
+        sys.version_info[0] < 3 or
+        sys.version_info[0] == 3 and sys.version_info[1] < 4
+):
+    from mock import patch, call, Mock, DEFAULT  # noqa
+else:
+    from unittest.mock import patch, call, Mock, DEFAULT  # noqa
+
+pbm = 'pi2graphite.dirwatch'
+pb = '%s.DirectoryWatcher' % pbm
+
+
+def wait_for(func, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        if func():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestFsType(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mounts = os.path.join(self.tmpdir, 'mounts')
+        with open(self.mounts, 'w') as fh:
+            fh.write(
+                'rootfs / rootfs rw 0 0\n'
+                'sysfs /sys sysfs rw,nosuid 0 0\n'
+                'tmpfs /sys/fs/cgroup tmpfs ro 0 0\n'
+                'garbage\n'
+                '/dev/sda1 /mnt/my\\040disk ext4 rw 0 0\n'
+            )
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fs_type(self):
+        with patch('%s.os.path.realpath' % pbm) as mock_realpath:
+            mock_realpath.side_effect = lambda x: x
+            assert fs_type('/sys/bus/w1/devices', self.mounts) == 'sysfs'
+            assert fs_type('/sys', self.mounts) == 'sysfs'
+            assert fs_type('/sys/fs/cgroup/x', self.mounts) == 'tmpfs'
+            assert fs_type('/system', self.mounts) == 'rootfs'
+            assert fs_type('/mnt/my disk/a', self.mounts) == 'ext4'
+
+    def test_no_mounts(self):
+        assert fs_type('/', os.path.join(self.tmpdir, 'nope')) is None
+
+
+class TestDirectoryWatcher(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, 'a'))
+        self.changes = []
+        self.cls = DirectoryWatcher(
+            self.tmpdir, lambda a, r: self.changes.append((a, r)),
+            interval=0.05
+        )
+
+    def teardown(self):
+        self.cls.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_init(self):
+        assert self.cls._entries == set(['a'])
+        assert self.cls.mode is None
+        assert self.cls._wake_r is None
+        assert self.cls._wake_w is None
+
+    def test_check(self):
+        os.mkdir(os.path.join(self.tmpdir, 'b'))
+        os.rmdir(os.path.join(self.tmpdir, 'a'))
+        self.cls._check()
+        self.cls._check()
+        assert self.changes == [(set(['b']), set(['a']))]
+        assert self.cls._entries == set(['b'])
+
+    def test_check_callback_exception(self):
+        self.cls._callback = Mock(side_effect=RuntimeError('foo'))
+        os.mkdir(os.path.join(self.tmpdir, 'b'))
+        with patch('%s.logger' % pbm) as mock_logger:
+            self.cls._check()
+        assert self.cls._callback.mock_calls == [call(set(['b']), set())]
+        assert mock_logger.error.call_count == 1
+
+    def test_stop_not_started(self):
+        self.cls.stop()
+        self.cls.stop()
+        assert self.cls._wake_w is None
+
+    def test_start_stop_closes_pipe(self):
+        with patch('%s.fs_type' % pbm) as mock_fs_type:
+            mock_fs_type.return_value = 'sysfs'
+            self.cls.start()
+        wake_r, wake_w = self.cls._wake_r, self.cls._wake_w
+        os.fstat(wake_r)
+        self.cls.stop()
+        assert self.cls._wake_r is None
+        assert self.cls._wake_w is None
+        for fd in (wake_r, wake_w):
+            with pytest.raises(OSError):
+                os.fstat(fd)
+
+    def test_start_exception_closes_pipe(self):
+        with patch('%s.os.pipe' % pbm, wraps=os.pipe) as mock_pipe:
+            with patch('%s._inotify_watch' % pb) as mock_watch:
+                mock_watch.side_effect = RuntimeError('foo')
+                with pytest.raises(RuntimeError):
+                    self.cls.start()
+        assert len(mock_pipe.mock_calls) == 1
+        assert self.cls._wake_r is None
+        assert self.cls._wake_w is None
+        assert self.cls._thread is None
+
+    def test_poll(self):
+        with patch('%s.fs_type' % pbm) as mock_fs_type:
+            mock_fs_type.return_value = 'sysfs'
+            self.cls.start()
+        assert self.cls.mode == 'poll'
+        assert self.cls._fd is None
+        os.mkdir(os.path.join(self.tmpdir, 'b'))
+        assert wait_for(lambda: self.changes == [(set(['b']), set())])
+
+    def test_inotify(self):
+        self.cls.start()
+        if self.cls.mode != 'inotify':
+            return
+        os.mkdir(os.path.join(self.tmpdir, 'b'))
+        assert wait_for(lambda: self.changes == [(set(['b']), set())])
+        os.rmdir(os.path.join(self.tmpdir, 'a'))
+        assert wait_for(lambda: len(self.changes) == 2)
+        assert self.changes[1] == (set(), set(['a']))
+        start = time.time()
+        self.cls.stop()
+        assert time.time() - start < 1
+
+    def test_no_libc(self):
+        with patch('%s._libc' % pbm) as mock_libc:
+            with patch('%s.fs_type' % pbm) as mock_fs_type:
+                mock_libc.return_value = None
+                mock_fs_type.return_value = 'ext4'
+                assert self.cls._inotify_watch() is None
+
+    def test_read_events_ignored(self):
+        r, w = os.pipe()
+        self.cls._fd = r
+        # normally opened by start(); closed by stop() in teardown
+        self.cls._wake_r, self.cls._wake_w = os.pipe()
+        os.write(w, EVENT_HEADER.pack(1, IN_CREATE, 0, 4) + b'b\0\0\0')
+        os.write(w, EVENT_HEADER.pack(1, IN_IGNORED, 0, 0))
+        assert self.cls._read_events() is True
+        assert self.cls._fd is None
+        assert self.cls.mode == 'poll'
+        os.close(w)
@@ -0,0 +1,481 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/webhook2lambda2sqs>
+
+################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of webhook2lambda2sqs, also known as webhook2lambda2sqs.
+
+    webhook2lambda2sqs is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    webhook2lambda2sqs is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with webhook2lambda2sqs.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/webhook2lambda2sqs> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+################################################################################
+"""
+import os
+import sys
+import time
+import struct
+import zlib
+
+from pi2graphite.diskcache import DiskCache, SegmentEncoder, SegmentDecoder
+
+# https://code.google.com/p/mock/issues/detail?id=249
+# py>=3.4 should use unittest.mock not the mock package on pypi
+if (
+        sys.version_info[0] < 3 or
+        sys.version_info[0] == 3 and sys.version_info[1] < 4
+):
+    from mock import patch, call, Mock, DEFAULT  # noqa
+else:
+    from unittest.mock import patch, call, Mock, DEFAULT  # noqa
+
+pbm = 'pi2graphite.diskcache'
+
+
+class TestSegmentCodec(object):
+
+    def test_round_trip(self):
+        enc = SegmentEncoder()
+        dec = SegmentDecoder()
+        frames = [
+            enc.encode(b'pfx.a.temp 21.5 1000\npfx.b 2 1000\n'),
+            enc.encode(b'pfx.a.temp 21.75 1060\nbad line\n\npfx.b 3 990\n')
+        ]
+        res = []
+        for frame in frames:
+            length = struct.unpack('!I', frame[:4])[0]
+            assert len(frame) == length + 4
+            res.append(dec.decode(frame[4:]))
+        assert res == [
+            b'pfx.a.temp 21.5 1000\npfx.b 2 1000\n',
+            b'pfx.a.temp 21.75 1060\nbad line\npfx.b 3 990\n'
+        ]
+
+    def test_encoding(self):
+        enc = SegmentEncoder()
+        frame = enc.encode(b'pfx.a 1 1000\npfx.a 2 1060\n')
+        raw = zlib.decompressobj().decompress(frame[4:])
+        assert raw == b'=pfx.a\n0 1 1000\n0 2 60\n'
+
+    def test_encode_empty(self):
+        assert SegmentEncoder().encode(b'\n') == b''
+
+
+class TestDiskCache(object):
+
+    def test_init_creates_dir(self, tmpdir):
+        d = str(tmpdir.join('cache'))
+        DiskCache(directory=d)
+        assert os.path.isdir(d)
+
+    def test_append_read_commit(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\n')
+        cls.append('b 2 3\n')
+        assert cls.segments() == [1]
+        assert list(cls.read_chunks(1)) == [('a 1 2\nb 2 3\n', 12)]
+        cls.commit(1, 6)
+        assert cls.committed(1) == 6
+        assert list(cls.read_chunks(1)) == [('b 2 3\n', 12)]
+        # a new instance resumes from the checkpoint
+        cls2 = DiskCache(directory=str(tmpdir), compress=False)
+        assert list(cls2.read_chunks(1)) == [('b 2 3\n', 12)]
+
+    def test_commit_progress(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\nb 2 3\nc 3 4\n')
+        cls.commit(1, 6, points=1, lines=1)
+        assert tmpdir.join('000000000001.ckpt').read() == '6 1\n'
+        assert cls.progress(1) == (6, 1)
+        assert cls.committed(1) == 6
+        assert list(cls.read_chunks(1)) == [('c 3 4\n', 18)]
+        cls2 = DiskCache(directory=str(tmpdir), compress=False)
+        assert cls2.depth()[2] == 1
+        assert list(cls2.read_chunks(1)) == [('c 3 4\n', 18)]
+
+    def test_commit_progress_compressed(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir))
+        cls._frame_lines = 2
+        cls.append('a 1 2\nb 2 3\nc 3 4\n')
+        cls.close()
+        chunks = list(cls.read_chunks(1, max_lines=1))
+        assert [x[0] for x in chunks] == ['a 1 2\nb 2 3\n', 'c 3 4\n']
+        # two lines of the first frame and the start of the next one sent
+        cls.commit(1, len(cls._magic), points=2, lines=2)
+        assert list(cls.read_chunks(1)) == [('c 3 4\n', chunks[1][1])]
+        cls.commit(1, len(cls._magic), points=0, lines=3)
+        assert list(cls.read_chunks(1)) == []
+
+    def test_commit_all_removes_segment(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\n')
+        cls.commit(1, 3)
+        assert tmpdir.join('000000000001.ckpt').check()
+        cls.commit(1, 6)
+        assert cls.segments() == []
+        assert tmpdir.listdir() == []
+        cls.append('b 1 2\n')
+        assert cls.segments() == [2]
+
+    def test_has_data(self, tmpdir):
+        assert DiskCache.has_data(str(tmpdir.join('missing'))) is False
+        assert DiskCache.has_data(str(tmpdir)) is False
+        tmpdir.mkdir('a_2003').join('000000000001.seg').write('a 1 2\n')
+        assert DiskCache.has_data(str(tmpdir)) is False
+        tmpdir.join('1234.json').write('a 1 2\n')
+        assert DiskCache.has_data(str(tmpdir)) is True
+        tmpdir.join('1234.json').remove()
+        tmpdir.join('000000000003.seg').write('a 1 2\n')
+        assert DiskCache.has_data(str(tmpdir)) is True
+
+    def test_discard(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\nb 2 3\n')
+        cls.commit(1, 6, points=1)
+        cls.discard(1)
+        cls.discard(2)
+        assert cls.segments() == []
+        assert tmpdir.listdir() == []
+        assert cls.depth() == (0, 0, 0)
+
+    def test_rotation(self, tmpdir):
+        cls = DiskCache(
+            directory=str(tmpdir), segment_bytes=10, compress=False
+        )
+        cls.append('a 1 2\n')
+        cls.append('b 1 2\n')
+        cls.append('c 1 2\n')
+        assert cls.segments() == [1, 2]
+        assert list(cls.read_chunks(1)) == [('a 1 2\nb 1 2\n', 12)]
+        assert list(cls.read_chunks(2)) == [('c 1 2\n', 6)]
+
+    def test_read_ignores_partial_line(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\nb 1')
+        assert list(cls.read_chunks(1)) == [('a 1 2\n', 6)]
+
+    def corrupt_segments(self, tmpdir):
+        good = DiskCache(directory=str(tmpdir))
+        good.append('a 1 2\nb 1 3\n')
+        good.close()
+        seg = tmpdir.join('000000000001.seg').read_binary()
+        # flip two bytes in the first frame's zlib stream
+        hdr = len(DiskCache._magic) + 4
+        bad = bytearray(seg)
+        bad[hdr + 2] ^= 0xff
+        bad[hdr + 3] ^= 0xff
+        tmpdir.join('000000000002.seg').write_binary(bytes(bad))
+        tmpdir.join('000000000002.ckpt').write('0 1\n')
+        # a frame that decompresses, but to a malformed datapoint line
+        comp = zlib.compressobj()
+        payload = comp.compress(b'=a\n0 1\n') + comp.flush(zlib.Z_SYNC_FLUSH)
+        tmpdir.join('000000000003.seg').write_binary(
+            DiskCache._magic + struct.pack('!I', len(payload)) + payload
+        )
+        # invalid UTF-8 in a plaintext segment
+        tmpdir.join('000000000004.seg').write_binary(b'c 1 4\n\xff\xfe 1 5\n')
+
+    def test_scan_quarantines_damaged_segments(self, tmpdir):
+        self.corrupt_segments(tmpdir)
+        with patch('%s.logger' % pbm) as mock_logger:
+            cls = DiskCache(directory=str(tmpdir))
+        # the invalid line is skipped, and the rest of its segment kept
+        assert cls.segments() == [1, 4]
+        assert cls.depth()[2] == 3
+        assert list(cls.read_chunks(4)) == [('c 1 4\n', 13)]
+        assert sorted(x.basename for x in tmpdir.listdir()) == [
+            '000000000001.seg', '000000000002.bad', '000000000003.bad',
+            '000000000004.seg'
+        ]
+        assert len([
+            c for c in mock_logger.error.mock_calls
+            if c[1][0].startswith('Cache segment %s is damaged')
+        ]) == 2
+        cls.append('d 1 6\n')
+        assert cls.segments() == [1, 4, 5]
+        cls.commit(4, 13, points=1)
+        assert cls.segments() == [1, 5]
+        assert not tmpdir.join('000000000004.seg').check()
+
+    def damage_second_frame(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir))
+        cls._frame_lines = 2
+        cls.append('a 1 2\nb 1 3\nc 1 4\nd 1 5\n')
+        cls.append('e 1 6\n')
+        cls.close()
+        ends = [x[1] for x in cls.read_chunks(1, max_lines=1)]
+        assert len(ends) == 3
+        path = tmpdir.join('000000000001.seg')
+        data = bytearray(path.read_binary())
+        data[ends[0] + 6] ^= 0xff
+        data[ends[0] + 7] ^= 0xff
+        path.write_binary(bytes(data))
+        return ends[0]
+
+    def test_read_stops_at_damaged_frame(self, tmpdir):
+        end = self.damage_second_frame(tmpdir)
+        with patch('%s.logger' % pbm):
+            cls = DiskCache(directory=str(tmpdir))
+            assert cls.segments() == [1]
+            assert cls.depth()[2] == 2
+            assert list(cls.read_chunks(1)) == [('a 1 2\nb 1 3\n', end)]
+            cls.append('f 1 7\n')
+            cls.close()
+            # sending everything before the damage quarantines the segment
+            cls.commit(1, end, points=2)
+        assert cls.segments() == [2]
+        assert sorted(x.basename for x in tmpdir.listdir()) == [
+            '000000000001.bad', '000000000002.seg'
+        ]
+        assert list(cls.read_chunks(2)) == [('f 1 7\n', 36)]
+
+    def test_read_damage_after_committed(self, tmpdir):
+        end = self.damage_second_frame(tmpdir)
+        with patch('%s.logger' % pbm):
+            cls = DiskCache(directory=str(tmpdir))
+            cls.commit(1, end, points=2)
+        # the damaged segment was quarantined by the commit
+        assert cls.segments() == []
+        assert tmpdir.join('000000000001.bad').check()
+
+    def test_read_damage_after_progress(self, tmpdir):
+        self.damage_second_frame(tmpdir)
+        # both lines of the first frame sent, but not committed past it
+        tmpdir.join('000000000001.ckpt').write('%d 2\n' % len(DiskCache._magic))
+        with patch('%s.logger' % pbm):
+            cls = DiskCache(directory=str(tmpdir))
+        assert cls.segments() == []
+        assert tmpdir.join('000000000001.bad').check()
+
+    def test_read_damage_at_checkpoint(self, tmpdir):
+        end = self.damage_second_frame(tmpdir)
+        tmpdir.join('000000000001.ckpt').write('%d\n' % end)
+        with patch('%s.logger' % pbm):
+            cls = DiskCache(directory=str(tmpdir))
+        assert cls.segments() == []
+        assert tmpdir.join('000000000001.bad').check()
+        assert not tmpdir.join('000000000001.ckpt').check()
+        assert cls._reading == set()
+
+    def test_import_legacy(self, tmpdir):
+        tmpdir.join('200.json').write('b 1 200\n')
+        tmpdir.join('100.json').write('a 1 100\n')
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        assert cls.segments() == [1]
+        assert list(cls.read_chunks(1)) == [('a 1 100\nb 1 200\n', 16)]
+        assert not tmpdir.join('100.json').check()
+        assert not tmpdir.join('200.json').check()
+
+    def test_read_chunks_bounded(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\nb 1 2\nc 1 2\n')
+        cls.append('dddddddddddddddddd 1 2\ne 1 2\n')
+        assert list(cls.read_chunks(1, max_lines=2)) == [
+            ('a 1 2\nb 1 2\n', 12),
+            ('c 1 2\ndddddddddddddddddd 1 2\n', 41),
+            ('e 1 2\n', 47)
+        ]
+        assert list(cls.read_chunks(1, max_bytes=13)) == [
+            ('a 1 2\nb 1 2\n', 12),
+            ('c 1 2\n', 18),
+            ('dddddddddddddddddd 1 2\n', 41),
+            ('e 1 2\n', 47)
+        ]
+
+    def test_depth(self, tmpdir):
+        cls = DiskCache(
+            directory=str(tmpdir), segment_bytes=10, compress=False
+        )
+        cls.append('a 1 2\nb 1 2\n')
+        cls.append('c 1 2\n')
+        assert cls.depth() == (2, 18, 3)
+        cls.commit(1, 6, points=1)
+        assert cls.depth() == (2, 18, 2)
+        # a new instance counts unsent points on disk
+        cls2 = DiskCache(directory=str(tmpdir), compress=False)
+        assert cls2.depth() == (2, 18, 2)
+
+    def test_max_age(self, tmpdir):
+        cls = DiskCache(
+            directory=str(tmpdir), segment_bytes=5, max_age=60, compress=False
+        )
+        cls.append('a 1 2\n')
+        cls._index[1]['mtime'] = time.time() - 120
+        cls.append('b 1 2\n')
+        assert cls.segments() == [2]
+        assert cls.evicted_points == 1
+        assert cls.depth()[2] == 1
+
+    def test_downsample_avg(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False,
+                        segment_bytes=40, max_bytes=60, downsample_at=0.5)
+        cls.append('a 1 10\nb 5 10\na 3 20\nb 7 20\na 5 30\n')
+        cls.commit(1, 7, points=1)
+        cls.append('c 1 40\n')
+        # segment 1 is rotated out, then downsampled from its checkpoint
+        assert cls.segments() == [1]
+        assert list(cls.read_chunks(1)) == [
+            ('b 6.0 10\na 4.0 20\nc 1.0 40\n', 27)
+        ]
+        assert tmpdir.join('000000000001.ds').check()
+        assert not tmpdir.join('000000000001.ckpt').check()
+        assert cls.evicted_points == 2
+        assert cls.depth() == (1, 27, 3)
+
+    def test_downsample_nth(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False,
+                        segment_bytes=40, max_bytes=100, downsample_at=0.1,
+                        downsample_factor=3, downsample_method='nth')
+        cls.append('a 1 1\na 2 2\na 3 3\na 4 4\na 5 5\na 6 6\na 7 7\n')
+        cls.append('c 1 40\n')
+        assert list(cls.read_chunks(1)) == [
+            ('a 1.0 1\na 4.0 4\na 7.0 7\n', 24)
+        ]
+        # only downsampled once
+        cls.append('d 1 40\n')
+        assert list(cls.read_chunks(1)) == [
+            ('a 1.0 1\na 4.0 4\na 7.0 7\n', 24)
+        ]
+
+    def test_evict_over_max_bytes(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False,
+                        segment_bytes=12, max_bytes=20, downsample_factor=1)
+        cls.append('a 1 2\nb 1 2\n')
+        cls.append('c 1 2\nd 1 2\n')
+        cls.append('e 1 2\n')
+        assert cls.segments() == [2, 3]
+        assert cls.evicted_points == 2
+        assert cls.depth() == (2, 18, 3)
+
+    def test_no_evict_while_reading(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False,
+                        segment_bytes=12, max_bytes=20, downsample_factor=1)
+        cls.append('a 1 2\nb 1 2\n')
+        chunks = cls.read_chunks(1, max_lines=1)
+        assert next(chunks) == ('a 1 2\n', 6)
+        cls.append('c 1 2\nd 1 2\n')
+        cls.append('e 1 2\n')
+        assert cls.segments() == [1, 3]
+        assert next(chunks) == ('b 1 2\n', 12)
+        chunks.close()
+        assert cls._reading == set()
+
+    def test_protected_before_reading_starts(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False,
+                        segment_bytes=12, max_bytes=20, downsample_factor=1)
+        cls.append('a 1 2\nb 1 2\n')
+        cls.commit(1, 6, points=1)
+        chunks = cls.read_chunks(1)
+        assert chunks.progress == (6, 0)
+        assert cls._reading == set([1])
+        # limits are enforced before the first chunk is read
+        cls.append('c 1 2\nd 1 2\n')
+        cls.append('e 1 2\n')
+        assert cls.segments() == [1, 3]
+        assert list(chunks) == [('b 1 2\n', 12)]
+        assert cls._reading == set()
+
+    def test_close_unstarted(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\n')
+        chunks = cls.read_chunks(1)
+        chunks.close()
+        assert cls._reading == set()
+
+    def test_compressed(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir))
+        cls.append('a.b.c 1 1000\n' * 3)
+        cls.append('a.b.c 2 1060\nd 3 1060\n')
+        seg = tmpdir.join('000000000001.seg').read_binary()
+        assert seg.startswith(b'pi2graphite-z1\n')
+        assert len(seg) < 100
+        chunks = list(cls.read_chunks(1, max_lines=3))
+        assert [c[0] for c in chunks] == [
+            'a.b.c 1 1000\n' * 3, 'a.b.c 2 1060\nd 3 1060\n'
+        ]
+        assert chunks[1][1] == len(seg)
+        assert cls.depth() == (1, len(seg), 5)
+        # resume from a checkpoint in the middle of the segment
+        cls.commit(1, chunks[0][1], points=3)
+        assert list(cls.read_chunks(1)) == [chunks[1]]
+        cls.commit(1, chunks[1][1], points=2)
+        assert cls.segments() == []
+
+    def test_compressed_not_reopened(self, tmpdir):
+        DiskCache(directory=str(tmpdir)).append('a 1 2\n')
+        cls = DiskCache(directory=str(tmpdir))
+        cls.append('b 1 2\n')
+        assert cls.segments() == [1, 2]
+        size = tmpdir.join('000000000001.seg').size()
+        assert [list(cls.read_chunks(s)) for s in [1, 2]] == [
+            [('a 1 2\n', size)], [('b 1 2\n', size)]
+        ]
+
+    def test_compressed_partial_frame(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir))
+        cls.append('a 1 2\n')
+        cls.close()
+        size = tmpdir.join('000000000001.seg').size()
+        with open(str(tmpdir.join('000000000001.seg')), 'ab') as fh:
+            fh.write(b'\x00\x00\x00\x20abc')
+        assert list(cls.read_chunks(1)) == [('a 1 2\n', size)]
+
+    def test_compressed_downsample(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), segment_bytes=30,
+                        max_bytes=100, downsample_at=0.3)
+        cls.append('a 1 10\na 3 20\n')
+        cls.append('b 1 40\n')
+        assert tmpdir.join('000000000001.ds').check()
+        assert [c[0] for c in cls.read_chunks(1)] == ['a 2.0 10\n']
+
+    def test_segments_chronological(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), segment_bytes=5)
+        cls.append('a 1 300\n')
+        cls.append('b 1 100\nc 1 400\n')
+        cls.append('d 1 200\n')
+        assert cls.segments() == [2, 3, 1]
+        # the index is rebuilt from disk at startup
+        cls2 = DiskCache(directory=str(tmpdir), segment_bytes=5)
+        assert cls2.segments() == [2, 3, 1]
+        assert cls2._index[2]['first_ts'] == 100
+        assert cls2._index[2]['points'] == 2
+
+    def test_segments_not_rescanned(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        with patch('%s.os.listdir' % pbm) as mock_listdir:
+            cls.append('a 1 2\n')
+            chunks = list(cls.read_chunks(1))
+            cls.commit(1, chunks[-1][1], points=1)
+            assert cls.segments() == []
+        assert mock_listdir.mock_calls == []
+
+    def test_commit_fsyncs(self, tmpdir):
+        cls = DiskCache(directory=str(tmpdir), compress=False)
+        cls.append('a 1 2\nb 1 2\n')
+        with patch('%s.os.fsync' % pbm) as mock_fsync:
+            cls.commit(1, 6, points=1)
+        assert len(mock_fsync.mock_calls) == 1
+        assert cls.committed(1) == 6
@@ -0,0 +1,1463 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/webhook2lambda2sqs>
+
+################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of webhook2lambda2sqs, also known as webhook2lambda2sqs.
+
+    webhook2lambda2sqs is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    webhook2lambda2sqs is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with webhook2lambda2sqs.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/webhook2lambda2sqs> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+################################################################################
+"""
+import sys
+import socket
+import struct
+import pickle
+import threading
+import pytest
+
+from pi2graphite.graphiteclient import (
+    ResolverCache, GraphiteConnection, TokenBucket, CircuitBreaker,
+    LineSerializer, UDPSender, GraphiteDestination, ConsistentHashRing,
+    CachingGraphiteClient
+)
+from pi2graphite.diskcache import ChunkReader, DiskCache
+
+# https://code.google.com/p/mock/issues/detail?id=249
+# py>=3.4 should use unittest.mock not the mock package on pypi
+if (
+        sys.version_info[0] < 3 or
+        sys.version_info[0] == 3 and sys.version_info[1] < 4
+):
+    from mock import patch, call, Mock, DEFAULT, mock_open  # noqa
+else:
+    from unittest.mock import patch, call, Mock, DEFAULT, mock_open  # noqa
+
+pbm = 'pi2graphite.graphiteclient'
+pbc = '%s.GraphiteConnection' % pbm
+pbd = '%s.GraphiteDestination' % pbm
+pb = '%s.CachingGraphiteClient' % pbm
+
+
+class TestResolverCache(object):
+
+    def setup(self):
+        self.cls = ResolverCache(ttl=300)
+        self.addrs = [(2, 1, 6, '', ('1.2.3.4', 2003))]
+
+    def test_resolve_cached(self):
+        with patch('%s.socket.getaddrinfo' % pbm) as mock_gai:
+            with patch('%s.time.time' % pbm) as mock_time:
+                mock_gai.return_value = self.addrs
+                mock_time.return_value = 1000
+                assert self.cls.resolve('myhost', 2003) == self.addrs
+                mock_time.return_value = 1299
+                assert self.cls.resolve('myhost', 2003) == self.addrs
+                mock_time.return_value = 1300
+                assert self.cls.resolve('myhost', 2003) == self.addrs
+        assert mock_gai.mock_calls == [
+            call('myhost', 2003, 0, socket.SOCK_STREAM),
+            call('myhost', 2003, 0, socket.SOCK_STREAM)
+        ]
+        assert self.cls.lookups == 2
+        assert self.cls.failures == 0
+
+    def test_resolve_fallback(self):
+        self.cls._cache[('myhost', 2003, socket.SOCK_STREAM)] = (
+            10, self.addrs
+        )
+        with patch('%s.socket.getaddrinfo' % pbm) as mock_gai:
+            with patch('%s.time.time' % pbm) as mock_time:
+                mock_gai.side_effect = socket.gaierror('fail')
+                mock_time.return_value = 1000
+                assert self.cls.resolve('myhost', 2003) == self.addrs
+        assert self.cls.lookups == 1
+        assert self.cls.failures == 1
+        assert self.cls._cache[('myhost', 2003, socket.SOCK_STREAM)] == (
+            1300, self.addrs
+        )
+
+    def test_resolve_fails(self):
+        with patch('%s.socket.getaddrinfo' % pbm) as mock_gai:
+            mock_gai.side_effect = socket.gaierror('fail')
+            with pytest.raises(socket.gaierror):
+                self.cls.resolve('myhost', 2003, socket.SOCK_DGRAM)
+        assert self.cls.failures == 1
+        assert self.cls._cache == {}
+
+    def test_expire(self):
+        self.cls._cache[('myhost', 2003, socket.SOCK_STREAM)] = (
+            1000, self.addrs
+        )
+        self.cls.expire('myhost', 2003)
+        self.cls.expire('otherhost', 2003)
+        assert self.cls._cache == {
+            ('myhost', 2003, socket.SOCK_STREAM): (0, self.addrs)
+        }
+
+
+class TestGraphiteConnection(object):
+
+    def setup(self):
+        self.mock_resolver = Mock(spec_set=ResolverCache)
+        self.mock_resolver.resolve.return_value = [
+            (2, 1, 6, '', ('myhost', 2003))
+        ]
+        self.cls = GraphiteConnection(
+            'myhost', 2003, resolver=self.mock_resolver
+        )
+
+    def test_init(self):
+        assert self.cls._host == 'myhost'
+        assert self.cls._port == 2003
+        assert self.cls._timeout == 10
+        assert self.cls._sock is None
+        assert self.cls.connected is False
+        assert self.cls.connects == 0
+        assert self.cls.connects_saved == 0
+
+    def test_send_connects(self):
+        self.cls._set_keepalive = Mock()
+        mock_sock = Mock()
+        with patch('%s._open' % pbc) as mock_cc:
+            mock_cc.return_value = mock_sock
+            self.cls.send(b'foo')
+        assert mock_cc.mock_calls == [
+            call((2, 1, 6, '', ('myhost', 2003))),
+            call().sendall(b'foo')
+        ]
+        assert self.cls.connected is True
+        assert self.cls.connects == 1
+        assert self.cls.connects_saved == 0
+
+    def test_connect_options(self):
+        cls = GraphiteConnection('myhost', 2003, timeout=5, send_timeout=30,
+                                 nodelay=True, sndbuf=131072,
+                                 resolver=self.mock_resolver)
+        mock_sock = Mock()
+        with patch('%s._open' % pbc) as mock_cc:
+            mock_cc.return_value = mock_sock
+            cls._connect()
+        assert mock_cc.call_args_list == [
+            call((2, 1, 6, '', ('myhost', 2003)))
+        ]
+        assert mock_sock.mock_calls[:3] == [
+            call.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            call.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072),
+            call.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        assert mock_sock.mock_calls[-1] == call.settimeout(30)
+        assert cls._sock == mock_sock
+
+    def test_set_keepalive(self):
+        cls = GraphiteConnection('myhost', 2003, timeout=5, send_timeout=30,
+                                 resolver=self.mock_resolver)
+        mock_sock = Mock()
+        cls._set_keepalive(mock_sock)
+        expected = [call.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        for opt, val in [
+            ('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3),
+            ('TCP_USER_TIMEOUT', 30000)
+        ]:
+            if hasattr(socket, opt):
+                expected.append(call.setsockopt(
+                    socket.IPPROTO_TCP, getattr(socket, opt), val
+                ))
+        assert mock_sock.mock_calls == expected
+
+    def test_set_keepalive_connect_timeout(self):
+        cls = GraphiteConnection('myhost', 2003, timeout=2.5,
+                                 resolver=self.mock_resolver)
+        mock_sock = Mock()
+        with patch('%s.socket.TCP_USER_TIMEOUT' % pbm, 18, create=True):
+            cls._set_keepalive(mock_sock)
+        assert mock_sock.mock_calls[-1] == call.setsockopt(
+            socket.IPPROTO_TCP, 18, 2500
+        )
+
+    def test_set_keepalive_unsupported(self):
+        mock_sock = Mock()
+        attrs = ['SOL_SOCKET', 'SO_KEEPALIVE', 'IPPROTO_TCP']
+        with patch('%s.socket' % pbm, spec_set=attrs) as mock_s:
+            self.cls._set_keepalive(mock_sock)
+        assert mock_sock.mock_calls == [
+            call.setsockopt(mock_s.SOL_SOCKET, mock_s.SO_KEEPALIVE, 1)
+        ]
+
+    def test_connect_addresses(self):
+        self.mock_resolver.resolve.return_value = [
+            (10, 1, 6, '', ('::1', 2003, 0, 0)),
+            (2, 1, 6, '', ('127.0.0.1', 2003))
+        ]
+        mock_sock = Mock()
+        with patch('%s._open' % pbc) as mock_cc:
+            mock_cc.side_effect = [socket.error('refused'), mock_sock]
+            self.cls._connect()
+        assert mock_cc.mock_calls == [
+            call((10, 1, 6, '', ('::1', 2003, 0, 0))),
+            call((2, 1, 6, '', ('127.0.0.1', 2003)))
+        ]
+        assert self.cls._sock == mock_sock
+        assert self.mock_resolver.mock_calls == [
+            call.resolve('myhost', 2003)
+        ]
+
+    def test_open(self):
+        cls = GraphiteConnection('myhost', 2003, timeout=5,
+                                 resolver=self.mock_resolver)
+        addr = (10, 1, 6, '', ('fe80::1', 2003, 0, 2))
+        with patch('%s.socket.socket' % pbm) as mock_socket:
+            res = cls._open(addr)
+        assert res is mock_socket.return_value
+        assert mock_socket.mock_calls == [
+            call(10, 1, 6),
+            call().settimeout(5),
+            call().connect(('fe80::1', 2003, 0, 2))
+        ]
+
+    def test_open_fails(self):
+        addr = (2, 1, 6, '', ('127.0.0.1', 2003))
+        with patch('%s.socket.socket' % pbm) as mock_socket:
+            mock_socket.return_value.connect.side_effect = socket.error('no')
+            with pytest.raises(socket.error):
+                self.cls._open(addr)
+        assert mock_socket.mock_calls == [
+            call(2, 1, 6),
+            call().settimeout(10),
+            call().connect(('127.0.0.1', 2003)),
+            call().close()
+        ]
+
+    def test_open_ipv6_scope_id(self):
+        try:
+            srv = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            srv.bind(('::1', 0))
+        except socket.error:
+            pytest.skip('IPv6 loopback not available')
+        try:
+            srv.listen(1)
+            port = srv.getsockname()[1]
+            addr = (
+                socket.AF_INET6, socket.SOCK_STREAM, 6, '',
+                ('::1', port, 0, 0)
+            )
+            with patch('%s.socket.create_connection' % pbm) as mock_cc:
+                sock = self.cls._open(addr)
+            assert mock_cc.mock_calls == []
+            assert sock.getpeername()[:2] == ('::1', port)
+            assert len(sock.getpeername()) == 4
+            sock.close()
+        finally:
+            srv.close()
+
+    def test_connect_addresses_fail(self):
+        with patch('%s._open' % pbc) as mock_cc:
+            mock_cc.side_effect = socket.error('refused')
+            with pytest.raises(socket.error):
+                self.cls._connect()
+        assert self.cls._sock is None
+        assert self.mock_resolver.mock_calls == [
+            call.resolve('myhost', 2003),
+            call.expire('myhost', 2003)
+        ]
+
+    def test_connect_options_fail(self):
+        cls = GraphiteConnection('myhost', 2003, nodelay=True,
+                                 resolver=self.mock_resolver)
+        mock_sock = Mock()
+        mock_sock.setsockopt.side_effect = socket.error('fail')
+        with patch('%s._open' % pbc) as mock_cc:
+            mock_cc.return_value = mock_sock
+            with pytest.raises(socket.error):
+                cls._connect()
+        assert mock_sock.close.mock_calls == [call()]
+        assert cls._sock is None
+        assert cls.connects == 0
+
+    def test_send_reuses_connection(self):
+        mock_sock = Mock()
+        self.cls._sock = mock_sock
+        with patch('%s._open' % pbc) as mock_cc:
+            with patch('%s._peer_closed' % pbc) as mock_closed:
+                mock_closed.return_value = False
+                self.cls.send(b'foo')
+                self.cls.send(b'bar')
+        assert mock_cc.mock_calls == []
+        assert mock_sock.mock_calls == [
+            call.sendall(b'foo'), call.sendall(b'bar')
+        ]
+        assert self.cls.connects == 0
+        assert self.cls.connects_saved == 2
+        assert self.cls.sends == 2
+        assert self.cls.bytes_sent == 6
+
+    def test_send_peer_closed_reconnects(self):
+        self.cls._set_keepalive = Mock()
+        old_sock = Mock()
+        new_sock = Mock()
+        self.cls._sock = old_sock
+        with patch('%s._open' % pbc) as mock_cc:
+            with patch('%s._peer_closed' % pbc) as mock_closed:
+                mock_closed.return_value = True
+                mock_cc.return_value = new_sock
+                self.cls.send(b'foo')
+        assert old_sock.mock_calls == [call.close()]
+        assert new_sock.mock_calls == [call.sendall(b'foo')]
+        assert self.cls._sock == new_sock
+        assert self.cls.connects == 1
+
+    def test_send_retries_once_on_error(self):
+        self.cls._set_keepalive = Mock()
+        old_sock = Mock()
+        old_sock.sendall.side_effect = socket.error('broken pipe')
+        new_sock = Mock()
+        self.cls._sock = old_sock
+        with patch('%s._open' % pbc) as mock_cc:
+            with patch('%s._peer_closed' % pbc) as mock_closed:
+                mock_closed.return_value = False
+                mock_cc.return_value = new_sock
+                self.cls.send(b'foo')
+        assert new_sock.mock_calls == [call.sendall(b'foo')]
+        assert self.cls._sock == new_sock
+        assert self.cls.connects == 1
+        assert self.cls.connects_saved == 0
+        assert self.cls.sends == 1
+        assert self.cls.bytes_sent == 3
+
+    def test_send_connect_fails(self):
+        with patch('%s._open' % pbc) as mock_cc:
+            mock_cc.side_effect = socket.error('refused')
+            with pytest.raises(socket.error):
+                self.cls.send(b'foo')
+        assert self.cls.connected is False
+        assert self.cls.sends == 0
+        assert self.cls.bytes_sent == 0
+
+    def test_peer_closed(self):
+        srv, cli = socket.socketpair()
+        self.cls._sock = cli
+        assert self.cls._peer_closed() is False
+        srv.close()
+        assert self.cls._peer_closed() is True
+        cli.close()
+
+
+class TestTokenBucket(object):
+
+    def test_reserve(self):
+        with patch('%s.time.time' % pbm) as mock_time:
+            mock_time.return_value = 100.0
+            cls = TokenBucket(10)
+            # starts full
+            assert cls.reserve(10) == 0.0
+            # debt of 5 tokens at 10/sec
+            assert cls.reserve(5) == 0.5
+            mock_time.return_value = 101.0
+            # repaid 10, now 5 in bucket
+            assert cls.reserve(5) == 0.0
+            mock_time.return_value = 200.0
+            # capped at capacity
+            assert cls.reserve(20) == 1.0
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_and_recovers(self):
+        cls = CircuitBreaker(failure_threshold=2, backoff=10, max_backoff=30)
+        with patch('%s.time.time' % pbm) as mock_time:
+            with patch('%s.random.uniform' % pbm) as mock_rand:
+                mock_rand.return_value = 1.0
+                mock_time.return_value = 100.0
+                assert cls.allow() is True
+                cls.failure()
+                assert cls.state == CircuitBreaker.CLOSED
+                cls.failure()
+                assert cls.state == CircuitBreaker.OPEN
+                assert cls.allow() is False
+                mock_time.return_value = 110.0
+                assert cls.allow() is True
+                assert cls.state == CircuitBreaker.HALF_OPEN
+                # failed probe doubles the backoff
+                cls.failure()
+                assert cls.state == CircuitBreaker.OPEN
+                mock_time.return_value = 129.0
+                assert cls.allow() is False
+                mock_time.return_value = 130.0
+                assert cls.allow() is True
+                cls.failure()
+                # capped at max_backoff
+                mock_time.return_value = 159.0
+                assert cls.allow() is False
+                mock_time.return_value = 160.0
+                assert cls.allow() is True
+                assert cls.open_time == 60.0
+                cls.success()
+                assert cls.state == CircuitBreaker.CLOSED
+                assert cls._backoff == 10
+                mock_time.return_value = 200.0
+                assert cls.open_time == 60.0
+        assert cls.transitions == 7
+        assert mock_rand.mock_calls == [call(0.5, 1.5)] * 3
+
+    def test_success_resets_failures(self):
+        cls = CircuitBreaker(failure_threshold=2)
+        cls.failure()
+        cls.success()
+        cls.failure()
+        assert cls.state == CircuitBreaker.CLOSED
+        assert cls.transitions == 0
+
+
+class TestLineSerializer(object):
+
+    def test_serialize(self):
+        cls = LineSerializer()
+        res = cls.serialize([
+            ('foo', 1, 123), ('bar.baz', 2.5, 123), ('foo', 3, 456)
+        ])
+        assert isinstance(res, bytearray)
+        assert res == b'foo 1 123\nbar.baz 2.5 123\nfoo 3 456\n'
+        assert cls._paths == {'foo': b'foo ', 'bar.baz': b'bar.baz '}
+        res2 = cls.serialize([('foo', 4, 789)])
+        assert res2 is res
+        assert res2 == b'foo 4 789\n'
+        assert cls.serialize([]) == b''
+
+    def test_serialize_prefix(self):
+        cls = LineSerializer(prefix='pfx.host')
+        res = cls.serialize([('foo', 1, 123), ('bar.baz', 2.5, 123)])
+        assert res == b'pfx.host.foo 1 123\npfx.host.bar.baz 2.5 123\n'
+
+    def test_chunks(self):
+        buf = b'a 1 1\nbb 2 2\nc 3 3\nd 4 4\n'
+        assert LineSerializer.chunks(buf) == [(0, 25, 4)]
+        assert LineSerializer.chunks(buf, max_bytes=13) == [
+            (0, 13, 2), (13, 25, 2)
+        ]
+        assert LineSerializer.chunks(buf, max_lines=3) == [
+            (0, 19, 3), (19, 25, 1)
+        ]
+        assert LineSerializer.chunks(buf, max_bytes=13, max_lines=1) == [
+            (0, 6, 1), (6, 13, 1), (13, 19, 1), (19, 25, 1)
+        ]
+        assert LineSerializer.chunks(buf, max_bytes=3) == [
+            (0, 6, 1), (6, 13, 1), (13, 19, 1), (19, 25, 1)
+        ]
+        assert LineSerializer.chunks(b'') == []
+
+    def test_serialize_clears_cache(self):
+        cls = LineSerializer(max_paths=1)
+        cls.serialize([('a', 1, 1), ('b', 1, 1)])
+        assert len(cls._paths) == 2
+        assert cls.serialize([('c', 2, 2)]) == b'c 2 2\n'
+        assert cls._paths == {'c': b'c '}
+
+
+class TestUDPSender(object):
+
+    def setup(self):
+        self.cls = UDPSender('myhost', 2003, max_datagram=24)
+
+    def test_datagrams(self):
+        res = self.cls._datagrams([
+            ('a.b', 1, 10), ('c.d', 2.5, 11), ('e', 3, 12),
+            ('a.very.long.metric.name', 4, 13), ('f', 5, 14)
+        ])
+        assert res == [
+            (b'a.b 1 10\nc.d 2.5 11\n', 2),
+            (b'e 3 12\n', 1),
+            (b'a.very.long.metric.name 4 13\n', 1),
+            (b'f 5 14\n', 1)
+        ]
+
+    def test_send(self):
+        mock_sock = Mock()
+        with patch.multiple(
+            '%s.socket' % pbm,
+            getaddrinfo=DEFAULT,
+            socket=DEFAULT
+        ) as mocks:
+            mocks['getaddrinfo'].return_value = [
+                (2, 2, 17, '', ('1.2.3.4', 2003))
+            ]
+            mocks['socket'].return_value = mock_sock
+            mock_sock.sendto.side_effect = [None, socket.error('EAGAIN')]
+            self.cls.send([('a.b', 1, 10), ('c.d', 2.5, 11), ('e', 3, 12)])
+            self.cls.send([])
+        assert mocks['getaddrinfo'].mock_calls == [
+            call('myhost', 2003, 0, socket.SOCK_DGRAM)
+        ]
+        assert mocks['socket'].call_args_list == [call(2, 2, 17)]
+        assert mock_sock.mock_calls == [
+            call.setblocking(0),
+            call.sendto(b'a.b 1 10\nc.d 2.5 11\n', ('1.2.3.4', 2003)),
+            call.sendto(b'e 3 12\n', ('1.2.3.4', 2003))
+        ]
+        assert self.cls.datagrams == 1
+        assert self.cls.points == 2
+        assert self.cls.dropped_points == 1
+
+    def test_send_resolve_fails(self):
+        with patch('%s.socket.getaddrinfo' % pbm) as mock_gai:
+            mock_gai.side_effect = socket.gaierror('fail')
+            self.cls.send([('a.b', 1, 10), ('c.d', 2.5, 11)])
+        assert self.cls._sock is None
+        assert self.cls.dropped_points == 2
+
+    def test_close(self):
+        mock_sock = Mock()
+        self.cls._sock = mock_sock
+        self.cls.close()
+        assert mock_sock.mock_calls == [call.close()]
+        assert self.cls._sock is None
+
+
+class TestGraphiteDestination(object):
+
+    def setup(self):
+        with patch('%s.DiskCache' % pbm, autospec=True) as mock_cache:
+            self.cls = GraphiteDestination('myhost', replay_jitter=0)
+        self.mock_cache = mock_cache.return_value
+        self.mock_cache.progress.return_value = (0, 0)
+        self.mock_cache._reading = set()
+
+    def reader(self, seg, chunks, progress=(0, 0)):
+        return ChunkReader(
+            self.mock_cache, seg, progress, (x for x in chunks)
+        )
+
+    def test_init(self):
+        with patch('%s.DiskCache' % pbm, autospec=True) as mock_cache:
+            cls = GraphiteDestination(
+                'myhost', cache_dir='/foo', cache_segment_bytes=1234
+            )
+        assert mock_cache.mock_calls == [
+            call(directory='/foo', segment_bytes=1234, max_bytes=0,
+                 max_age=0, downsample_at=0.75, downsample_factor=2,
+                 downsample_method='avg', compress=True)
+        ]
+        assert cls._cache == mock_cache.return_value
+        assert cls._conn._host == 'myhost'
+        assert cls._conn._port == 2003
+        assert cls._replay_buckets == []
+        assert cls._udp is None
+
+    def test_init_rate_limits(self):
+        with patch('%s.DiskCache' % pbm, autospec=True):
+            cls = GraphiteDestination(
+                'myhost', replay_points_per_sec=100, replay_bytes_per_sec=2000
+            )
+        assert [x[0] for x in cls._replay_buckets] == ['points', 'bytes']
+        assert cls._replay_buckets[0][1]._rate == 100
+        assert cls._replay_buckets[1][1]._rate == 2000
+
+    def test_name(self):
+        assert self.cls.name == 'myhost_2003'
+        self.cls._host = '10.0.0.1'
+        assert self.cls.name == '10_0_0_1_2003'
+
+    def test_graphite_pickle(self):
+        self.cls._pickle_batch_size = 2
+        res = self.cls._graphite_pickle([
+            ('pfx.a', 1, 10), ('pfx.b', 2.5, 11), ('pfx.c', 3, 12)
+        ])
+        frames = []
+        while len(res) > 0:
+            length = struct.unpack('!L', res[:4])[0]
+            frames.append(pickle.loads(res[4:4 + length]))
+            res = res[4 + length:]
+        assert frames == [
+            [('pfx.a', (10, 1)), ('pfx.b', (11, 2.5))],
+            [('pfx.c', (12, 3))]
+        ]
+
+    def test_prefixed(self):
+        data = [('foo', 1, 2)]
+        assert self.cls._prefixed(data) is data
+        self.cls._metric_prefix = 'pfx'
+        assert self.cls._prefixed(data) == [('pfx.foo', 1, 2)]
+
+    def test_cache_payload_plaintext(self):
+        assert self.cls._cache_payload('a 1 2\n') == 'a 1 2\n'
+
+    def test_cache_payload_pickle(self):
+        self.cls._protocol = 'pickle'
+        with patch('%s._graphite_pickle' % pbd, autospec=True) as mock_pkl:
+            mock_pkl.return_value = b'pickled'
+            res = self.cls._cache_payload('a.b 1 2\nc 2.5 3\n\n')
+        assert res == b'pickled'
+        assert mock_pkl.mock_calls == [
+            call(self.cls, [('a.b', 1.0, 2), ('c', 2.5, 3)])
+        ]
+
+    def test_send_pickle(self):
+        self.cls._protocol = 'pickle'
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_pickle=DEFAULT,
+            _graphite_send=DEFAULT,
+            _request_flush=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            mocks['_graphite_pickle'].return_value = b'pickled'
+            mocks['_graphite_send'].return_value = True
+            assert self.cls.send([('pfx.foo', 1, 2)]) is True
+        assert mocks['_graphite_pickle'].mock_calls == [
+            call(self.cls, [('pfx.foo', 1, 2)])
+        ]
+        assert mocks['_graphite_send'].mock_calls == [
+            call(self.cls, b'pickled')
+        ]
+        assert mocks['_request_flush'].mock_calls == [call(self.cls)]
+        assert mocks['_cache_data'].mock_calls == []
+
+    def test_graphite_send(self):
+        with patch('%s.send' % pbc, autospec=True) as mock_send:
+            assert self.cls._graphite_send('foo 1 2\n') is True
+        assert mock_send.mock_calls == [call(self.cls._conn, b'foo 1 2\n')]
+
+    def test_graphite_send_memoryview(self):
+        buf = bytearray(b'foo 1 2\nbar 1 2\n')
+        view = memoryview(buf)[:8]
+        with patch('%s.send' % pbc, autospec=True) as mock_send:
+            with patch('%s.logger' % pbm) as mock_logger:
+                mock_logger.isEnabledFor.return_value = True
+                assert self.cls._graphite_send(view) is True
+        assert mock_send.mock_calls == [call(self.cls._conn, view)]
+        # the debug log gets a copy, not the view
+        assert mock_logger.debug.mock_calls == [
+            call('Sending data: "%s"', b'foo 1 2\n')
+        ]
+
+    def test_graphite_send_fails(self):
+        with patch('%s.send' % pbc, autospec=True) as mock_send:
+            mock_send.side_effect = socket.error('refused')
+            assert self.cls._graphite_send('foo 1 2\n') is False
+        assert self.cls._breaker._failures == 1
+
+    def test_graphite_send_breaker_open(self):
+        self.cls._breaker = Mock(spec_set=CircuitBreaker)
+        self.cls._breaker.allow.return_value = False
+        with patch('%s.send' % pbc, autospec=True) as mock_send:
+            assert self.cls._graphite_send('foo 1 2\n') is False
+        assert mock_send.mock_calls == []
+        assert self.cls._breaker.mock_calls == [call.allow()]
+
+    def test_flush_cache_empty(self):
+        self.mock_cache.segments.return_value = []
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            self.cls._flush_cache()
+        assert mock_send.mock_calls == []
+        assert self.mock_cache.mock_calls == [call.segments()]
+
+    def capture(self, mock_send, results):
+        """
+        Make a mock _graphite_send return each of ``results`` in turn, and
+        return a list that each chunk sent is copied into; chunks sent as
+        memoryviews are released once sent.
+        """
+        sent = []
+        results = iter(results)
+
+        def se(cls, data):
+            sent.append(bytes(data))
+            return next(results)
+
+        mock_send.side_effect = se
+        return sent
+
+    def test_send_chunked_zero_copy(self):
+        self.cls._max_lines_per_write = 1
+        views = []
+
+        def se(cls, data):
+            views.append(
+                isinstance(data, memoryview) and
+                data.obj is self.cls._serializer._buf
+            )
+            return True
+
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_send=DEFAULT,
+            _request_flush=DEFAULT
+        ) as mocks:
+            mocks['_graphite_send'].side_effect = se
+            assert self.cls._send([('a', 1, 1), ('b', 2, 2)]) == []
+            # the views were released, so the buffer can be reused
+            assert self.cls._send([('c', 3, 3), ('d', 4, 4)]) == []
+        assert views == [True, True, True, True]
+
+    def test_send_cached_chunked(self):
+        self.cls._max_lines_per_write = 1
+        sent = []
+
+        def se(cls, data):
+            sent.append((type(data), bytes(data)))
+            return True
+
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            mock_send.side_effect = se
+            assert self.cls._send_cached('a 1 2\nb 2 3\n') == 2
+        assert sent == [
+            (memoryview, b'a 1 2\n'), (memoryview, b'b 2 3\n')
+        ]
+
+    def test_send_cached_pickle(self):
+        self.cls._max_lines_per_write = 1
+        self.cls._protocol = 'pickle'
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_send=DEFAULT,
+            _graphite_pickle=DEFAULT
+        ) as mocks:
+            mocks['_graphite_send'].return_value = True
+            mocks['_graphite_pickle'].side_effect = lambda cls, x: repr(x)
+            assert self.cls._send_cached('a 1 2\nb 2 3\n') == 2
+        assert mocks['_graphite_pickle'].mock_calls == [
+            call(self.cls, [('a', 1.0, 2)]),
+            call(self.cls, [('b', 2.0, 3)])
+        ]
+
+    def test_flush_cache(self):
+        self.cls._replay_chunk_delay = 0
+        self.mock_cache.segments.return_value = [3, 4]
+        self.mock_cache.read_chunks.side_effect = [
+            self.reader(3, [('a 1 2\n', 50), ('b 2 2\n', 100)]),
+            self.reader(4, [('c 3 4\n', 20)])
+        ]
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            mock_send.return_value = True
+            self.cls._flush_cache()
+        assert mock_send.mock_calls == [
+            call(self.cls, b'a 1 2\n'),
+            call(self.cls, b'b 2 2\n'),
+            call(self.cls, b'c 3 4\n')
+        ]
+        assert self.mock_cache.mock_calls == [
+            call.segments(),
+            call.read_chunks(3, max_lines=1000, max_bytes=65536),
+            call.commit(3, 50, points=1),
+            call.commit(3, 100, points=1),
+            call.read_chunks(4, max_lines=1000, max_bytes=65536),
+            call.commit(4, 20, points=1)
+        ]
+        assert self.cls.sets_flushed == 2
+        assert self.cls.points_flushed == 3
+        assert self.cls.replay_rate > 0
+
+    def test_flush_cache_send_fails(self):
+        self.mock_cache.segments.return_value = [3, 4]
+        self.mock_cache.read_chunks.return_value = self.reader(
+            3, [('a 1 2\n', 100)]
+        )
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            mock_send.return_value = False
+            self.cls._flush_cache()
+        assert self.mock_cache.mock_calls == [
+            call.segments(),
+            call.read_chunks(3, max_lines=1000, max_bytes=65536)
+        ]
+        assert self.mock_cache._reading == set()
+        assert self.cls.sets_flushed == 0
+        assert self.cls.points_flushed == 0
+
+    def test_flush_cache_partial(self):
+        self.cls._replay_chunk_delay = 0
+        self.cls._max_lines_per_write = 2
+        self.mock_cache.segments.return_value = [3]
+        self.mock_cache.read_chunks.return_value = self.reader(
+            3, [('a 1 2\nb 2 2\nc 3 2\n', 100)], progress=(40, 1)
+        )
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            sent = self.capture(mock_send, [True, False])
+            self.cls._flush_cache()
+        assert sent == [b'a 1 2\nb 2 2\n', b'c 3 2\n']
+        assert self.mock_cache.mock_calls == [
+            call.segments(),
+            call.read_chunks(3, max_lines=1000, max_bytes=65536),
+            call.commit(3, 40, points=2, lines=3)
+        ]
+        assert self.cls.replay_deduped_points == 1
+        assert self.cls.points_flushed == 2
+        assert self.cls.sets_flushed == 0
+
+    def test_flush_cache_deduped_counted_once(self):
+        self.cls._replay_chunk_delay = 0
+        self.mock_cache.segments.return_value = [3]
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            mock_send.return_value = False
+            for progress in [(40, 2), (40, 2), (40, 5), (90, 1)]:
+                self.mock_cache.read_chunks.return_value = self.reader(
+                    3, [('a 1 2\n', 100)], progress=progress
+                )
+                self.cls._flush_cache()
+        # 2 for the first batch, 3 more when it resumed further on, then 1
+        # for the next batch
+        assert self.cls.replay_deduped_points == 6
+
+    def test_flush_cache_stopped(self):
+        self.mock_cache.segments.return_value = [3]
+        self.cls._stop.set()
+        self.mock_cache.read_chunks.return_value = self.reader(
+            3, [('a 1 2\n', 100)]
+        )
+        self.mock_cache._reading.add(3)
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            self.cls._flush_cache()
+        assert mock_send.mock_calls == []
+        assert self.mock_cache.mock_calls == [
+            call.segments(),
+            call.read_chunks(3, max_lines=1000, max_bytes=65536)
+        ]
+        # the segment is released even though reading never started
+        assert self.mock_cache._reading == set()
+
+    def test_flush_cache_damaged_segment(self, tmpdir):
+        cls = GraphiteDestination(
+            'myhost', cache_dir=str(tmpdir), replay_chunk_delay=0,
+            replay_jitter=0
+        )
+        cls._cache._frame_lines = 1
+        cls._cache.append('a 1 2\nb 1 3\n')
+        cls._cache.close()
+        cls._cache.append('c 1 4\n')
+        cls._cache.close()
+        # damage the second frame of the first segment
+        ends = [x[1] for x in cls._cache.read_chunks(1, max_lines=1)]
+        path = tmpdir.join('000000000001.seg')
+        data = bytearray(path.read_binary())
+        data[ends[0] + 6] ^= 0xff
+        data[ends[0] + 7] ^= 0xff
+        path.write_binary(bytes(data))
+        with patch('%s._graphite_send' % pbd, autospec=True) as mock_send:
+            mock_send.return_value = True
+            with patch('%s.logger' % pbm):
+                with patch('%s.logger' % 'pi2graphite.diskcache'):
+                    cls._flush_cache()
+        assert mock_send.mock_calls == [
+            call(cls, b'a 1 2\n'), call(cls, b'c 1 4\n')
+        ]
+        assert cls._cache.segments() == []
+        assert sorted(x.basename for x in tmpdir.listdir()) == [
+            '000000000001.bad'
+        ]
+        assert cls.sets_flushed == 2
+        cls.close()
+
+    def test_send_chunked(self):
+        self.cls._max_bytes_per_write = 12
+        self.cls._max_lines_per_write = 2
+        data = [('a', 1, 1), ('b', 2, 2), ('c', 3, 3), ('d', 4, 4)]
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_send=DEFAULT,
+            _request_flush=DEFAULT
+        ) as mocks:
+            sent = self.capture(
+                mocks['_graphite_send'], [True, False, True, True]
+            )
+            assert self.cls._send(data) == [('c', 3, 3), ('d', 4, 4)]
+            assert self.cls._send(data) == []
+        assert sent == [
+            b'a 1 1\nb 2 2\n', b'c 3 3\nd 4 4\n',
+            b'a 1 1\nb 2 2\n', b'c 3 3\nd 4 4\n'
+        ]
+        assert mocks['_request_flush'].mock_calls == [call(self.cls)]
+
+    def test_send_chunked_pickle(self):
+        self.cls._protocol = 'pickle'
+        self.cls._max_lines_per_write = 2
+        data = [('a', 1, 1), ('b', 2, 2), ('c', 3, 3)]
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_pickle=DEFAULT,
+            _graphite_send=DEFAULT,
+            _request_flush=DEFAULT
+        ) as mocks:
+            mocks['_graphite_send'].side_effect = [True, False]
+            assert self.cls._send(data) == [('c', 3, 3)]
+        assert mocks['_graphite_pickle'].mock_calls == [
+            call(self.cls, [('a', 1, 1), ('b', 2, 2)]),
+            call(self.cls, [('c', 3, 3)])
+        ]
+        assert mocks['_request_flush'].mock_calls == []
+
+    def test_send_fails(self):
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_send=DEFAULT,
+            _request_flush=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            mocks['_graphite_send'].return_value = False
+            assert self.cls.send([('pfx.foo', 1, 2)]) is False
+        assert mocks['_graphite_send'].mock_calls == [
+            call(self.cls, b'pfx.foo 1 2\n')
+        ]
+        assert mocks['_request_flush'].mock_calls == []
+        assert mocks['_cache_data'].mock_calls == [
+            call(self.cls, [('pfx.foo', 1, 2)])
+        ]
+
+    def test_send_pickle_fails(self):
+        self.cls._protocol = 'pickle'
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _graphite_send=DEFAULT,
+            _request_flush=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            mocks['_graphite_send'].return_value = False
+            assert self.cls.send([('pfx.foo', 1, 2)]) is False
+        assert mocks['_cache_data'].mock_calls == [
+            call(self.cls, [('pfx.foo', 1, 2)])
+        ]
+
+    def test_flush_cache_jitter(self):
+        self.cls._replay_jitter = 10
+        self.mock_cache.segments.return_value = [3]
+        self.mock_cache.read_chunks.return_value = self.reader(3, [])
+        with patch('%s._graphite_send' % pbd, autospec=True):
+            with patch('%s.random.uniform' % pbm) as mock_rand:
+                mock_rand.return_value = 2.5
+                with patch.object(self.cls, '_stop') as mock_stop:
+                    mock_stop.is_set.return_value = False
+                    self.cls._flush_cache()
+        assert mock_rand.mock_calls == [call(0, 10)]
+        assert mock_stop.mock_calls[0] == call.wait(2.5)
+
+    def test_replay_wait(self):
+        pts = Mock(spec_set=TokenBucket)
+        pts.reserve.return_value = 0.05
+        byt = Mock(spec_set=TokenBucket)
+        byt.reserve.return_value = 3.0
+        assert self.cls._replay_wait('a 1 2\nb 1 2\n') == 0.1
+        self.cls._replay_buckets = [('points', pts)]
+        assert self.cls._replay_wait('a 1 2\nb 1 2\n') == 0.1
+        self.cls._replay_buckets = [('points', pts), ('bytes', byt)]
+        assert self.cls._replay_wait('a 1 2\nb 1 2\n') == 3.0
+        assert pts.mock_calls == [call.reserve(2), call.reserve(2)]
+        assert byt.mock_calls == [call.reserve(12)]
+
+    def test_cache_data(self):
+        self.cls._cache_serializer = LineSerializer(prefix='pfx')
+        self.cls._cache_data([('foo', 1, 2), ('bar', 3, 2)])
+        assert self.mock_cache.mock_calls == [
+            call.append('pfx.foo 1 2\npfx.bar 3 2\n')
+        ]
+
+    def test_enqueue_spills(self):
+        self.cls._queue_max_points = 3
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _send_worker=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            self.cls.enqueue([('a', 1, 1), ('b', 1, 1)])
+            self.cls.enqueue([('a', 2, 2)])
+            assert mocks['_cache_data'].mock_calls == []
+            self.cls.enqueue([('a', 3, 3), ('b', 3, 3)])
+            self.cls._sender_thread.join(5)
+        assert mocks['_send_worker'].mock_calls == [call(self.cls)]
+        assert mocks['_cache_data'].mock_calls == [
+            call(self.cls, [('a', 1, 1), ('b', 1, 1)])
+        ]
+        assert list(self.cls._queue) == [
+            [('a', 2, 2)], [('a', 3, 3), ('b', 3, 3)]
+        ]
+        assert self.cls._queued_points == 3
+        assert self.cls.spilled_points == 2
+
+    def test_send_worker(self):
+        self.cls._queue_max_points = 2
+        self.cls._queue_retry_delay = 0
+        self.cls._queue.extend([[('a', 1, 1)], [('b', 2, 2)]])
+        self.cls._queued_points = 2
+        sent = []
+
+        def se_send(cls, data_list):
+            sent.append(list(data_list))
+            if len(sent) == 1:
+                # new data arrives while sending; then fail
+                cls._queue.append([('c', 3, 3), ('d', 4, 4)])
+                cls._queued_points += 2
+                return data_list[1:]
+            cls._stop.set()
+            return []
+
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _send=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            mocks['_send'].side_effect = se_send
+            self.cls._send_worker()
+        # unsent part of the batch put back first, oldest spilled to get
+        # back down to 2 points
+        assert mocks['_cache_data'].mock_calls == [
+            call(self.cls, [('b', 2, 2)])
+        ]
+        assert sent == [
+            [('a', 1, 1), ('b', 2, 2)],
+            [('c', 3, 3), ('d', 4, 4)]
+        ]
+        assert len(self.cls._queue) == 0
+        assert self.cls._queued_points == 0
+        assert self.cls.spilled_points == 1
+
+    def test_send_worker_thread(self):
+        self.cls._queue_max_points = 100
+        sent = threading.Event()
+        with patch('%s._send' % pbd, autospec=True) as mock_send:
+            mock_send.side_effect = lambda x, y: sent.set() or []
+            self.cls.enqueue([('a', 1, 1)])
+            assert sent.wait(5) is True
+            self.cls.close()
+        assert mock_send.mock_calls == [call(self.cls, [('a', 1, 1)])]
+        assert self.cls._sender_thread.is_alive() is False
+
+    def test_close_caches_queue(self):
+        self.cls._queue.extend([[('a', 1, 1)], [('b', 2, 2)]])
+        self.cls._queued_points = 2
+        with patch('%s._cache_data' % pbd, autospec=True) as mock_cache:
+            self.cls.close()
+        assert mock_cache.mock_calls == [
+            call(self.cls, [('a', 1, 1), ('b', 2, 2)])
+        ]
+        assert self.cls._queued_points == 0
+        assert self.mock_cache.mock_calls == [call.close()]
+
+    def test_close_while_sending(self):
+        # close() gives up waiting while a send is blocked, and the send
+        # then fails; the in-flight batch must still be cached
+        self.cls._queue_max_points = 100
+        self.cls.CLOSE_TIMEOUT = 0.1
+        sending = threading.Event()
+        release = threading.Event()
+
+        def se_send(cls, data_list):
+            sending.set()
+            release.wait(5)
+            return data_list
+
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _send=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            mocks['_send'].side_effect = se_send
+            self.cls.enqueue([('a', 1, 1)])
+            assert sending.wait(5) is True
+            self.cls.enqueue([('b', 2, 2)])
+            self.cls.close()
+            assert self.cls._sender_thread.is_alive() is True
+            assert mocks['_cache_data'].mock_calls == [
+                call(self.cls, [('b', 2, 2)])
+            ]
+            release.set()
+            self.cls._sender_thread.join(5)
+        assert self.cls._sender_thread.is_alive() is False
+        assert mocks['_cache_data'].mock_calls == [
+            call(self.cls, [('b', 2, 2)]),
+            call(self.cls, [('a', 1, 1)])
+        ]
+        assert len(self.cls._queue) == 0
+        assert mocks['_send'].mock_calls == [call(self.cls, [('a', 1, 1)])]
+
+    def test_send_worker_stopped_during_send(self):
+        self.cls._queue.append([('a', 1, 1), ('b', 2, 2)])
+        self.cls._queued_points = 2
+
+        def se_send(cls, data_list):
+            cls._stop.set()
+            return data_list[1:]
+
+        with patch.multiple(
+            pbd,
+            autospec=True,
+            _send=DEFAULT,
+            _cache_data=DEFAULT
+        ) as mocks:
+            mocks['_send'].side_effect = se_send
+            self.cls._send_worker()
+        assert mocks['_cache_data'].mock_calls == [
+            call(self.cls, [('b', 2, 2)])
+        ]
+        assert len(self.cls._queue) == 0
+        assert self.cls._queued_points == 0
+
+    def test_flush_worker(self):
+        flushed = threading.Event()
+        with patch('%s._flush_cache' % pbd, autospec=True) as mock_flush:
+            mock_flush.side_effect = lambda x: flushed.set()
+            self.cls._request_flush()
+            assert flushed.wait(5) is True
+            self.cls.close()
+        assert mock_flush.mock_calls == [call(self.cls)]
+        assert self.cls._flush_thread.is_alive() is False
+
+    def test_self_metrics(self):
+        self.cls._conn.connects = 2
+        self.cls._conn.connects_saved = 5
+        self.cls._conn.send_time = 1.23456789
+        self.cls._conn.sends = 6
+        self.cls._conn.bytes_sent = 600
+        self.cls._conn.send_latency = 0.0123456789
+        self.cls.replay_rate = 1234.56789
+        self.cls._resolver.lookups = 4
+        self.cls._resolver.failures = 1
+        self.cls._resolver.resolve_time = 0.5
+        self.mock_cache.depth.return_value = (2, 1000, 50)
+        self.mock_cache.evicted_points = 7
+        self.cls._breaker.state = CircuitBreaker.OPEN
+        self.cls._breaker.transitions = 3
+        self.cls._breaker._open_time = 12.5
+        self.cls.sets_flushed = 4
+        self.cls.points_flushed = 40
+        self.cls.replay_deduped_points = 3
+        assert self.cls.self_metrics(123) == [
+            ('pi2graphite.cache.segments', 2, 123),
+            ('pi2graphite.cache.bytes', 1000, 123),
+            ('pi2graphite.cache.points', 50, 123),
+            ('pi2graphite.cache.evicted_points', 7, 123),
+            ('pi2graphite.cache.sets_flushed', 4, 123),
+            ('pi2graphite.cache.points_flushed', 40, 123),
+            ('pi2graphite.cache.replay_deduped_points', 3, 123),
+            ('pi2graphite.cache.replay_points_per_sec', 1234.568, 123),
+            ('pi2graphite.graphite.connects', 2, 123),
+            ('pi2graphite.graphite.connects_saved', 5, 123),
+            ('pi2graphite.graphite.send_time_sec', 1.234568, 123),
+            ('pi2graphite.graphite.sends', 6, 123),
+            ('pi2graphite.graphite.bytes_sent', 600, 123),
+            ('pi2graphite.graphite.send_latency_sec', 0.012346, 123),
+            ('pi2graphite.graphite.dns_lookups', 4, 123),
+            ('pi2graphite.graphite.dns_failures', 1, 123),
+            ('pi2graphite.graphite.dns_resolve_time_sec', 0.5, 123),
+            ('pi2graphite.graphite.breaker_state', 2, 123),
+            ('pi2graphite.graphite.breaker_transitions', 3, 123),
+            ('pi2graphite.graphite.breaker_open_sec', 12.5, 123)
+        ]
+
+    def test_self_metrics_qualifier(self):
+        self.mock_cache.depth.return_value = (0, 0, 0)
+        self.mock_cache.evicted_points = 0
+        res = self.cls.self_metrics(123, qualifier='.myhost_2003')
+        assert [x[0] for x in res[:2]] == [
+            'pi2graphite.cache.myhost_2003.segments',
+            'pi2graphite.cache.myhost_2003.bytes'
+        ]
+        assert res[-1][0] == 'pi2graphite.graphite.myhost_2003.breaker_open_sec'
+
+    def test_udp(self):
+        with patch('%s.DiskCache' % pbm, autospec=True):
+            with patch('%s.UDPSender' % pbm, autospec=True) as mock_udp:
+                cls = GraphiteDestination('myhost', udp_port=2013)
+        assert mock_udp.mock_calls == [call('myhost', port=2013,
+                                            max_datagram=1472,
+                                            metric_prefix='',
+                                            resolver=cls._resolver)]
+        mock_udp.return_value.datagrams = 1
+        mock_udp.return_value.points = 2
+        mock_udp.return_value.dropped_points = 3
+        cls._cache.depth.return_value = (0, 0, 0)
+        cls._cache.evicted_points = 0
+        cls.send_udp([('foo', 1, 2)])
+        cls._queue_max_points = 10
+        cls._queued_points = 4
+        cls.spilled_points = 6
+        assert cls.self_metrics(5)[-5:] == [
+            ('pi2graphite.udp.datagrams', 1, 5),
+            ('pi2graphite.udp.points', 2, 5),
+            ('pi2graphite.udp.dropped_points', 3, 5),
+            ('pi2graphite.queue.points', 4, 5),
+            ('pi2graphite.queue.spilled_points', 6, 5)
+        ]
+        cls.close()
+        assert mock_udp.return_value.mock_calls == [
+            call.send([('foo', 1, 2)]),
+            call.close()
+        ]
+
+
+class TestConsistentHashRing(object):
+
+    def test_position(self):
+        # same computation as carbon; first 4 hex digits of md5
+        assert ConsistentHashRing._position('foo') == 0xacbd
+
+    def test_ring(self):
+        nodes = [('a', None), ('b', None), ('c', '1')]
+        cls = ConsistentHashRing(nodes)
+        assert len(cls._positions) == 300
+        assert cls._positions == sorted(cls._positions)
+        assert len(set(cls._positions)) == 300
+        counts = dict((n, 0) for n in nodes)
+        for i in range(3000):
+            counts[cls.get_node('metric.%d' % i)] += 1
+        for n in nodes:
+            assert counts[n] > 500
+        other = ConsistentHashRing(nodes)
+        assert [cls.get_node('m.%d' % i) for i in range(100)] == [
+            other.get_node('m.%d' % i) for i in range(100)
+        ]
+
+    def test_get_node_wraps(self):
+        cls = ConsistentHashRing([('a', None)], replica_count=1)
+        cls._positions = [10]
+        assert cls.get_node('foo') == ('a', None)
+
+
+class TestCachingGraphiteClient(object):
+
+    def setup(self):
+        with patch('%s.GraphiteDestination' % pbm, autospec=True) as mock_d:
+            self.cls = CachingGraphiteClient(
+                'myhost', metric_prefix='pfx', replay_jitter=0
+            )
+        self.mock_dest = mock_d
+
+    def test_init(self):
+        assert self.mock_dest.mock_calls == [
+            call('myhost', port=2003, cache_dir='/var/lib/pi2graphite',
+                 replay_jitter=0, metric_prefix='pfx')
+        ]
+        assert self.cls._destinations == [self.mock_dest.return_value]
+        assert self.cls._ring is None
+        assert self.cls._pool is None
+
+    def test_init_multiple(self):
+        dests = [
+            {'host': 'a', 'port': 2004},
+            {'host': 'b'},
+            {'host': 'b', 'port': 2013, 'instance': 2}
+        ]
+        with patch('%s.GraphiteDestination' % pbm, autospec=True) as mock_d:
+            cls = CachingGraphiteClient(
+                destinations=dests, fanout='shard', cache_dir='/foo',
+                protocol='pickle'
+            )
+        assert mock_d.mock_calls == [
+            call('a', port=2004, cache_dir='/foo/a_2004', protocol='pickle',
+                 metric_prefix=''),
+            call('b', port=2003, cache_dir='/foo/b_2003', protocol='pickle',
+                 metric_prefix=''),
+            call('b', port=2013, cache_dir='/foo/b_2013', protocol='pickle',
+                 metric_prefix='')
+        ]
+        assert cls._nodes == {('a', None): 0, ('b', None): 1, ('b', '2'): 2}
+        assert cls._ring is not None
+        assert cls._pool is not None
+        cls.close()
+
+    def cache_contents(self, dest):
+        cache = dest._cache
+        return ''.join(
+            data for seg in cache.segments()
+            for data, _ in cache.read_chunks(seg)
+        )
+
+    def test_init_multiple_migrates_cache(self, tmpdir):
+        old = DiskCache(directory=str(tmpdir))
+        old.append('pfx.a 1 10\npfx.b 2 10\n')
+        old.append('pfx.c 3 11\n')
+        old.close()
+        tmpdir.join('1234.json').write('pfx.d 4 12\n')
+        dests = [{'host': 'a'}, {'host': 'b'}]
+        with patch('%s.logger' % pbm) as mock_logger:
+            cls = CachingGraphiteClient(
+                destinations=dests, cache_dir=str(tmpdir),
+                metric_prefix='pfx'
+            )
+        try:
+            for dest in cls._destinations:
+                assert self.cache_contents(dest) == (
+                    'pfx.a 1 10\npfx.b 2 10\npfx.c 3 11\npfx.d 4 12\n'
+                )
+        finally:
+            cls.close()
+        assert sorted(x.basename for x in tmpdir.listdir()) == [
+            'a_2003', 'b_2003'
+        ]
+        assert call(
+            'Moving %d datapoints cached in %s into the caches of %d '
+            'destinations', 4, str(tmpdir), 2
+        ) in mock_logger.warning.mock_calls
+
+    def test_init_multiple_migrates_cache_shard(self, tmpdir):
+        names = ['m%d' % i for i in range(50)]
+        old = DiskCache(directory=str(tmpdir))
+        old.append(''.join('pfx.%s 1 10\n' % n for n in names))
+        # the first 10 datapoints were already sent
+        old.commit(1, 0, points=10, lines=10)
+        old.close()
+        dests = [{'host': 'a'}, {'host': 'b'}, {'host': 'c'}]
+        cls = CachingGraphiteClient(
+            destinations=dests, fanout='shard', cache_dir=str(tmpdir),
+            metric_prefix='pfx'
+        )
+        try:
+            batches = cls._batches([(n, 1, 10) for n in names[10:]])
+            expected = dict(
+                (dest, ''.join('pfx.%s 1 10\n' % x[0] for x in batch))
+                for dest, batch in batches
+            )
+            assert len(expected) == 3
+            for dest in cls._destinations:
+                assert self.cache_contents(dest) == expected[dest]
+        finally:
+            cls.close()
+        assert DiskCache.has_data(str(tmpdir)) is False
+
+    def test_init_single_keeps_cache(self, tmpdir):
+        old = DiskCache(directory=str(tmpdir))
+        old.append('pfx.a 1 10\n')
+        old.close()
+        with patch('%s.DiskCache.discard' % pbm) as mock_discard:
+            cls = CachingGraphiteClient(
+                'myhost', cache_dir=str(tmpdir), metric_prefix='pfx'
+            )
+        try:
+            assert mock_discard.mock_calls == []
+            assert self.cache_contents(cls._destinations[0]) == (
+                'pfx.a 1 10\n'
+            )
+        finally:
+            cls.close()
+
+    def test_send_data(self):
+        self.cls.send_data([('foo', 1, 2), ('bar', 3, 4)])
+        assert self.mock_dest.return_value.mock_calls == [
+            call.send([('foo', 1, 2), ('bar', 3, 4)])
+        ]
+
+    def test_send_data_replicate(self):
+        d1 = Mock(spec_set=GraphiteDestination)
+        d2 = Mock(spec_set=GraphiteDestination)
+        self.cls._destinations = [d1, d2]
+        self.cls._pool = Mock()
+        self.cls._pool.map.side_effect = lambda f, x: [f(y) for y in x]
+        self.cls.send_data([('foo', 1, 2)])
+        assert d1.mock_calls == [call.send([('foo', 1, 2)])]
+        assert d2.mock_calls == [call.send([('foo', 1, 2)])]
+        assert len(self.cls._pool.map.mock_calls) == 1
+
+    def test_send_data_shard(self):
+        d1 = Mock(spec_set=GraphiteDestination)
+        d2 = Mock(spec_set=GraphiteDestination)
+        self.cls._destinations = [d1, d2]
+        self.cls._nodes = {('a', None): 0, ('b', None): 1}
+        self.cls._ring = Mock(spec_set=ConsistentHashRing)
+        self.cls._ring.get_node.side_effect = lambda x: (
+            ('a', None) if x.endswith('foo') else ('b', None)
+        )
+        self.cls._pool = Mock()
+        self.cls._pool.map.side_effect = lambda f, x: [f(y) for y in x]
+        self.cls.send_data([('foo', 1, 2), ('bar', 3, 4), ('x.foo', 5, 6)])
+        assert d1.mock_calls == [
+            call.send([('foo', 1, 2), ('x.foo', 5, 6)])
+        ]
+        assert d2.mock_calls == [call.send([('bar', 3, 4)])]
+        assert self.cls._shard_of == {'foo': 0, 'bar': 1, 'x.foo': 0}
+        assert self.cls._ring.get_node.mock_calls == [
+            call('pfx.foo'), call('pfx.bar'), call('pfx.x.foo')
+        ]
+        self.cls.send_data([('foo', 7, 8)])
+        assert len(self.cls._ring.get_node.mock_calls) == 3
+
+    def test_send_data_shard_one_batch(self):
+        d1 = Mock(spec_set=GraphiteDestination)
+        d2 = Mock(spec_set=GraphiteDestination)
+        self.cls._destinations = [d1, d2]
+        self.cls._nodes = {('a', None): 0, ('b', None): 1}
+        self.cls._ring = Mock(spec_set=ConsistentHashRing)
+        self.cls._ring.get_node.return_value = ('b', None)
+        self.cls._pool = Mock()
+        self.cls.send_data([('foo', 1, 2)])
+        assert d1.mock_calls == []
+        assert d2.mock_calls == [call.send([('foo', 1, 2)])]
+        assert self.cls._pool.mock_calls == []
+
+    def test_self_metrics(self):
+        self.mock_dest.return_value.self_metrics.return_value = [('a', 1, 2)]
+        assert self.cls.self_metrics(2) == [('a', 1, 2)]
+        assert self.mock_dest.return_value.mock_calls == [
+            call.self_metrics(2)
+        ]
+
+    def test_self_metrics_multiple(self):
+        d1 = Mock(spec_set=GraphiteDestination)
+        d1.name = 'a_2003'
+        d1.self_metrics.return_value = [('a', 1, 2)]
+        d2 = Mock(spec_set=GraphiteDestination)
+        d2.name = 'b_2003'
+        d2.self_metrics.return_value = [('b', 1, 2)]
+        self.cls._destinations = [d1, d2]
+        assert self.cls.self_metrics(2) == [('a', 1, 2), ('b', 1, 2)]
+        assert d1.mock_calls == [call.self_metrics(2, qualifier='.a_2003')]
+        assert d2.mock_calls == [call.self_metrics(2, qualifier='.b_2003')]
+
+    def test_close(self):
+        self.cls.close()
+        assert self.mock_dest.return_value.mock_calls == [call.close()]
+
+    def test_send_data_udp(self):
+        with patch('%s.GraphiteDestination' % pbm, autospec=True) as mock_d:
+            cls = CachingGraphiteClient(
+                'myhost', metric_prefix='pfx', udp_patterns=['wifi.*', 'x'],
+                udp_port=2013
+            )
+        assert mock_d.mock_calls == [
+            call('myhost', port=2003, cache_dir='/var/lib/pi2graphite',
+                 metric_prefix='pfx', udp_port=2013)
+        ]
+        cls.send_data([('wifi.foo', 1, 2), ('x', 3, 4), ('xy', 5, 6)])
+        cls.send_data([('x', 7, 8)])
+        assert mock_d.return_value.mock_calls == [
+            call.send_udp([('wifi.foo', 1, 2), ('x', 3, 4)]),
+            call.send([('xy', 5, 6)]),
+            call.send_udp([('x', 7, 8)])
+        ]
+
+    def test_send_data_queued(self):
+        with patch('%s.GraphiteDestination' % pbm, autospec=True) as mock_d:
+            cls = CachingGraphiteClient('myhost', queue_max_points=10)
+        cls.send_data([('foo', 1, 2)])
+        assert mock_d.return_value.mock_calls == [
+            call.enqueue([('foo', 1, 2)])
+        ]
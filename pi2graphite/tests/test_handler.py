@@ -0,0 +1,257 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+import sys
+from datetime import datetime, timedelta
+
+from pi2graphite.config import Config
+from pi2graphite.handler import MetricsHandler
+
+# https://code.google.com/p/mock/issues/detail?id=249
+# py>=3.4 should use unittest.mock not the mock package on pypi
+if (
+        sys.version_info[0] < 3 or
+        sys.version_info[0] == 3 and sys.version_info[1] < 4
+):
+    from mock import patch, call, Mock, DEFAULT  # noqa
+else:
+    from unittest.mock import patch, call, Mock, DEFAULT  # noqa
+
+pbm = 'pi2graphite.handler'
+pb = '%s.MetricsHandler' % pbm
+
+
+class HandlerTester(object):
+
+    def setup(self):
+        self.mock_conf = Mock(spec_set=Config)
+        self.mock_conf.polling_interval = 60
+        self.mock_conf.send_wifi_metrics = False
+        self.mock_conf.send_self_metrics = True
+        with patch.multiple(
+            pbm,
+            CachingGraphiteClient=DEFAULT,
+            OneWireCollector=DEFAULT,
+            WifiCollector=DEFAULT
+        ) as mocks:
+            self.cls = MetricsHandler(self.mock_conf)
+        self.mock_graphite = mocks['CachingGraphiteClient'].return_value
+        self.mock_1wire = mocks['OneWireCollector'].return_value
+        self.mock_wifi = mocks['WifiCollector'].return_value
+
+
+class TestOneWire(HandlerTester):
+
+    def test_kept_between_polls(self):
+        self.mock_1wire.poll.return_value = [('a', 1, 2)]
+        with patch('%s.OneWireCollector' % pbm) as mock_ow:
+            assert self.cls.do_poll() == [('a', 1, 2)]
+            assert self.cls.do_poll() == [('a', 1, 2)]
+        assert mock_ow.mock_calls == []
+        assert self.mock_1wire.poll.mock_calls == [call(), call()]
+        assert self.mock_1wire.close.mock_calls == []
+
+    def test_rebuilt_after_exception(self):
+        self.mock_1wire.poll.side_effect = RuntimeError('foo')
+        new_1wire = Mock()
+        new_1wire.poll.return_value = [('a', 1, 2)]
+        with patch('%s.OneWireCollector' % pbm) as mock_ow:
+            mock_ow.return_value = new_1wire
+            with patch('%s.logger' % pbm) as mock_logger:
+                assert self.cls.do_poll() == []
+                assert self.mock_1wire.close.mock_calls == [call()]
+                assert self.cls._1wire is None
+                assert mock_ow.mock_calls == []
+                assert self.cls.do_poll() == [('a', 1, 2)]
+        assert mock_ow.mock_calls == [call(self.mock_conf), call().poll()]
+        assert self.cls._1wire is new_1wire
+        assert mock_logger.error.mock_calls == [
+            call('Exception polling OneWire', exc_info=True)
+        ]
+
+    def test_close_exception(self):
+        self.mock_1wire.poll.side_effect = RuntimeError('foo')
+        self.mock_1wire.close.side_effect = RuntimeError('bar')
+        with patch('%s.logger' % pbm) as mock_logger:
+            assert self.cls.do_poll() == []
+        assert self.cls._1wire is None
+        assert mock_logger.error.mock_calls == [
+            call('Exception polling OneWire', exc_info=True),
+            call('Exception closing OneWireCollector', exc_info=True)
+        ]
+
+    def test_create_exception_retried(self):
+        self.cls._1wire = None
+        with patch('%s.OneWireCollector' % pbm) as mock_ow:
+            mock_ow.side_effect = [RuntimeError('foo'), self.mock_1wire]
+            self.mock_1wire.poll.return_value = [('a', 1, 2)]
+            with patch('%s.logger' % pbm):
+                assert self.cls.do_poll() == []
+            assert self.cls._1wire is None
+            assert self.cls.do_poll() == [('a', 1, 2)]
+        assert len(mock_ow.mock_calls) == 2
+
+    def test_closed_on_exit(self):
+        with patch('%s._poll_and_send' % pb, autospec=True) as mock_pas:
+            mock_pas.side_effect = SystemExit(0)
+            try:
+                self.cls.run()
+            except SystemExit:
+                pass
+        assert self.mock_1wire.close.mock_calls == [call()]
+        assert self.cls._1wire is None
+        assert self.mock_graphite.close.mock_calls == [call()]
+
+
+class TestSelfMetrics(HandlerTester):
+
+    def setup(self):
+        super(TestSelfMetrics, self).setup()
+        self.cls._poll_stats = {
+            'wifi': (0.5, 2),
+            'onewire': (0.12345678, 3)
+        }
+        self.cls._loop_lag = 1.5
+
+    def test_self_metrics(self):
+        with patch('%s.process_rss' % pbm) as mock_rss:
+            mock_rss.return_value = 1234
+            with patch('%s.os.times' % pbm) as mock_times:
+                mock_times.return_value = (1.23456, 0.5, 0, 0, 0)
+                res = self.cls.self_metrics(1000, 0.98765432, 5)
+        assert res == [
+            ('pi2graphite.poll.onewire.duration_sec', 0.123457, 1000),
+            ('pi2graphite.poll.onewire.points', 3, 1000),
+            ('pi2graphite.poll.wifi.duration_sec', 0.5, 1000),
+            ('pi2graphite.poll.wifi.points', 2, 1000),
+            ('pi2graphite.loop.poll_sec', 0.987654, 1000),
+            ('pi2graphite.loop.points', 5, 1000),
+            ('pi2graphite.loop.lag_sec', 1.5, 1000),
+            ('pi2graphite.process.rss_bytes', 1234, 1000),
+            ('pi2graphite.process.cpu_user_sec', 1.235, 1000),
+            ('pi2graphite.process.cpu_system_sec', 0.5, 1000)
+        ]
+
+    def test_self_metrics_no_rss(self):
+        with patch('%s.process_rss' % pbm) as mock_rss:
+            mock_rss.return_value = None
+            res = self.cls.self_metrics(1000, 1, 5)
+        names = [x[0] for x in res]
+        assert 'pi2graphite.process.rss_bytes' not in names
+        assert 'pi2graphite.process.cpu_user_sec' in names
+
+    def test_do_poll_stats(self):
+        self.mock_conf.send_wifi_metrics = True
+        self.cls._wifi_collector = self.mock_wifi
+        self.cls._poll_stats = {}
+        self.mock_1wire.poll.return_value = [('a', 1, 2), ('b', 3, 4)]
+        self.mock_wifi.poll.return_value = [('c', 5, 6)]
+        with patch('%s.time' % pbm) as mock_time:
+            mock_time.side_effect = [10.0, 10.25, 11.0, 11.5]
+            res = self.cls.do_poll()
+        assert res == [('a', 1, 2), ('b', 3, 4), ('c', 5, 6)]
+        assert self.cls._poll_stats == {
+            'onewire': (0.25, 2),
+            'wifi': (0.5, 1)
+        }
+
+    def test_do_poll_stats_exception(self):
+        self.cls._poll_stats = {}
+        self.mock_1wire.poll.side_effect = RuntimeError('foo')
+        with patch('%s.time' % pbm) as mock_time:
+            mock_time.side_effect = [10.0, 10.25]
+            with patch('%s.logger' % pbm):
+                assert self.cls.do_poll() == []
+        assert self.cls._poll_stats == {'onewire': (0.25, 0)}
+
+    def test_poll_and_send(self):
+        self.mock_graphite.self_metrics.return_value = [('g', 7, 1002)]
+        with patch.multiple(
+            pb, autospec=True, do_poll=DEFAULT, self_metrics=DEFAULT
+        ) as mocks:
+            mocks['do_poll'].return_value = [('a', 1, 1000)]
+            mocks['self_metrics'].return_value = [('s', 2, 1002)]
+            with patch('%s.time' % pbm) as mock_time:
+                mock_time.side_effect = [1000.0, 1002.5, 1002.75]
+                self.cls._poll_and_send()
+        assert mocks['self_metrics'].mock_calls == [
+            call(self.cls, 1002, 2.75, 1)
+        ]
+        assert self.mock_graphite.self_metrics.mock_calls == [call(1002)]
+        assert self.mock_graphite.send_data.mock_calls == [
+            call([('a', 1, 1000), ('s', 2, 1002), ('g', 7, 1002)])
+        ]
+
+    def test_poll_and_send_disabled(self):
+        self.mock_conf.send_self_metrics = False
+        with patch.multiple(
+            pb, autospec=True, do_poll=DEFAULT, self_metrics=DEFAULT
+        ) as mocks:
+            mocks['do_poll'].return_value = [('a', 1, 1000)]
+            self.cls._poll_and_send()
+        assert mocks['self_metrics'].mock_calls == []
+        assert self.mock_graphite.self_metrics.mock_calls == []
+        assert self.mock_graphite.send_data.mock_calls == [
+            call([('a', 1, 1000)])
+        ]
+
+    def test_loop_lag(self):
+        self.cls._loop_lag = 0.0
+        t0 = datetime(2016, 1, 1, 12, 0, 0)
+        lags = []
+
+        def se_pas(handler):
+            lags.append(handler._loop_lag)
+            if len(lags) == 3:
+                raise SystemExit(0)
+
+        with patch('%s.datetime' % pbm) as mock_dt:
+            mock_dt.now.side_effect = [
+                t0, t0 + timedelta(seconds=10),
+                # 5 seconds late
+                t0 + timedelta(seconds=65), t0 + timedelta(seconds=70),
+                # on time
+                t0 + timedelta(seconds=125)
+            ]
+            with patch('%s._poll_and_send' % pb, autospec=True) as mock_pas:
+                mock_pas.side_effect = se_pas
+                with patch('%s.sleep' % pbm) as mock_sleep:
+                    try:
+                        self.cls.run()
+                    except SystemExit:
+                        pass
+        assert lags == [0.0, 5.0, 0.0]
+        assert mock_sleep.mock_calls == [call(50.0), call(55.0)]
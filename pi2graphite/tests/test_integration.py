@@ -0,0 +1,140 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+
+import time
+
+from pi2graphite.graphiteclient import CachingGraphiteClient
+from pi2graphite.tests.fakecarbon import FakeCarbon
+
+
+class TestIntegration(object):
+    """
+    End-to-end tests of CachingGraphiteClient against a local FakeCarbon.
+    """
+
+    def setup(self):
+        self.carbon = FakeCarbon()
+        self.carbon.start()
+        self.clients = []
+
+    def teardown(self):
+        for c in self.clients:
+            c.close()
+        self.carbon.stop()
+
+    def client(self, tmpdir, **kwargs):
+        kwargs.setdefault('metric_prefix', 'pfx')
+        kwargs.setdefault('replay_jitter', 0)
+        kwargs.setdefault('replay_chunk_delay', 0)
+        kwargs.setdefault('connect_timeout', 1)
+        kwargs.setdefault('send_timeout', 1)
+        c = CachingGraphiteClient(
+            '127.0.0.1', port=self.carbon.port, cache_dir=str(tmpdir),
+            **kwargs
+        )
+        self.clients.append(c)
+        return c
+
+    def data(self, start, count):
+        return [('m%d' % i, float(i), 1000 + i) for i in range(start, count)]
+
+    def test_plaintext(self, tmpdir):
+        self.client(tmpdir).send_data(self.data(0, 3))
+        assert self.carbon.wait_for(3)
+        assert self.carbon.received() == [
+            ('pfx.m0', 0.0, 1000),
+            ('pfx.m1', 1.0, 1001),
+            ('pfx.m2', 2.0, 1002)
+        ]
+
+    def test_pickle(self, tmpdir):
+        self.carbon.stop()
+        self.carbon = FakeCarbon(protocol='pickle')
+        self.carbon.start()
+        self.client(
+            tmpdir, protocol='pickle', pickle_batch_size=2
+        ).send_data(self.data(0, 5))
+        assert self.carbon.wait_for(5)
+        assert sorted(self.carbon.received()) == [
+            ('pfx.m%d' % i, float(i), 1000 + i) for i in range(5)
+        ]
+
+    def test_refused_then_replay(self, tmpdir):
+        c = self.client(tmpdir)
+        self.carbon.fault('refuse')
+        c.send_data(self.data(0, 50))
+        assert c.self_metrics(1)[2][:2] == ('pi2graphite.cache.points', 50)
+        self.carbon.fault(None)
+        c.send_data(self.data(50, 60))
+        assert self.carbon.wait_for(60)
+        assert self.carbon.duplicates() == 0
+        assert sorted(p[2] for p in self.carbon.received()) == list(
+            range(1000, 1060)
+        )
+
+    def test_reset_mid_stream(self, tmpdir):
+        c = self.client(tmpdir)
+        c.send_data(self.data(0, 1))
+        assert self.carbon.wait_for(1)
+        self.carbon.fault('reset', reset_after=100)
+        c.send_data(self.data(1, 20))
+        # give the reset a chance to arrive before the next send
+        time.sleep(0.2)
+        self.carbon.fault(None)
+        c.send_data(self.data(20, 21))
+        assert self.carbon.wait_for(1, prefix='pfx.m20')
+        assert self.carbon.resets == 1
+        assert self.carbon.connections == 2
+
+    def test_slow(self, tmpdir):
+        self.carbon.fault('slow', read_bytes=64, read_delay=0.01)
+        self.client(tmpdir).send_data(self.data(0, 100))
+        assert self.carbon.wait_for(100)
+        assert self.carbon.duplicates() == 0
+
+    def test_half_open(self, tmpdir):
+        c = self.client(tmpdir, send_buffer_bytes=4096)
+        c.send_data(self.data(0, 1))
+        assert self.carbon.wait_for(1)
+        self.carbon.fault('half_open')
+        # enough data to fill the socket buffers, so the send times out
+        c.send_data(self.data(1, 20000))
+        points = c.self_metrics(1)[2][1]
+        assert points > 0
+        self.carbon.fault(None)
+        c.send_data(self.data(20000, 20001))
+        assert self.carbon.wait_for(1, prefix='pfx.m20000')
@@ -0,0 +1,731 @@
+"""
+The latest version of this package is available at:
+<http://github.com/jantman/pi2graphite>
+
+##################################################################################
+Copyright 2016 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pi2graphite, also known as pi2graphite.
+
+    pi2graphite is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pi2graphite is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with pi2graphite.  If not, see <http://www.gnu.org/licenses/>.
+
+The Copyright and Authors attributions contained herein may not be removed or
+otherwise altered, except to add the Author attribution of a contributor to
+this work. (Additional Terms pursuant to Section 7b of the AGPL v3)
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pi2graphite> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+##################################################################################
+"""
+import os
+import sys
+import time
+import errno
+import shutil
+import tempfile
+import threading
+import pytest
+from multiprocessing.pool import ThreadPool
+
+from w1thermsensor import W1ThermSensor
+
+from pi2graphite.config import Config
+from pi2graphite.onewire_collector import (
+    OneWireCollector, SysfsSensor, SensorReadError, parse_w1_slave
+)
+
+# https://code.google.com/p/mock/issues/detail?id=249
+# py>=3.4 should use unittest.mock not the mock package on pypi
+if (
+        sys.version_info[0] < 3 or
+        sys.version_info[0] == 3 and sys.version_info[1] < 4
+):
+    from mock import patch, call, Mock, DEFAULT  # noqa
+else:
+    from unittest.mock import patch, call, Mock, DEFAULT  # noqa
+
+pbm = 'pi2graphite.onewire_collector'
+pb = '%s.OneWireCollector' % pbm
+
+CRC_OK = '72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+CRC_BAD = '72 01 4b 46 7f ff 0e 10 57 : crc=57 NO\n'
+
+
+def w1_slave(temp, crc=CRC_OK):
+    return crc + '72 01 4b 46 7f ff 0e 10 57 t=%d\n' % temp
+
+
+class FakeSysfs(object):
+    """
+    Fake /sys/bus/w1/devices tree; w1thermsensor is pointed at it for the
+    duration of each test.
+    """
+
+    def __init__(self):
+        self.base = tempfile.mkdtemp()
+        self._patch = patch.object(W1ThermSensor, 'BASE_DIRECTORY', self.base)
+        self._patch.start()
+
+    def cleanup(self):
+        self._patch.stop()
+        shutil.rmtree(self.base)
+
+    def add(self, dirname, content=None):
+        path = os.path.join(self.base, dirname)
+        if not os.path.exists(path):
+            os.mkdir(path)
+        if content is not None:
+            with open(os.path.join(path, 'w1_slave'), 'w') as fh:
+                fh.write(content)
+
+    def remove(self, dirname):
+        shutil.rmtree(os.path.join(self.base, dirname))
+
+
+def mock_config(**kwargs):
+    conf = Mock(spec_set=Config)
+    conf.onewire_bulk_read = False
+    conf.onewire_hotplug_interval = 0
+    conf.onewire_read_threads = 1
+    conf.onewire_reader = 'w1thermsensor'
+    conf.onewire_rescan_interval = 300
+    conf.onewire_sensor_timeout = 10
+    for k, v in kwargs.items():
+        setattr(conf, 'onewire_%s' % k, v)
+    conf.metric_name_for_sensor.side_effect = lambda x: {
+        '28-000000000001': 'tempA'
+    }.get(x, x)
+    return conf
+
+
+class TestParseW1Slave(object):
+
+    def test_ok(self):
+        assert parse_w1_slave(w1_slave(23125).encode('ascii')) == 23125
+
+    def test_negative(self):
+        assert parse_w1_slave(w1_slave(-1250).encode('ascii')) == -1250
+        assert parse_w1_slave(w1_slave(-62).encode('ascii')) == -62
+        assert parse_w1_slave(w1_slave(0).encode('ascii')) == 0
+
+    def test_no_trailing_newline(self):
+        data = (CRC_OK + '72 01 4b 46 7f ff 0e 10 57 t=125').encode('ascii')
+        assert parse_w1_slave(data) == 125
+
+    def test_crc_no(self):
+        with pytest.raises(SensorReadError) as excinfo:
+            parse_w1_slave(w1_slave(23125, crc=CRC_BAD).encode('ascii'))
+        assert 'CRC check failed' in str(excinfo.value)
+
+    def test_no_temperature(self):
+        with pytest.raises(SensorReadError) as excinfo:
+            parse_w1_slave((CRC_OK + '72 01 4b\n').encode('ascii'))
+        assert 'No temperature' in str(excinfo.value)
+
+    def test_garbled_temperature(self):
+        for t in ['t=', 't=12x4', 't=--1', 't=1.5']:
+            data = (CRC_OK + '72 01 4b %s\n' % t).encode('ascii')
+            with pytest.raises(SensorReadError) as excinfo:
+                parse_w1_slave(data)
+            assert 'Invalid temperature' in str(excinfo.value)
+
+    def test_empty(self):
+        # i.e. read while a conversion is pending
+        with pytest.raises(SensorReadError):
+            parse_w1_slave(b'')
+
+    def test_truncated(self):
+        for data in [CRC_OK[:20], CRC_OK[:-4] + '\n', CRC_OK]:
+            with pytest.raises(SensorReadError):
+                parse_w1_slave(data.encode('ascii'))
+
+
+class TestSysfsSensor(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.sysfs.add('28-000000000001', w1_slave(23125))
+        self.cls = SysfsSensor(self.sysfs.base, '28-000000000001')
+
+    def teardown(self):
+        self.cls.close()
+        self.sysfs.cleanup()
+
+    def test_init(self):
+        assert self.cls.slave_prefix == '28-'
+        assert self.cls.id == '000000000001'
+        assert self.cls.path == os.path.join(
+            self.sysfs.base, '28-000000000001', 'w1_slave'
+        )
+        assert self.cls._fd is None
+        assert repr(self.cls) == '<SysfsSensor 28-000000000001>'
+
+    def test_read_keeps_file_open(self):
+        with patch('%s.os.open' % pbm, wraps=os.open) as mock_open:
+            assert self.cls.read_millicelsius() == 23125
+            self.sysfs.add('28-000000000001', w1_slave(-1250))
+            assert self.cls.read_millicelsius() == -1250
+        assert len(mock_open.mock_calls) == 1
+        assert self.cls._fd is not None
+
+    def test_read_errors_reopen(self):
+        for num in [errno.EIO, errno.ENODEV, errno.ENOENT]:
+            fd = os.open(os.devnull, os.O_RDONLY)
+            self.cls._fd = fd
+            with patch('%s._pread' % pbm) as mock_pread:
+                mock_pread.side_effect = OSError(num, os.strerror(num))
+                with pytest.raises(OSError):
+                    self.cls.read_millicelsius()
+            assert mock_pread.mock_calls == [call(fd, 256)]
+            assert self.cls._fd is None
+            with pytest.raises(OSError):
+                # closed by the failed read
+                os.fstat(fd)
+            # reopened on the next read
+            assert self.cls.read_millicelsius() == 23125
+            assert self.cls._fd is not None
+            self.cls.close()
+
+    def test_read_invalid_closes(self):
+        self.sysfs.add('28-000000000001', '')
+        with pytest.raises(SensorReadError):
+            self.cls.read_millicelsius()
+        assert self.cls._fd is None
+        self.sysfs.add('28-000000000001', w1_slave(100))
+        assert self.cls.read_millicelsius() == 100
+
+    def test_open_fails(self):
+        self.sysfs.remove('28-000000000001')
+        with pytest.raises(OSError):
+            self.cls.read_millicelsius()
+        assert self.cls._fd is None
+
+    def test_close(self):
+        self.cls.read_millicelsius()
+        fd = self.cls._fd
+        self.cls.close()
+        self.cls.close()
+        assert self.cls._fd is None
+        with pytest.raises(OSError):
+            os.fstat(fd)
+
+
+class TestSysfsReader(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.temps = [23125, -1250, 0, -62, 85000, 125000, -55000, 1]
+        for i, t in enumerate(self.temps):
+            self.sysfs.add('28-%012x' % i, w1_slave(t))
+        self.sysfs.add('w1_bus_master1')
+
+    def teardown(self):
+        self.sysfs.cleanup()
+
+    def test_same_as_w1thermsensor(self):
+        native = OneWireCollector(mock_config(reader='sysfs'))
+        w1 = OneWireCollector(mock_config())
+        try:
+            for i, t in enumerate(self.temps):
+                dirname = '28-%012x' % i
+                sensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20,
+                                       dirname[3:])
+                expected = sensor.get_temperatures([
+                    W1ThermSensor.DEGREES_C, W1ThermSensor.DEGREES_F
+                ])
+                res = native._poll_sensor(native._handle(dirname), 1234)
+                assert res == [
+                    ('%s.temp_c' % dirname, expected[0], 1234),
+                    ('%s.temp_f' % dirname, expected[1], 1234)
+                ]
+            assert sorted(native.poll()) == sorted(w1.poll())
+        finally:
+            native.close()
+            w1.close()
+
+    def test_handles_reused(self):
+        cls = OneWireCollector(mock_config(reader='sysfs', rescan_interval=0))
+        try:
+            with patch('%s.os.open' % pbm, wraps=os.open) as mock_open:
+                assert len(cls.poll()) == 16
+                assert len(cls.poll()) == 16
+            assert len(mock_open.mock_calls) == 8
+            assert sorted(cls._handles) == [
+                '28-%012x' % i for i in range(8)
+            ]
+            old = cls._handles['28-000000000000']
+            self.sysfs.remove('28-000000000000')
+            assert len(cls.poll()) == 14
+            assert '28-000000000000' not in cls._handles
+            assert old._fd is None
+        finally:
+            cls.close()
+        assert cls._handles == {}
+
+    def test_crc_error_reported_per_sensor(self):
+        self.sysfs.add('28-000000000001', w1_slave(1, crc=CRC_BAD))
+        cls = OneWireCollector(mock_config(reader='sysfs'))
+        try:
+            with patch('%s.logger' % pbm) as mock_logger:
+                res = cls.poll()
+        finally:
+            cls.close()
+        assert len(res) == 14
+        assert 'tempA.temp_c' not in [x[0] for x in res]
+        assert len(mock_logger.error.mock_calls) == 1
+        args = mock_logger.error.mock_calls[0][1]
+        assert args[0] == 'Error polling sensor %s'
+        assert args[1].id == '000000000001'
+
+
+class TestNoSensors(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.sysfs.add('w1_bus_master1')
+
+    def teardown(self):
+        self.sysfs.cleanup()
+
+    def test_sysfs(self):
+        with patch.object(W1ThermSensor, 'get_available_sensors') as mock_get:
+            cls = OneWireCollector(mock_config(reader='sysfs'))
+            try:
+                assert cls._1w is None
+                assert cls.poll() == []
+            finally:
+                cls.close()
+        assert mock_get.mock_calls == []
+
+    def test_w1thermsensor(self):
+        with pytest.raises(Exception) as excinfo:
+            OneWireCollector(mock_config())
+        assert excinfo.type.__name__ == 'NoSensorFoundError'
+
+
+class TestPollParallel(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.sysfs.add('28-000000000001', w1_slave(20000))
+        self.release = threading.Event()
+        self.cls = OneWireCollector(
+            mock_config(read_threads=3, sensor_timeout=0.3)
+        )
+
+    def teardown(self):
+        self.release.set()
+        self.cls.close()
+        self.sysfs.cleanup()
+
+    def poll_sensor(self, hang=(), fail=()):
+        def se(sensor, ts):
+            if sensor in hang:
+                self.release.wait()
+            if sensor in fail:
+                raise RuntimeError('read failed')
+            return [('%s.temp_c' % sensor, 1.0, ts)]
+        self.cls._poll_sensor = se
+
+    def errors(self, mock_logger):
+        return [
+            (c[1][0], c[1][1]) for c in mock_logger.error.mock_calls
+        ]
+
+    def test_hang_and_raise(self):
+        self.poll_sensor(hang=['s1'], fail=['s2'])
+        sensors = ['s0', 's1', 's2', 's3', 's4']
+        with patch('%s.logger' % pbm) as mock_logger:
+            start = time.time()
+            res = self.cls._poll_parallel(sensors, 1234)
+            elapsed = time.time() - start
+        # two rounds of reads for five sensors on three threads
+        assert elapsed < 0.6 + 0.2
+        assert sorted(res) == [
+            ('s0.temp_c', 1.0, 1234),
+            ('s3.temp_c', 1.0, 1234),
+            ('s4.temp_c', 1.0, 1234)
+        ]
+        assert self.errors(mock_logger) == [
+            ('Timed out polling sensor %s after %s seconds', 's1'),
+            ('Error polling sensor %s', 's2')
+        ]
+        assert self.cls._sensors is None
+
+    def test_hung_threads_skip_unstarted(self):
+        self.poll_sensor(hang=['s0', 's1', 's2'])
+        sensors = ['s0', 's1', 's2', 's3']
+        with patch('%s.logger' % pbm) as mock_logger:
+            start = time.time()
+            res = self.cls._poll_parallel(sensors, 1234)
+            elapsed = time.time() - start
+        assert elapsed < 0.6 + 0.2
+        assert res == []
+        assert [x[1] for x in self.errors(mock_logger)] == [
+            's0', 's1', 's2', 's3'
+        ]
+
+    def test_pool_reused_and_closed(self):
+        self.poll_sensor()
+        with patch('%s.ThreadPool' % pbm, wraps=ThreadPool) as mock_pool:
+            self.cls._poll_parallel(['s0', 's1'], 1234)
+            pool = self.cls._pool
+            self.cls._poll_parallel(['s0', 's1', 's2'], 1235)
+        assert mock_pool.mock_calls[0] == call(3)
+        assert len([
+            c for c in mock_pool.mock_calls if c[0] == ''
+        ]) == 1
+        assert self.cls._pool is pool
+        self.cls.close()
+        assert self.cls._pool is None
+        with pytest.raises(ValueError):
+            pool.apply_async(len, ('x',))
+
+    def test_hung_reads_do_not_add_threads(self):
+        self.poll_sensor(hang=['s0', 's1', 's2'])
+        before = threading.active_count()
+        with patch('%s.logger' % pbm):
+            self.cls._poll_parallel(['s0', 's1', 's2'], 1234)
+            during = threading.active_count()
+            self.cls._poll_parallel(['s0', 's1', 's2'], 1235)
+            self.cls._poll_parallel(['s0', 's1', 's2'], 1236)
+        assert threading.active_count() == during
+        assert during > before
+
+
+class TestBulkRead(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.sysfs.add('28-000000000001', w1_slave(20000))
+        self.sysfs.add('w1_bus_master1')
+        self.sysfs.add('w1_bus_master2')
+        self.bulk1 = os.path.join(
+            self.sysfs.base, 'w1_bus_master1', 'therm_bulk_read'
+        )
+        self.bulk2 = os.path.join(
+            self.sysfs.base, 'w1_bus_master2', 'therm_bulk_read'
+        )
+        with open(self.bulk1, 'w') as fh:
+            fh.write('0\n')
+        self.cls = OneWireCollector(
+            mock_config(bulk_read=True, sensor_timeout=0.2)
+        )
+
+    def teardown(self):
+        self.cls.close()
+        self.sysfs.cleanup()
+
+    def test_trigger(self):
+        with patch('%s._bulk_status' % pb, autospec=True) as mock_status:
+            mock_status.return_value = 0
+            with patch('%s.logger' % pbm) as mock_logger:
+                self.cls._bulk_convert()
+        with open(self.bulk1, 'r') as fh:
+            assert fh.read() == 'trigger\n'
+        # the bus master without bulk read support is left alone
+        assert not os.path.exists(self.bulk2)
+        assert mock_status.mock_calls == [call(self.cls, self.bulk1)]
+        assert mock_logger.warning.mock_calls == []
+
+    def test_no_bus_supports_bulk(self):
+        os.unlink(self.bulk1)
+        with patch('%s._bulk_status' % pb, autospec=True) as mock_status:
+            with patch('%s.logger' % pbm) as mock_logger:
+                self.cls._bulk_convert()
+        assert mock_status.mock_calls == []
+        assert mock_logger.debug.mock_calls == [
+            call('No 1wire bus masters support bulk conversion')
+        ]
+        assert mock_logger.warning.mock_calls == []
+
+    def test_trigger_error(self):
+        # make the trigger write fail on bus 1 but not bus 2
+        os.unlink(self.bulk1)
+        os.mkdir(self.bulk1)
+        with open(self.bulk2, 'w') as fh:
+            fh.write('0\n')
+        with patch('%s._bulk_status' % pb, autospec=True) as mock_status:
+            mock_status.return_value = 0
+            with patch('%s.logger' % pbm) as mock_logger:
+                self.cls._bulk_convert()
+        assert mock_status.mock_calls == [call(self.cls, self.bulk2)]
+        assert len(mock_logger.warning.mock_calls) == 1
+        args = mock_logger.warning.mock_calls[0][1]
+        assert args[0].startswith('Unable to trigger bulk conversion')
+        assert args[1] == self.bulk1
+
+    def test_trigger_error_falls_back_to_per_sensor(self):
+        os.unlink(self.bulk1)
+        os.mkdir(self.bulk1)
+        with patch('%s.logger' % pbm) as mock_logger:
+            res = self.cls.poll()
+        assert res == [
+            ('tempA.temp_c', 20.0, res[0][2]),
+            ('tempA.temp_f', 68.0, res[0][2])
+        ]
+        assert len(mock_logger.warning.mock_calls) == 1
+        assert mock_logger.error.mock_calls == []
+
+    def test_waits_while_converting(self):
+        with patch('%s._bulk_status' % pb, autospec=True) as mock_status:
+            mock_status.side_effect = [-1, -1, 1]
+            with patch('%s.time.sleep' % pbm) as mock_sleep:
+                with patch('%s.logger' % pbm) as mock_logger:
+                    self.cls._bulk_convert()
+        assert len(mock_status.mock_calls) == 3
+        assert mock_sleep.mock_calls == [call(0.05), call(0.05)]
+        assert mock_logger.warning.mock_calls == []
+
+    def test_timeout(self):
+        with patch('%s._bulk_status' % pb, autospec=True) as mock_status:
+            mock_status.return_value = -1
+            with patch('%s.logger' % pbm) as mock_logger:
+                start = time.time()
+                self.cls._bulk_convert()
+                elapsed = time.time() - start
+        assert 0.2 <= elapsed < 0.5
+        assert mock_logger.warning.mock_calls == [
+            call('Bulk conversion not complete after %s seconds on: %s',
+                 0.2, [self.bulk1])
+        ]
+
+    def test_status(self):
+        for content, expected in [
+            ('-1\n', -1), ('1\n', 1), ('0\n', 0), ('garbage\n', 0)
+        ]:
+            with open(self.bulk1, 'w') as fh:
+                fh.write(content)
+            assert self.cls._bulk_status(self.bulk1) == expected
+        assert self.cls._bulk_status(self.bulk2) == 0
+
+    def test_poll_converts_first(self):
+        with patch.multiple(
+            pb, autospec=True, _bulk_convert=DEFAULT, _poll_sensor=DEFAULT
+        ) as mocks:
+            mocks['_poll_sensor'].return_value = []
+            self.cls.poll()
+            self.cls._bulk_read = False
+            self.cls.poll()
+        assert mocks['_bulk_convert'].mock_calls == [call(self.cls)]
+        assert len(mocks['_poll_sensor'].mock_calls) == 2
+
+
+class TestRescan(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.sysfs.add('28-000000000001', w1_slave(20000))
+        self.sysfs.add('w1_bus_master1')
+
+    def teardown(self):
+        self.sysfs.cleanup()
+
+    def names(self, res):
+        return sorted(set(x[0].rsplit('.', 1)[0] for x in res))
+
+    def test_cached_within_interval(self):
+        cls = OneWireCollector(mock_config(rescan_interval=300))
+        try:
+            orig = OneWireCollector._scan
+            with patch('%s._scan' % pb, autospec=True) as mock_scan:
+                mock_scan.side_effect = orig
+                assert self.names(cls.poll()) == ['tempA']
+                self.sysfs.add('28-000000000002', w1_slave(10000))
+                assert self.names(cls.poll()) == ['tempA']
+                assert len(mock_scan.mock_calls) == 1
+                # interval elapsed; next call rescans
+                res = cls._get_sensors(cls._scanned + 300)
+                assert len(mock_scan.mock_calls) == 2
+        finally:
+            cls.close()
+        assert sorted(s.id for s in res) == ['000000000001', '000000000002']
+
+    def test_names_resolved_once(self):
+        conf = mock_config(rescan_interval=0)
+        cls = OneWireCollector(conf)
+        try:
+            cls.poll()
+            cls.poll()
+            cls.poll()
+        finally:
+            cls.close()
+        assert conf.metric_name_for_sensor.mock_calls == [
+            call('28-000000000001')
+        ]
+
+    def test_interval_zero(self):
+        cls = OneWireCollector(mock_config(rescan_interval=0))
+        try:
+            assert self.names(cls.poll()) == ['tempA']
+            self.sysfs.add('28-000000000002', w1_slave(10000))
+            assert self.names(cls.poll()) == ['28-000000000002', 'tempA']
+            self.sysfs.remove('28-000000000001')
+            assert self.names(cls.poll()) == ['28-000000000002']
+        finally:
+            cls.close()
+
+    def test_read_failure_forces_rescan(self):
+        self.sysfs.add('28-000000000002', w1_slave(10000, crc=CRC_BAD))
+        cls = OneWireCollector(mock_config(rescan_interval=300))
+        try:
+            with patch('%s.logger' % pbm):
+                assert self.names(cls.poll()) == ['tempA']
+            assert cls._sensors is None
+            # the failed sensor was unplugged and another added
+            self.sysfs.remove('28-000000000002')
+            self.sysfs.add('28-000000000003', w1_slave(10000))
+            assert self.names(cls.poll()) == ['28-000000000003', 'tempA']
+            assert cls._sensors is not None
+        finally:
+            cls.close()
+
+    def test_scan_failure(self):
+        cls = OneWireCollector(mock_config(rescan_interval=300))
+        try:
+            with patch('%s._scan' % pb, autospec=True) as mock_scan:
+                mock_scan.side_effect = RuntimeError('foo')
+                with patch('%s.logger' % pbm) as mock_logger:
+                    assert cls.poll() == []
+            assert len(mock_logger.error.mock_calls) == 1
+            assert cls._sensors is None
+            assert self.names(cls.poll()) == ['tempA']
+        finally:
+            cls.close()
+
+
+class TestSensorsChanged(object):
+
+    def setup(self):
+        self.sysfs = FakeSysfs()
+        self.sysfs.add('28-000000000001', w1_slave(20000))
+        self.sysfs.add('w1_bus_master1')
+
+    def teardown(self):
+        self.sysfs.cleanup()
+
+    def ids(self, cls):
+        return [s.id for s in cls._sensors]
+
+    def test_added(self):
+        conf = mock_config()
+        cls = OneWireCollector(conf)
+        try:
+            cls.poll()
+            self.sysfs.add('28-000000000002', w1_slave(10000))
+            with patch('%s._scan' % pb, autospec=True) as mock_scan:
+                cls._sensors_changed(set(['28-000000000002']), set())
+                res = cls.poll()
+        finally:
+            cls.close()
+        assert mock_scan.mock_calls == []
+        assert self.ids(cls) == ['000000000001', '000000000002']
+        assert sorted(x[0] for x in res) == [
+            '28-000000000002.temp_c', '28-000000000002.temp_f',
+            'tempA.temp_c', 'tempA.temp_f'
+        ]
+        assert conf.metric_name_for_sensor.mock_calls == [
+            call('28-000000000001'), call('28-000000000002')
+        ]
+
+    def test_removed_closes_fd(self):
+        self.sysfs.add('28-000000000002', w1_slave(10000))
+        cls = OneWireCollector(mock_config(reader='sysfs'))
+        try:
+            cls.poll()
+            old = cls._handles['28-000000000001']
+            fd = old._fd
+            assert fd is not None
+            self.sysfs.remove('28-000000000001')
+            cls._sensors_changed(set(), set(['28-000000000001']))
+            assert self.ids(cls) == ['000000000002']
+            assert sorted(cls._handles) == ['28-000000000002']
+            assert old._fd is None
+            with pytest.raises(OSError):
+                os.fstat(fd)
+            assert [x[0] for x in cls.poll()] == [
+                '28-000000000002.temp_c', '28-000000000002.temp_f'
+            ]
+        finally:
+            cls.close()
+
+    def test_non_sensor_entries_ignored(self):
+        cls = OneWireCollector(mock_config(reader='sysfs'))
+        try:
+            cls.poll()
+            sensors = cls._sensors
+            self.sysfs.add('w1_bus_master2')
+            with patch('%s.logger' % pbm) as mock_logger:
+                cls._sensors_changed(
+                    set(['w1_bus_master2']), set(['w1_bus_master1'])
+                )
+            assert cls._sensors is sensors
+            assert sorted(cls._handles) == ['28-000000000001']
+            assert mock_logger.mock_calls == []
+        finally:
+            cls.close()
+
+    def test_not_scanned_yet(self):
+        cls = OneWireCollector(mock_config())
+        try:
+            cls._sensors_changed(set(['28-000000000002']), set())
+            assert cls._sensors is None
+        finally:
+            cls.close()
+
+    def test_under_lock(self):
+        cls = OneWireCollector(mock_config())
+        try:
+            cls.poll()
+            self.sysfs.add('28-000000000002', w1_slave(10000))
+            t = threading.Thread(
+                target=cls._sensors_changed,
+                args=(set(['28-000000000002']), set())
+            )
+            with cls._lock:
+                t.start()
+                t.join(0.2)
+                # blocked until the lock is released
+                assert t.is_alive()
+                assert self.ids(cls) == ['000000000001']
+            t.join(5)
+            assert not t.is_alive()
+            assert self.ids(cls) == ['000000000001', '000000000002']
+        finally:
+            cls.close()
+
+    def test_hotplug(self):
+        cls = OneWireCollector(mock_config(hotplug_interval=0.05))
+        try:
+            assert cls._watcher is not None
+            cls.poll()
+            # move the sensor in complete, as the kernel would add it
+            tmp = tempfile.mkdtemp(dir=os.path.dirname(self.sysfs.base))
+            with open(os.path.join(tmp, 'w1_slave'), 'w') as fh:
+                fh.write(w1_slave(10000))
+            os.rename(tmp, os.path.join(self.sysfs.base, '28-000000000002'))
+            for _ in range(100):
+                if len(cls._sensors) == 2:
+                    break
+                time.sleep(0.05)
+            assert self.ids(cls) == ['000000000001', '000000000002']
+        finally:
+            cls.close()
+        assert cls._watcher is None
@@ -34,13 +34,18 @@ AUTHORS:
 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 ##################################################################################
 """
+import os
 import sys
+import signal
+import socket
 import logging
+import subprocess
 import pytest
 
 from pi2graphite.version import PROJECT_URL, VERSION
 from pi2graphite.runner import (
-    parse_args, set_log_debug, set_log_info, set_log_level_format
+    parse_args, set_log_debug, set_log_info, set_log_level_format, main,
+    handle_sigterm
 )
 
 # https://code.google.com/p/mock/issues/detail?id=249
@@ -129,3 +134,89 @@ class TestSetLog(object):
         assert mock_logger.mock_calls == [
             call.setLevel(5)
         ]
+
+
+class TestMain(object):
+
+    def test_main(self):
+        args = parse_args(['-c', 'foo.json'])
+        with patch.multiple(
+            pbm,
+            autospec=True,
+            Config=DEFAULT,
+            MetricsHandler=DEFAULT
+        ) as mocks:
+            with patch('%s.signal.signal' % pbm) as mock_signal:
+                mocks['Config'].return_value.logging_level = 'WARNING'
+                main(args)
+        assert mocks['Config'].mock_calls[0] == call('foo.json')
+        assert mock_signal.mock_calls == [
+            call(signal.SIGTERM, handle_sigterm)
+        ]
+        assert mocks['MetricsHandler'].mock_calls == [
+            call(mocks['Config'].return_value),
+            call().run()
+        ]
+
+
+# child process for TestHandleSigterm; queues datapoints for a destination
+# that refuses connections, then waits to be killed
+SIGTERM_CHILD = """
+import signal
+import sys
+import time
+from pi2graphite.graphiteclient import CachingGraphiteClient
+from pi2graphite.runner import handle_sigterm
+
+client = CachingGraphiteClient(
+    '127.0.0.1', port=int(sys.argv[1]), cache_dir=sys.argv[2],
+    queue_max_points=10000, queue_retry_delay=60, replay_jitter=0,
+    cache_compress=False
+)
+client.send_data([('foo', 1, 1000), ('bar', 2, 1000)])
+signal.signal(signal.SIGTERM, handle_sigterm)
+try:
+    sys.stdout.write('ready\\n')
+    sys.stdout.flush()
+    while True:
+        time.sleep(1)
+finally:
+    client.close()
+"""
+
+
+class TestHandleSigterm(object):
+
+    def test_raises(self):
+        with pytest.raises(SystemExit) as excinfo:
+            handle_sigterm(signal.SIGTERM, None)
+        assert excinfo.value.code == 0
+
+    def test_sigterm_caches_queue(self, tmpdir):
+        # find a port nothing is listening on
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        cache_dir = str(tmpdir.join('cache'))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        proc = subprocess.Popen(
+            [sys.executable, '-c', SIGTERM_CHILD, str(port), cache_dir],
+            stdout=subprocess.PIPE, env=env
+        )
+        try:
+            assert proc.stdout.readline().strip() == b'ready'
+            assert os.listdir(cache_dir) == []
+            proc.send_signal(signal.SIGTERM)
+            assert proc.wait() == 0
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+        segments = [x for x in os.listdir(cache_dir) if x.endswith('.seg')]
+        assert len(segments) == 1
+        with open(os.path.join(cache_dir, segments[0]), 'rb') as fh:
+            data = fh.read()
+        assert b'foo 1 1000' in data
+        assert b'bar 2 1000' in data
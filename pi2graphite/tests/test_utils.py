@@ -38,7 +38,7 @@ import sys
 import pytest
 import json
 
-from pi2graphite.utils import pretty_json, read_json_file
+from pi2graphite.utils import pretty_json, read_json_file, process_rss
 from pi2graphite.tests.support import exc_msg
 
 # https://code.google.com/p/mock/issues/detail?id=249
@@ -95,3 +95,17 @@ class TestUtils(object):
         assert exc_msg(excinfo.value) == 'ERROR: file /my/path does not exist.'
         assert mock_exist.mock_calls == [call('/my/path')]
         assert m_open.mock_calls == []
+
+    def test_process_rss(self):
+        with patch('%s.open' % pbm, mock_open(read_data='1234 56 78 9 0\n'),
+                   create=True) as m_open:
+            with patch('%s.os.sysconf' % pbm, autospec=True) as mock_conf:
+                mock_conf.return_value = 4096
+                assert process_rss() == 56 * 4096
+        assert m_open.mock_calls[0] == call('/proc/self/statm', 'r')
+        assert mock_conf.mock_calls == [call('SC_PAGE_SIZE')]
+
+    def test_process_rss_unavailable(self):
+        with patch('%s.open' % pbm, create=True) as m_open:
+            m_open.side_effect = IOError('no such file')
+            assert process_rss() is None
@@ -59,6 +59,23 @@ def read_json_file(fpath):
     return res
 
 
+def process_rss():
+    """
+    Return the current resident set size of this process, from
+    ``/proc/self/statm``.
+
+    :return: RSS in bytes, or None if it cannot be determined (i.e. not on
+      Linux)
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
 def pretty_json(obj):
     """
     Given an object, return a pretty-printed JSON representation of it.